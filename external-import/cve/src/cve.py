@@ -5,13 +5,13 @@ import yaml
 import time
 import urllib.request
 import gzip
-import shutil
 import certifi
 import ssl
 
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 from pycti import OpenCTIConnectorHelper, get_config_variable
-from cvetostix2 import convert
+from cvetostix2 import DEFAULT_BUNDLE_SIZE, iter_bundles
 
 
 class Cve:
@@ -37,6 +37,16 @@ class Cve:
         self.cve_interval = get_config_variable(
             "CVE_INTERVAL", ["cve", "interval"], config, True
         )
+        self.cve_bundle_size = get_config_variable(
+            "CVE_BUNDLE_SIZE",
+            ["cve", "bundle_size"],
+            config,
+            True,
+            DEFAULT_BUNDLE_SIZE,
+        )
+        self.cve_history_workers = get_config_variable(
+            "CVE_HISTORY_WORKERS", ["cve", "history_workers"], config, True, 4
+        )
         self.update_existing_data = get_config_variable(
             "CONNECTOR_UPDATE_EXISTING_DATA",
             ["connector", "update_existing_data"],
@@ -46,46 +56,24 @@ class Cve:
     def get_interval(self):
         return int(self.cve_interval) * 60 * 60 * 24
 
-    def delete_files(self):
-        if os.path.exists("data.json"):
-            os.remove("data.json")
-        if os.path.exists("data.json.gz"):
-            os.remove("data.json.gz")
-        if os.path.exists("data-stix2.json"):
-            os.remove("data-stix2.json")
-
     def convert_and_send(self, url, work_id):
         try:
-            # Downloading json.gz file
+            # Downloading, unzipping and converting the json.gz file on the fly
             self.helper.log_info("Requesting the file " + url)
-            response = urllib.request.urlopen(
+            count = 0
+            with urllib.request.urlopen(
                 url, context=ssl.create_default_context(cafile=certifi.where())
-            )
-            image = response.read()
-            with open(
-                os.path.dirname(os.path.abspath(__file__)) + "/data.json.gz", "wb"
-            ) as file:
-                file.write(image)
-            # Unzipping the file
-            self.helper.log_info("Unzipping the file")
-            with gzip.open("data.json.gz", "rb") as f_in:
-                with open("data.json", "wb") as f_out:
-                    shutil.copyfileobj(f_in, f_out)
-            # Converting the file to stix2
-            self.helper.log_info("Converting the file")
-            convert("data.json", "data-stix2.json")
-            with open("data-stix2.json") as stix_json:
-                contents = stix_json.read()
-                self.helper.send_stix2_bundle(
-                    contents,
-                    entities_types=self.helper.connect_scope,
-                    update=self.update_existing_data,
-                    work_id=work_id,
-                )
-            # Remove files
-            self.delete_files()
+            ) as response, gzip.GzipFile(fileobj=response) as data:
+                for bundle in iter_bundles(data, self.cve_bundle_size):
+                    self.helper.send_stix2_bundle(
+                        bundle,
+                        entities_types=self.helper.connect_scope,
+                        update=self.update_existing_data,
+                        work_id=work_id,
+                    )
+                    count += 1
+            self.helper.log_info("Sent " + str(count) + " bundles from " + url)
         except Exception as e:
-            self.delete_files()
             self.helper.log_error(str(e))
             time.sleep(60)
 
@@ -118,11 +106,16 @@ class Cve:
                 if last_run is None and self.cve_import_history:
                     now = datetime.now()
                     years = list(range(2002, now.year + 1))
-                    for year in years:
-                        self.convert_and_send(
-                            f"{self.cve_history_data_feed}nvdcve-1.1-{year}.json.gz",
-                            work_id,
-                        )
+                    # The yearly feeds are independent, import them concurrently
+                    with ThreadPoolExecutor(
+                        max_workers=self.cve_history_workers
+                    ) as executor:
+                        for year in years:
+                            executor.submit(
+                                self.convert_and_send,
+                                f"{self.cve_history_data_feed}nvdcve-1.1-{year}.json.gz",
+                                work_id,
+                            )
 
                 # Store the current timestamp as a last run
                 self.helper.log_info(
@@ -3,8 +3,8 @@
 import sys
 import datetime
 
-# Importing the JSON module
-import json
+# Importing the streaming JSON parser
+import ijson
 
 # Importing the different stix2 modules
 from stix2 import Vulnerability
@@ -14,93 +14,112 @@ from stix2 import ExternalReference
 
 from pycti import OpenCTIStix2Utils
 
+# Vulnerabilities per bundle
+DEFAULT_BUNDLE_SIZE = 1000
 
-def convert(filename, output="output.json"):
-    # Create the default author
-    author = Identity(name="The MITRE Corporation", identity_class="organization")
-    count = 0
-    with open(filename) as json_file:
-        vulnerabilities_bundle = [author]
-        data = json.load(json_file)
-        for cves in data["CVE_Items"]:
-            count += 1
-            # Get the name
-            name = cves["cve"]["CVE_data_meta"]["ID"]
-
-            # Create external references
+
+def create_author():
+    return Identity(name="The MITRE Corporation", identity_class="organization")
+
+
+def convert_item(cves, author):
+    """Convert an item of the CVE_Items of an NVD feed to a Vulnerability"""
+    # Get the name
+    name = cves["cve"]["CVE_data_meta"]["ID"]
+
+    # Create external references
+    external_reference = ExternalReference(
+        source_name="NIST NVD", url="https://nvd.nist.gov/vuln/detail/" + name
+    )
+    external_references = [external_reference]
+    if "references" in cves["cve"] and "reference_data" in cves["cve"]["references"]:
+        for reference in cves["cve"]["references"]["reference_data"]:
             external_reference = ExternalReference(
-                source_name="NIST NVD", url="https://nvd.nist.gov/vuln/detail/" + name
-            )
-            external_references = [external_reference]
-            if (
-                "references" in cves["cve"]
-                and "reference_data" in cves["cve"]["references"]
-            ):
-                for reference in cves["cve"]["references"]["reference_data"]:
-                    external_reference = ExternalReference(
-                        source_name=reference["refsource"], url=reference["url"]
-                    )
-                    external_references.append(external_reference)
-
-            # Getting the different fields
-            description = cves["cve"]["description"]["description_data"][0]["value"]
-            base_score = (
-                cves["impact"]["baseMetricV3"]["cvssV3"]["baseScore"]
-                if "baseMetricV3" in cves["impact"]
-                else None
-            )
-            base_severity = (
-                cves["impact"]["baseMetricV3"]["cvssV3"]["baseSeverity"]
-                if "baseMetricV3" in cves["impact"]
-                else None
-            )
-            attack_vector = (
-                cves["impact"]["baseMetricV3"]["cvssV3"]["attackVector"]
-                if "baseMetricV3" in cves["impact"]
-                else None
-            )
-            integrity_impact = (
-                cves["impact"]["baseMetricV3"]["cvssV3"]["integrityImpact"]
-                if "baseMetricV3" in cves["impact"]
-                else None
-            )
-            availability_impact = (
-                cves["impact"]["baseMetricV3"]["cvssV3"]["availabilityImpact"]
-                if "baseMetricV3" in cves["impact"]
-                else None
-            )
-            confidentiality_impact = (
-                cves["impact"]["baseMetricV3"]["cvssV3"]["confidentialityImpact"]
-                if "baseMetricV3" in cves["impact"]
-                else None
-            )
-            cdate = datetime.datetime.strptime(cves["publishedDate"], "%Y-%m-%dT%H:%MZ")
-            mdate = datetime.datetime.strptime(
-                cves["lastModifiedDate"], "%Y-%m-%dT%H:%MZ"
+                source_name=reference["refsource"], url=reference["url"]
             )
+            external_references.append(external_reference)
 
-            # Creating the vulnerability with the extracted fields
-            vuln = Vulnerability(
-                id=OpenCTIStix2Utils.generate_random_stix_id("vulnerability"),
-                name=name,
-                created=cdate,
-                modified=mdate,
-                description=description,
-                created_by_ref=author,
-                external_references=external_references,
-                custom_properties={
-                    "x_opencti_base_score": base_score,
-                    "x_opencti_base_severity": base_severity,
-                    "x_opencti_attack_vector": attack_vector,
-                    "x_opencti_integrity_impact": integrity_impact,
-                    "x_opencti_availability_impact": availability_impact,
-                    "x_opencti_confidentiality_impact": confidentiality_impact,
-                },
-            )
-            # Adding the vulnerability to the list of vulnerabilities
-            vulnerabilities_bundle.append(vuln)
+    # Getting the different fields
+    description = cves["cve"]["description"]["description_data"][0]["value"]
+    base_score = (
+        cves["impact"]["baseMetricV3"]["cvssV3"]["baseScore"]
+        if "baseMetricV3" in cves["impact"]
+        else None
+    )
+    base_severity = (
+        cves["impact"]["baseMetricV3"]["cvssV3"]["baseSeverity"]
+        if "baseMetricV3" in cves["impact"]
+        else None
+    )
+    attack_vector = (
+        cves["impact"]["baseMetricV3"]["cvssV3"]["attackVector"]
+        if "baseMetricV3" in cves["impact"]
+        else None
+    )
+    integrity_impact = (
+        cves["impact"]["baseMetricV3"]["cvssV3"]["integrityImpact"]
+        if "baseMetricV3" in cves["impact"]
+        else None
+    )
+    availability_impact = (
+        cves["impact"]["baseMetricV3"]["cvssV3"]["availabilityImpact"]
+        if "baseMetricV3" in cves["impact"]
+        else None
+    )
+    confidentiality_impact = (
+        cves["impact"]["baseMetricV3"]["cvssV3"]["confidentialityImpact"]
+        if "baseMetricV3" in cves["impact"]
+        else None
+    )
+    cdate = datetime.datetime.strptime(cves["publishedDate"], "%Y-%m-%dT%H:%MZ")
+    mdate = datetime.datetime.strptime(cves["lastModifiedDate"], "%Y-%m-%dT%H:%MZ")
+
+    # Creating the vulnerability with the extracted fields
+    vuln = Vulnerability(
+        id=OpenCTIStix2Utils.generate_random_stix_id("vulnerability"),
+        name=name,
+        created=cdate,
+        modified=mdate,
+        description=description,
+        created_by_ref=author,
+        external_references=external_references,
+        custom_properties={
+            "x_opencti_base_score": base_score,
+            "x_opencti_base_severity": base_severity,
+            "x_opencti_attack_vector": attack_vector,
+            "x_opencti_integrity_impact": integrity_impact,
+            "x_opencti_availability_impact": availability_impact,
+            "x_opencti_confidentiality_impact": confidentiality_impact,
+        },
+    )
+    return vuln
+
+
+def iter_bundles(json_file, bundle_size=DEFAULT_BUNDLE_SIZE):
+    """
+    Yield the serialized bundles of at most `bundle_size` vulnerabilities of
+    an NVD JSON feed, each bundle holding the author
+    """
+    author = create_author()
+    vulnerabilities = []
+    for cves in ijson.items(json_file, "CVE_Items.item", use_float=True):
+        vulnerabilities.append(convert_item(cves, author))
+        if len(vulnerabilities) >= bundle_size:
+            yield Bundle([author] + vulnerabilities, allow_custom=True).serialize()
+            vulnerabilities = []
+    if len(vulnerabilities) > 0:
+        yield Bundle([author] + vulnerabilities, allow_custom=True).serialize()
+
+
+def convert(filename, output="output.json"):
+    with open(filename, "rb") as json_file:
+        author = create_author()
+        vulnerabilities = [
+            convert_item(cves, author)
+            for cves in ijson.items(json_file, "CVE_Items.item", use_float=True)
+        ]
     # Creating the bundle from the list of vulnerabilities
-    bundle = Bundle(vulnerabilities_bundle, allow_custom=True)
+    bundle = Bundle([author] + vulnerabilities, allow_custom=True)
     bundle_json = bundle.serialize()
 
     # Write to file
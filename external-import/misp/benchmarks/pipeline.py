@@ -0,0 +1,104 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmark of the pipelined conversion of MISP events
+
+Serves synthetic pages of events with a simulated MISP response time and
+compares Misp.process_pages with Misp.process_pages_pipelined. Both
+must send one bundle per event, in the same order, and return the same latest
+event timestamp.
+
+Usage: PYTHONPATH=src python benchmarks/pipeline.py [pages] [attributes] [workers]
+"""
+
+import json
+import random
+import sys
+import time
+
+from process_events import BenchmarkHelper, build_connector, build_event
+
+RESPONSE_TIME = 0.5
+
+
+class BenchmarkMisp:
+    def __init__(self, events: list) -> None:
+        self.events = events
+
+    def search(self, controller: str, **kwargs) -> list:
+        time.sleep(RESPONSE_TIME)
+        offset = (kwargs["page"] - 1) * kwargs["limit"]
+        return self.events[offset : offset + kwargs["limit"]]
+
+
+def build_events(rng: random.Random, count: int, attributes: int) -> list:
+    events = []
+    for _ in range(count):
+        event = build_event(rng, rng.randint(1, attributes))
+        # Events are not ordered by timestamp in API responses
+        event["Event"]["timestamp"] = str(1640995200 + rng.randint(0, 10**6))
+        events.append(event)
+    return events
+
+
+def new_run(connector) -> dict:
+    return {
+        "timestamp": int(time.time()),
+        "query": {},
+        "offset": 0,
+        "page_size": connector.page_sizer.initial_size,
+        "number_events": 0,
+        "latest_event_timestamp": None,
+    }
+
+
+def report_ids(helper: BenchmarkHelper) -> list:
+    return [
+        [o["id"] for o in json.loads(bundle)["objects"] if o["type"] == "report"]
+        for bundle in helper.bundles
+    ]
+
+
+def main() -> None:
+    page_count = int(sys.argv[1]) if len(sys.argv) > 1 else 4
+    attributes = int(sys.argv[2]) if len(sys.argv) > 2 else 200
+    workers = int(sys.argv[3]) if len(sys.argv) > 3 else 4
+    events = build_events(random.Random(42), page_count * 50, attributes)
+
+    serial_helper = BenchmarkHelper()
+    connector = build_connector(serial_helper)
+    connector.misp = BenchmarkMisp(events)
+    serial_run = new_run(connector)
+    start = time.perf_counter()
+    connector.process_pages(None, None, serial_run)
+    serial_time = time.perf_counter() - start
+    print(f"Serial:    {len(serial_helper.bundles)} bundles in {serial_time:.2f}s")
+
+    pipeline_helper = BenchmarkHelper()
+    connector = build_connector(pipeline_helper)
+    connector.misp = BenchmarkMisp(events)
+    connector.pipeline_workers = workers
+    connector.pipeline_prefetch_pages = 2
+    pipeline_run = new_run(connector)
+    start = time.perf_counter()
+    connector.process_pages_pipelined(None, None, pipeline_run)
+    pipeline_time = time.perf_counter() - start
+    print(
+        f"Pipelined: {len(pipeline_helper.bundles)} bundles of "
+        f"{pipeline_run['number_events']} events in {pipeline_time:.2f}s "
+        f"({workers} workers)"
+    )
+
+    if report_ids(serial_helper) != report_ids(pipeline_helper):
+        raise SystemExit("Serial and pipelined bundles differ")
+    serial_timestamp = serial_run["latest_event_timestamp"]
+    pipeline_timestamp = pipeline_run["latest_event_timestamp"]
+    if serial_timestamp != pipeline_timestamp:
+        raise SystemExit("Serial and pipelined timestamps differ")
+    print(
+        f"Identical bundles and latest timestamp ({pipeline_timestamp}), "
+        f"speedup x{serial_time / pipeline_time:.1f}"
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,199 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmark of the conversion of MISP events into STIX2 bundles
+
+Builds synthetic events of growing size (attributes, objects with object
+references, sightings and event reports linking attributes) and measures
+Misp.process_events, the time per attribute should stay flat.
+
+Usage: PYTHONPATH=src python benchmarks/process_events.py [attributes...]
+"""
+
+import json
+import random
+import sys
+import time
+import uuid
+
+from misp import Misp, PageSizer
+
+
+class BenchmarkHelper:
+    connect_name = "MISP"
+    connect_confidence_level = 15
+
+    def __init__(self):
+        self.bundles = []
+        self.state = None
+
+    def log_debug(self, msg: str) -> None:
+        pass
+
+    def log_info(self, msg: str) -> None:
+        pass
+
+    def log_error(self, msg: str) -> None:
+        print(msg)
+
+    def set_state(self, state: dict) -> None:
+        self.state = state
+
+    def send_stix2_bundle(self, bundle: str, work_id=None, update=False) -> list:
+        self.bundles.append(bundle)
+        return []
+
+
+def build_connector(helper: BenchmarkHelper) -> Misp:
+    connector = Misp.__new__(Misp)
+    connector.helper = helper
+    connector.misp_url = "https://misp.example.com"
+    connector.misp_reference_url = None
+    connector.misp_create_report = True
+    connector.misp_create_indicators = True
+    connector.misp_create_observables = True
+    connector.misp_create_object_observables = True
+    connector.misp_report_type = "MISP Event"
+    connector.import_creator_orgs = None
+    connector.import_owner_orgs = None
+    connector.import_distribution_levels = None
+    connector.import_threat_levels = None
+    connector.import_only_published = None
+    connector.import_with_attachments = False
+    connector.import_to_ids_no_score = None
+    connector.import_unsupported_observables_as_text = False
+    connector.update_existing_data = False
+    connector.resolution_cache_size = 10000
+    # Events are not streamed
+    connector.stream_event_attributes = 0
+    connector.stream_bundle_size = 0
+    connector.init_caches()
+    connector.page_sizer = PageSizer(25, 800, 30, 50000)
+    return connector
+
+
+def random_uuid(rng: random.Random) -> str:
+    return str(uuid.UUID(int=rng.getrandbits(128), version=4))
+
+
+def build_attribute(rng: random.Random, timestamp: int) -> dict:
+    attribute_type = rng.choice(["ip-dst", "domain", "md5", "url"])
+    if attribute_type == "ip-dst":
+        value = ".".join(str(rng.randint(1, 254)) for _ in range(4))
+    elif attribute_type == "domain":
+        value = f"host{rng.randint(0, 10 ** 9)}.example.com"
+    elif attribute_type == "md5":
+        value = "%032x" % rng.getrandbits(128)
+    else:
+        value = f"https://host{rng.randint(0, 10 ** 9)}.example.com/index.php"
+
+    attribute = {
+        "uuid": random_uuid(rng),
+        "type": attribute_type,
+        "category": "Network activity",
+        "value": value,
+        "comment": "",
+        "to_ids": True,
+        "timestamp": str(timestamp),
+        "Tag": [
+            {"name": "tlp:green"},
+            {"name": f"campaign:{rng.randint(0, 50)}"},
+            {"name": f'misp-galaxy:threat-actor="APT {rng.randint(0, 20)}"'},
+        ],
+    }
+    if rng.random() < 0.05:
+        attribute["Sighting"] = [
+            {
+                "date_sighting": str(timestamp),
+                "Organisation": {"uuid": random_uuid(rng), "name": "Sighter"},
+            }
+        ]
+    return attribute
+
+
+def build_event(rng: random.Random, size: int) -> dict:
+    timestamp = 1640995200
+    attributes = [build_attribute(rng, timestamp) for _ in range(size // 2)]
+
+    objects = []
+    object_attributes = []
+    for _ in range(size // 4):
+        members = [build_attribute(rng, timestamp) for _ in range(2)]
+        object_attributes.extend(members)
+        objects.append(
+            {
+                "name": "domain-ip",
+                "meta-category": "network",
+                "description": "Domain and IP",
+                "Attribute": members,
+                "ObjectReference": [],
+            }
+        )
+    for misp_object in objects:
+        source = misp_object["Attribute"][0]
+        target = rng.choice(object_attributes)
+        misp_object["ObjectReference"].append(
+            {
+                "uuid": random_uuid(rng),
+                "source_uuid": source["uuid"],
+                "referenced_uuid": target["uuid"],
+                "relationship_type": "connects-to",
+                "comment": "",
+            }
+        )
+
+    content = " ".join(
+        f"@[attribute]({rng.choice(attributes)['uuid']})" for _ in range(size // 10)
+    )
+    return {
+        "Event": {
+            "id": str(rng.randint(1, 10**6)),
+            "uuid": random_uuid(rng),
+            "info": f"Synthetic event of {size} attributes",
+            "date": "2022-01-01",
+            "timestamp": str(timestamp),
+            "threat_level_id": "2",
+            "distribution": "1",
+            "published": True,
+            "Orgc": {"name": "Author"},
+            "Org": {"name": "Owner"},
+            "Tag": [{"name": "tlp:amber"}],
+            "Galaxy": [],
+            "Attribute": attributes,
+            "Object": objects,
+            "EventReport": [
+                {
+                    "uuid": random_uuid(rng),
+                    "name": "Report",
+                    "timestamp": str(timestamp),
+                    "content": content,
+                }
+            ],
+        }
+    }
+
+
+def main() -> None:
+    sizes = [int(size) for size in sys.argv[1:]] or [1000, 2000, 4000, 8000]
+    rng = random.Random(42)
+
+    for size in sizes:
+        event = build_event(rng, size)
+        helper = BenchmarkHelper()
+        connector = build_connector(helper)
+
+        start = time.perf_counter()
+        connector.process_events(None, [event])
+        elapsed = time.perf_counter() - start
+
+        bundle_objects = len(json.loads(helper.bundles[0])["objects"])
+        print(
+            f"{size:>7} attributes: {elapsed:7.2f}s, "
+            f"{elapsed / size * 1000:.3f}ms per attribute, "
+            f"{bundle_objects} bundle objects"
+        )
+        for name, counters in connector.cache_statistics().items():
+            print(f"        {name} cache: {counters}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,122 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmark of the streaming of huge MISP events
+
+Serves one synthetic huge event through a fake MISP and converts it at once,
+then streamed by slices of attributes and objects. Both modes must send the
+same indicators and object references, the peak memory of the streamed mode is bounded by the bundle
+size.
+
+Usage: PYTHONPATH=src python benchmarks/stream_event.py [attributes] [bundle size]
+"""
+
+import copy
+import json
+import random
+import sys
+import time
+import tracemalloc
+
+from process_events import BenchmarkHelper, build_connector, build_event
+
+
+class BenchmarkMisp:
+    def __init__(self, event: dict) -> None:
+        self.event = event
+
+    def search(self, controller: str, **kwargs) -> list:
+        event = self.event["Event"]
+        if controller == "events":
+            if kwargs.get("page", 1) > 1:
+                return []
+            if kwargs.get("metadata"):
+                metadata = {
+                    key: value
+                    for key, value in event.items()
+                    if key not in ["Attribute", "Object", "EventReport"]
+                }
+                metadata["attribute_count"] = str(
+                    len(event["Attribute"])
+                    + sum(len(o["Attribute"]) for o in event["Object"])
+                )
+                return [{"Event": metadata}]
+            return [copy.deepcopy(self.event)]
+
+        offset = (kwargs["page"] - 1) * kwargs["limit"]
+        if controller == "attributes":
+            attributes = event["Attribute"] + [
+                dict(attribute, object_id="1")
+                for misp_object in event["Object"]
+                for attribute in misp_object["Attribute"]
+            ]
+            return {"Attribute": attributes[offset : offset + kwargs["limit"]]}
+        return [
+            {"Object": misp_object}
+            for misp_object in event["Object"][offset : offset + kwargs["limit"]]
+        ]
+
+
+def run(event: dict, stream_event_attributes: int, bundle_size: int) -> tuple:
+    helper = BenchmarkHelper()
+    connector = build_connector(helper)
+    connector.misp = BenchmarkMisp(event)
+    connector.stream_event_attributes = stream_event_attributes
+    connector.stream_bundle_size = bundle_size
+    current_run = {
+        "timestamp": int(time.time()),
+        "query": {},
+        "offset": 0,
+        "page_size": connector.page_sizer.initial_size,
+        "number_events": 0,
+        "latest_event_timestamp": None,
+    }
+
+    tracemalloc.start()
+    start = time.perf_counter()
+    connector.process_pages(None, None, current_run)
+    elapsed = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    indicators = set()
+    references = set()
+    largest = 0
+    for bundle in helper.bundles:
+        objects = json.loads(bundle)["objects"]
+        largest = max(largest, len(objects))
+        indicators.update(o["id"] for o in objects if o["type"] == "indicator")
+        references.update(
+            (o["id"], o["source_ref"], o["target_ref"])
+            for o in objects
+            if o["type"] == "relationship"
+            and o.get("description", "").startswith("Original Relationship")
+        )
+    print(
+        f"{len(helper.bundles)} bundles (largest {largest} objects) "
+        f"in {elapsed:.2f}s, peak memory {peak / 1024 / 1024:.1f} MB"
+    )
+    return indicators, references
+
+
+def main() -> None:
+    size = int(sys.argv[1]) if len(sys.argv) > 1 else 4000
+    bundle_size = int(sys.argv[2]) if len(sys.argv) > 2 else 1000
+    event = build_event(random.Random(42), size)
+
+    print("At once:  ", end="")
+    full_indicators, full_references = run(event, 0, bundle_size)
+    print("Streamed: ", end="")
+    streamed_indicators, streamed_references = run(event, 1, bundle_size)
+
+    if full_indicators != streamed_indicators:
+        raise SystemExit("Streamed and full conversions differ")
+    if full_references != streamed_references:
+        raise SystemExit("Streamed and full object references differ")
+    print(
+        f"Identical indicators ({len(full_indicators)}) "
+        f"and object references ({len(full_references)})"
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -3,6 +3,12 @@ import os
 import yaml
 import time
 import json
+import queue
+import threading
+import uuid
+import multiprocessing
+
+from collections import deque, OrderedDict
 
 from datetime import datetime
 from pymisp import ExpandedPyMISP
@@ -29,6 +35,7 @@ from stix2 import (
     Note,
 )
 
+from stix2.canonicalization.Canonicalize import canonicalize
 from pycti import (
     OpenCTIConnectorHelper,
     get_config_variable,
@@ -69,6 +76,185 @@ OPENCTISTIX2 = {
     "text": {"type": "x-opencti-text", "path": ["value"]},
 }
 FILETYPES = ["file-name", "file-md5", "file-sha1", "file-sha256"]
+MARKING_TAGS = ["tlp:white", "tlp:green", "tlp:amber", "tlp:red"]
+# Tags already converted to markings or entities, not imported as labels
+EXCLUDED_TAG_PREFIXES = [
+    "misp-galaxy:threat-actor",
+    "misp-galaxy:mitre-threat-actor",
+    "misp-galaxy:microsoft-activity-group",
+    "misp-galaxy:mitre-enterprise-attack-threat-actor",
+    "misp-galaxy:mitre-mobile-attack-intrusion-set",
+    "misp-galaxy:mitre-intrusion-set",
+    "misp-galaxy:mitre-enterprise-attack-intrusion-set",
+    "misp-galaxy:mitre-malware",
+    "misp-galaxy:mitre-enterprise-attack-malware",
+    "misp-galaxy:mitre-attack-pattern",
+    "misp-galaxy:mitre-enterprise-attack-attack-pattern",
+    "misp-galaxy:mitre-tool",
+    "misp-galaxy:tool",
+    "misp-galaxy:ransomware",
+    "misp-galaxy:malpedia",
+    "misp-galaxy:sector",
+    "misp-galaxy:country",
+]
+
+
+class LRUCache:
+    # Bounded cache dropping the least recently used entries, with hit counters
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, compute):
+        if key in self.entries:
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return self.entries[key]
+
+        self.misses += 1
+        value = compute()
+        if self.maxsize > 0:
+            self.entries[key] = value
+            if len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+        return value
+
+    def reset_statistics(self):
+        self.hits = 0
+        self.misses = 0
+
+    def statistics(self):
+        return {"hits": self.hits, "misses": self.misses, "size": len(self.entries)}
+
+
+class PrefixTrie:
+    # Character trie telling if a value starts with one of the prefixes
+    def __init__(self, prefixes):
+        self.root = {}
+        for prefix in prefixes:
+            node = self.root
+            for char in prefix:
+                node = node.setdefault(char, {})
+            node[None] = True
+
+    def match(self, value):
+        node = self.root
+        for char in value:
+            if None in node:
+                return True
+            node = node.get(char)
+            if node is None:
+                return False
+        return None in node
+
+
+EXCLUDED_TAG_TRIE = PrefixTrie(EXCLUDED_TAG_PREFIXES)
+
+
+def count_attributes(events):
+    count = 0
+    for event in events:
+        if "Attribute" not in event["Event"]:
+            # Metadata only
+            count += int(event["Event"].get("attribute_count") or 0)
+            continue
+        count += len(event["Event"]["Attribute"])
+        for misp_object in event["Event"].get("Object", []):
+            count += len(misp_object.get("Attribute", []))
+    return count
+
+
+def count_bundle_objects(indicators, objects_observables):
+    count = len(objects_observables)
+    for indicator in indicators:
+        count += sum(
+            1 for key in ["indicator", "observable"] if indicator[key] is not None
+        )
+        for key in ["relationships", "sightings", "identities"]:
+            count += len(indicator[key])
+    return count
+
+
+def generate_organization_id(name):
+    # Same id as the OpenCTI standard id of the organization, so that the author
+    # of the events of an organization, and the elements it creates, are stable
+    data = canonicalize(
+        {"name": name.lower().strip(), "identity_class": "organization"}, utf8=False
+    )
+    return "identity--" + str(
+        uuid.uuid5(uuid.UUID("00abedb4-aa42-466c-9c01-fed23315a9b7"), data)
+    )
+
+
+class PageSizer:
+    # Page sizes are the minimum size doubled up to the maximum size, a page size is only used
+    # once it divides the number of events already fetched, so pages can still be addressed by number
+    def __init__(self, minimum, maximum, target_duration, max_attributes):
+        self.sizes = [max(1, minimum)]
+        while self.sizes[-1] * 2 <= maximum:
+            self.sizes.append(self.sizes[-1] * 2)
+        self.target_duration = target_duration
+        self.max_attributes = max_attributes
+        self.initial_size = self.fit(50)
+
+    def fit(self, size):
+        index = 0
+        while index + 1 < len(self.sizes) and self.sizes[index + 1] <= size:
+            index += 1
+        return self.sizes[index]
+
+    def page(self, offset, page_size):
+        index = self.sizes.index(self.fit(page_size))
+        while index > 0 and offset % self.sizes[index] != 0:
+            index -= 1
+        limit = self.sizes[index]
+        # Only when the sizes were changed since the checkpoint, some events are fetched again
+        return offset // limit + 1, limit
+
+    def smaller_size(self, page_size):
+        index = self.sizes.index(self.fit(page_size))
+        return self.sizes[max(0, index - 1)]
+
+    def next_size(self, page_info):
+        index = self.sizes.index(self.fit(page_info["limit"]))
+        if (
+            page_info["duration"] > self.target_duration
+            or page_info["attributes"] > self.max_attributes
+        ):
+            index = max(0, index - 1)
+        elif (
+            page_info["events"] == page_info["limit"]
+            and page_info["duration"] < self.target_duration / 4
+            and page_info["attributes"] < self.max_attributes / 4
+        ):
+            index = min(len(self.sizes) - 1, index + 1)
+        return self.sizes[index]
+
+
+# Connector of the pipeline worker processes, inherited from the parent at fork
+_pipeline_connector = None
+
+
+def _init_pipeline_worker(connector):
+    global _pipeline_connector
+    _pipeline_connector = connector
+
+
+def _process_event_worker(event):
+    result = _pipeline_connector.process_event(event)
+    return result, os.getpid(), _pipeline_connector.cache_statistics()
+
+
+def merge_cache_statistics(statistics_list):
+    merged = {}
+    for statistics in statistics_list:
+        for name, counters in statistics.items():
+            for counter, value in counters.items():
+                merged.setdefault(name, {}).setdefault(counter, 0)
+                merged[name][counter] += value
+    return merged
 
 
 class Misp:
@@ -169,12 +355,83 @@ class Misp:
             ["connector", "update_existing_data"],
             config,
         )
+        self.pipeline_workers = get_config_variable(
+            "MISP_PIPELINE_WORKERS",
+            ["misp", "pipeline_workers"],
+            config,
+            True,
+            1,
+        )
+        self.pipeline_prefetch_pages = get_config_variable(
+            "MISP_PIPELINE_PREFETCH_PAGES",
+            ["misp", "pipeline_prefetch_pages"],
+            config,
+            True,
+            2,
+        )
+        self.resolution_cache_size = get_config_variable(
+            "MISP_RESOLUTION_CACHE_SIZE",
+            ["misp", "resolution_cache_size"],
+            config,
+            True,
+            10000,
+        )
+        self.init_caches()
+        self.stream_event_attributes = get_config_variable(
+            "MISP_STREAM_EVENT_ATTRIBUTES",
+            ["misp", "stream_event_attributes"],
+            config,
+            True,
+            0,
+        )
+        self.stream_bundle_size = get_config_variable(
+            "MISP_STREAM_BUNDLE_SIZE",
+            ["misp", "stream_bundle_size"],
+            config,
+            True,
+            5000,
+        )
+        self.page_sizer = PageSizer(
+            get_config_variable(
+                "MISP_PAGE_SIZE_MIN", ["misp", "page_size_min"], config, True, 25
+            ),
+            get_config_variable(
+                "MISP_PAGE_SIZE_MAX", ["misp", "page_size_max"], config, True, 800
+            ),
+            get_config_variable(
+                "MISP_PAGE_TARGET_DURATION",
+                ["misp", "page_target_duration"],
+                config,
+                True,
+                30,
+            ),
+            get_config_variable(
+                "MISP_PAGE_MAX_ATTRIBUTES",
+                ["misp", "page_max_attributes"],
+                config,
+                True,
+                50000,
+            ),
+        )
 
         # Initialize MISP
         self.misp = ExpandedPyMISP(
             url=self.misp_url, key=self.misp_key, ssl=self.misp_ssl_verify, debug=False
         )
 
+    def init_caches(self):
+        # Markings, labels and entities resolved from tags and galaxies
+        self.markings_cache = LRUCache(self.resolution_cache_size)
+        self.tags_cache = LRUCache(self.resolution_cache_size)
+        self.elements_cache = LRUCache(self.resolution_cache_size)
+
+    def cache_statistics(self):
+        return {
+            "markings": self.markings_cache.statistics(),
+            "tags": self.tags_cache.statistics(),
+            "elements": self.elements_cache.statistics(),
+        }
+
     def get_interval(self):
         return int(self.misp_interval) * 60
 
@@ -188,6 +445,10 @@ class Misp:
                 self.helper.connect_id, friendly_name
             )
             current_state = self.helper.get_state()
+            current_run = None
+            if current_state is not None:
+                current_state = dict(current_state)
+                current_run = current_state.pop("current_run", None)
             if (
                 current_state is not None
                 and "last_run" in current_state
@@ -223,79 +484,95 @@ class Misp:
                 latest_event_timestamp = None
                 self.helper.log_info("Connector has never run")
 
-            # If import with tags
-            complex_query_tag = None
-            if (self.misp_import_tags is not None) or (
-                self.misp_import_tags_not is not None
-            ):
-                or_parameters = []
-                not_parameters = []
-
-                if self.misp_import_tags:
-                    for tag in self.misp_import_tags.split(","):
-                        or_parameters.append(tag.strip())
-                if self.misp_import_tags_not:
-                    for ntag in self.misp_import_tags_not.split(","):
-                        not_parameters.append(ntag.strip())
-
-                complex_query_tag = self.misp.build_complex_query(
-                    or_parameters=or_parameters if len(or_parameters) > 0 else None,
-                    not_parameters=not_parameters if len(not_parameters) > 0 else None,
+            if current_run is not None:
+                # Resume the interrupted run with the same query from its last checkpoint
+                timestamp = current_run["timestamp"]
+                self.helper.log_info(
+                    "Resuming interrupted run from offset "
+                    + str(current_run["offset"])
+                    + " ("
+                    + str(current_run["number_events"])
+                    + " events already processed)"
                 )
+            else:
+                # If import with tags
+                complex_query_tag = None
+                if (self.misp_import_tags is not None) or (
+                    self.misp_import_tags_not is not None
+                ):
+                    or_parameters = []
+                    not_parameters = []
+
+                    if self.misp_import_tags:
+                        for tag in self.misp_import_tags.split(","):
+                            or_parameters.append(tag.strip())
+                    if self.misp_import_tags_not:
+                        for ntag in self.misp_import_tags_not.split(","):
+                            not_parameters.append(ntag.strip())
+
+                    complex_query_tag = self.misp.build_complex_query(
+                        or_parameters=or_parameters if len(or_parameters) > 0 else None,
+                        not_parameters=not_parameters
+                        if len(not_parameters) > 0
+                        else None,
+                    )
 
-            # If import from a specific date
-            import_from_date = None
-            if self.misp_import_from_date is not None:
-                import_from_date = datetime.fromisoformat(self.misp_import_from_date)
-
-            # Prepare the query
-            kwargs = dict()
-            if complex_query_tag is not None:
-                kwargs["tags"] = complex_query_tag
-            if latest_event_timestamp is not None:
-                next_event_timestamp = latest_event_timestamp + 1
-                kwargs[self.misp_datetime_attribute] = next_event_timestamp
-            elif import_from_date is not None:
-                kwargs["date_from"] = import_from_date.strftime("%Y-%m-%d")
-
-            # With attachments
-            if self.import_with_attachments:
-                kwargs["with_attachments"] = self.import_with_attachments
+                # If import from a specific date
+                import_from_date = None
+                if self.misp_import_from_date is not None:
+                    import_from_date = datetime.fromisoformat(
+                        self.misp_import_from_date
+                    )
 
-            # Query with pagination of 100
-            current_page = 1
-            number_events = 0
-            while True:
-                kwargs["limit"] = 50
-                kwargs["page"] = current_page
-                self.helper.log_info(
-                    "Fetching MISP events with args: " + json.dumps(kwargs)
-                )
-                kwargs = json.loads(json.dumps(kwargs))
-                events = []
-                try:
-                    events = self.misp.search("events", **kwargs)
-                except Exception as e:
-                    self.helper.log_error(str(e))
-                    try:
-                        events = self.misp.search("events", **kwargs)
-                    except Exception as e:
-                        self.helper.log_error(str(e))
-
-                self.helper.log_info("MISP returned " + str(len(events)) + " events.")
-                number_events = number_events + len(events)
-                # Break if no more result
-                if len(events) == 0:
-                    break
-
-                event_timestamp = self.process_events(work_id, events)
-                if event_timestamp is not None:
-                    if latest_event_timestamp is None or (
-                        latest_event_timestamp is not None
-                        and event_timestamp > latest_event_timestamp
-                    ):
-                        latest_event_timestamp = event_timestamp
-                current_page += 1
+                # Prepare the query
+                kwargs = dict()
+                if complex_query_tag is not None:
+                    kwargs["tags"] = complex_query_tag
+                if latest_event_timestamp is not None:
+                    next_event_timestamp = latest_event_timestamp + 1
+                    kwargs[self.misp_datetime_attribute] = next_event_timestamp
+                elif import_from_date is not None:
+                    kwargs["date_from"] = import_from_date.strftime("%Y-%m-%d")
+
+                # With attachments
+                if self.import_with_attachments:
+                    kwargs["with_attachments"] = self.import_with_attachments
+
+                current_run = {
+                    "timestamp": timestamp,
+                    "query": kwargs,
+                    "offset": 0,
+                    "page_size": self.page_sizer.initial_size,
+                    "number_events": 0,
+                    "latest_event_timestamp": None,
+                }
+
+            # Query with adaptive pagination, checkpointed after each page
+            for cache in [self.markings_cache, self.tags_cache, self.elements_cache]:
+                cache.reset_statistics()
+            try:
+                if self.pipeline_workers > 1:
+                    cache_statistics = self.process_pages_pipelined(
+                        work_id, current_state, current_run
+                    )
+                else:
+                    self.process_pages(work_id, current_state, current_run)
+                    cache_statistics = self.cache_statistics()
+            except Exception as e:
+                self.fail_run(work_id, current_state, current_run, e)
+                time.sleep(self.get_interval())
+                continue
+            number_events = current_run["number_events"]
+            event_timestamp = current_run["latest_event_timestamp"]
+            if event_timestamp is not None:
+                if latest_event_timestamp is None or (
+                    latest_event_timestamp is not None
+                    and event_timestamp > latest_event_timestamp
+                ):
+                    latest_event_timestamp = event_timestamp
+            self.helper.log_info(
+                "Resolution cache statistics: " + json.dumps(cache_statistics)
+            )
             message = (
                 "Connector successfully run ("
                 + str(number_events)
@@ -314,13 +591,371 @@ class Misp:
             self.helper.api.work.to_processed(work_id, message)
             time.sleep(self.get_interval())
 
+    def fail_run(self, work_id, state, current_run, error):
+        # The run is kept in the state with a smaller page size, the next run
+        # resumes from its last checkpoint instead of moving past the failed page
+        current_run["page_size"] = self.page_sizer.smaller_size(
+            current_run["page_size"]
+        )
+        new_state = dict(state) if state is not None else {}
+        new_state["current_run"] = current_run
+        self.helper.set_state(new_state)
+        message = (
+            "Connector run interrupted at offset "
+            + str(current_run["offset"])
+            + ", resuming with pages of "
+            + str(current_run["page_size"])
+            + " events: "
+            + str(error)
+        )
+        self.helper.log_error(message)
+        self.helper.api.work.to_processed(work_id, message, True)
+
+    def fetch_events(self, kwargs, page, limit):
+        kwargs["limit"] = limit
+        kwargs["page"] = page
+        self.helper.log_info("Fetching MISP events with args: " + json.dumps(kwargs))
+        if self.stream_event_attributes > 0:
+            # Attributes of the events are fetched afterwards, or streamed for huge events
+            kwargs["metadata"] = True
+        kwargs = json.loads(json.dumps(kwargs))
+        start = time.time()
+        events = self.search_with_retry("events", **kwargs)
+
+        page_info = {
+            "page": page,
+            "limit": limit,
+            "events": len(events),
+            "attributes": count_attributes(events),
+            "duration": time.time() - start,
+        }
+        self.helper.log_info(
+            "MISP returned "
+            + str(page_info["events"])
+            + " events ("
+            + str(page_info["attributes"])
+            + " attributes) in "
+            + "{:.2f}".format(page_info["duration"])
+            + "s."
+        )
+        if self.stream_event_attributes > 0 and len(events) > 0:
+            events = self.fetch_full_events(events)
+        return events, page_info
+
+    def search_with_retry(self, controller, **kwargs):
+        # The error of the retry is raised, so that the page is not checkpointed
+        # and the interrupted run resumes from it
+        try:
+            return self.misp.search(controller, **kwargs)
+        except Exception as e:
+            self.helper.log_error(str(e))
+            return self.misp.search(controller, **kwargs)
+
+    def is_huge_event(self, event):
+        return (
+            self.stream_event_attributes > 0
+            and int(event["Event"].get("attribute_count") or 0)
+            > self.stream_event_attributes
+        )
+
+    def fetch_full_events(self, events):
+        # Replace the metadata of the events which are not streamed by the full events
+        event_ids = [
+            event["Event"]["id"] for event in events if not self.is_huge_event(event)
+        ]
+        full_events = {}
+        if len(event_ids) > 0:
+            kwargs = {"eventid": event_ids}
+            if self.import_with_attachments:
+                kwargs["with_attachments"] = self.import_with_attachments
+            for event in self.search_with_retry("events", **kwargs):
+                full_events[event["Event"]["id"]] = event
+
+        result = []
+        for event in events:
+            if self.is_huge_event(event):
+                result.append(event)
+            elif event["Event"]["id"] in full_events:
+                result.append(full_events[event["Event"]["id"]])
+            else:
+                self.helper.log_error(
+                    "Unable to fetch the attributes of event " + event["Event"]["uuid"]
+                )
+        return result
+
+    def fetch_event_slices(self, event):
+        # Attributes and objects of a huge event, by slices of stream_bundle_size
+        kwargs = {"eventid": event["Event"]["id"], "limit": self.stream_bundle_size}
+        if self.import_with_attachments:
+            kwargs["with_attachments"] = self.import_with_attachments
+        page = 1
+        while True:
+            response = self.search_with_retry(
+                "attributes", page=page, include_sightings=True, **kwargs
+            )
+            attributes = response.get("Attribute", [])
+            # Attributes of objects are fetched with their object
+            yield [
+                attribute
+                for attribute in attributes
+                if attribute.get("object_id", "0") == "0"
+            ], []
+            if len(attributes) < self.stream_bundle_size:
+                break
+            page += 1
+        page = 1
+        while True:
+            objects = self.search_with_retry("objects", page=page, **kwargs)
+            yield [], [misp_object["Object"] for misp_object in objects]
+            if len(objects) < self.stream_bundle_size:
+                break
+            page += 1
+
+    def stream_event(self, work_id, event):
+        self.helper.log_info(
+            "Streaming event "
+            + event["Event"]["uuid"]
+            + " ("
+            + str(event["Event"].get("attribute_count"))
+            + " attributes)"
+        )
+        event_timestamp = int(event["Event"]["timestamp"])
+        if not self.is_event_imported(event):
+            return event_timestamp
+
+        # Bundles of at most stream_bundle_size objects (plus the objects of one attribute
+        # or MISP object) sharing the same report id, the notes are sent with the last one
+        context = self.prepare_event(event)
+        batch = {"indicators": [], "observables": [], "objects": [], "size": 0}
+        bundle_count = 0
+        for attributes, objects in self.fetch_event_slices(event):
+            for attribute in attributes:
+                indicators = self.process_event_attributes(event, context, [attribute])
+                batch["indicators"] += indicators
+                batch["size"] += count_bundle_objects(indicators, [])
+                if batch["size"] >= self.stream_bundle_size:
+                    self.send_event_batch(work_id, event, context, batch, [])
+                    bundle_count += 1
+            for misp_object in objects:
+                indicators, observables = self.process_event_objects(
+                    event, context, [misp_object]
+                )
+                batch["indicators"] += indicators
+                batch["observables"] += observables
+                batch["objects"].append(misp_object)
+                batch["size"] += count_bundle_objects(indicators, observables)
+                if batch["size"] >= self.stream_bundle_size:
+                    self.send_event_batch(work_id, event, context, batch, [])
+                    bundle_count += 1
+        self.send_event_batch(
+            work_id, event, context, batch, event["Event"].get("EventReport", [])
+        )
+        if len(context["pending_references"]) > 0:
+            self.helper.log_info(
+                "Event "
+                + event["Event"]["uuid"]
+                + ": "
+                + str(len(context["pending_references"]))
+                + " object references to unknown objects ignored"
+            )
+        self.helper.log_info(
+            "Event "
+            + event["Event"]["uuid"]
+            + " streamed in "
+            + str(bundle_count + 1)
+            + " bundles"
+        )
+        return event_timestamp
+
+    def send_event_batch(self, work_id, event, context, batch, notes):
+        bundle = self.build_event_bundle(
+            event,
+            context,
+            batch["indicators"],
+            batch["observables"],
+            batch["objects"],
+            notes,
+        )
+        self.send_event_bundle(work_id, bundle)
+        batch.update({"indicators": [], "observables": [], "objects": [], "size": 0})
+        context["external_references"] = [context["external_reference"]]
+        context["files"] = []
+
+    def complete_page(self, state, current_run, page_info, latest_event_timestamp):
+        # Checkpoint the run once all the events of a page have been sent
+        current_run["offset"] = (page_info["page"] - 1) * page_info[
+            "limit"
+        ] + page_info["events"]
+        current_run["number_events"] += page_info["events"]
+        current_run["page_size"] = self.page_sizer.next_size(page_info)
+        if latest_event_timestamp is not None and (
+            current_run["latest_event_timestamp"] is None
+            or latest_event_timestamp > current_run["latest_event_timestamp"]
+        ):
+            current_run["latest_event_timestamp"] = latest_event_timestamp
+        new_state = dict(state) if state is not None else {}
+        new_state["current_run"] = current_run
+        self.helper.set_state(new_state)
+        self.helper.log_info(
+            "Page "
+            + str(page_info["page"])
+            + " of "
+            + str(page_info["limit"])
+            + " events fetched in "
+            + "{:.2f}".format(page_info["duration"])
+            + "s and processed in "
+            + "{:.2f}".format(page_info["processing_duration"])
+            + "s, checkpoint at offset "
+            + str(current_run["offset"])
+            + ", next page size "
+            + str(current_run["page_size"])
+        )
+
+    def process_pages(self, work_id, state, current_run):
+        while True:
+            page, limit = self.page_sizer.page(
+                current_run["offset"], current_run["page_size"]
+            )
+            events, page_info = self.fetch_events(
+                dict(current_run["query"]), page, limit
+            )
+            # Break if no more result
+            if len(events) == 0:
+                break
+
+            start = time.time()
+            event_timestamp = self.process_events(work_id, events)
+            page_info["processing_duration"] = time.time() - start
+            self.complete_page(state, current_run, page_info, event_timestamp)
+            # A partial page is the last one
+            if len(events) < limit:
+                break
+
+    def process_pages_pipelined(self, work_id, state, current_run):
+        # The next pages are fetched by a prefetcher thread and the events are converted
+        # by a pool of worker processes, while the bundles are sent in the order of the events
+        pages = queue.Queue(maxsize=self.pipeline_prefetch_pages)
+        stop = threading.Event()
+
+        def put(item):
+            while not stop.is_set():
+                try:
+                    pages.put(item, timeout=1)
+                    return
+                except queue.Full:
+                    continue
+
+        def prefetch():
+            # Pages are followed by None at the end of the results, or by the
+            # exception which stopped the prefetcher, raised again by the consumer
+            try:
+                offset = current_run["offset"]
+                page_size = current_run["page_size"]
+                while not stop.is_set():
+                    page, limit = self.page_sizer.page(offset, page_size)
+                    events, page_info = self.fetch_events(
+                        dict(current_run["query"]), page, limit
+                    )
+                    put((events, page_info))
+                    # Stop if no more result
+                    if len(events) < limit:
+                        break
+                    offset = (page - 1) * limit + len(events)
+                    page_size = self.page_sizer.next_size(page_info)
+                put(None)
+            except Exception as e:
+                put(e)
+
+        worker_statistics = {}
+        pending = deque()
+        page_timestamp = None
+        # Fork the workers before starting the prefetcher thread
+        context = multiprocessing.get_context("fork")
+        with context.Pool(
+            self.pipeline_workers, initializer=_init_pipeline_worker, initargs=(self,)
+        ) as pool:
+            prefetcher = threading.Thread(target=prefetch, daemon=True)
+            prefetcher.start()
+            try:
+                while True:
+                    item = pages.get()
+                    if isinstance(item, Exception):
+                        raise item
+                    last_page = item is None
+                    events, page_info = ([], None) if last_page else item
+                    if page_info is not None:
+                        page_info["start"] = time.time()
+                    for event in events:
+                        # Huge events are streamed by the sender, in order
+                        if self.is_huge_event(event):
+                            pending.append(("stream", event))
+                        else:
+                            pending.append(
+                                (
+                                    "event",
+                                    pool.apply_async(_process_event_worker, (event,)),
+                                )
+                            )
+                    if len(events) > 0:
+                        pending.append(("page", page_info))
+                    # Send the events of the previous pages while this one is converted,
+                    # a page is checkpointed once all its events have been sent
+                    while len(pending) > (0 if last_page else len(events) + 1):
+                        kind, item = pending.popleft()
+                        if kind == "page":
+                            item["processing_duration"] = time.time() - item["start"]
+                            self.complete_page(state, current_run, item, page_timestamp)
+                            page_timestamp = None
+                            continue
+                        if kind == "stream":
+                            event_timestamp = self.stream_event(work_id, item)
+                        else:
+                            result, pid, statistics = item.get()
+                            event_timestamp, bundle = result
+                            worker_statistics[pid] = statistics
+                            if bundle is not None:
+                                self.send_event_bundle(work_id, bundle)
+                        if page_timestamp is None or event_timestamp > page_timestamp:
+                            page_timestamp = event_timestamp
+                    if last_page:
+                        break
+            finally:
+                stop.set()
+                prefetcher.join()
+
+        return merge_cache_statistics(worker_statistics.values())
+
     def process_events(self, work_id, events) -> int:
+        latest_event_timestamp = None
+        for event in events:
+            if self.is_huge_event(event):
+                event_timestamp, bundle = self.stream_event(work_id, event), None
+            else:
+                event_timestamp, bundle = self.process_event(event)
+            # need to check if timestamp is more recent than the previous event since
+            # events are not ordered by timestamp in API response
+            if (
+                latest_event_timestamp is None
+                or event_timestamp > latest_event_timestamp
+            ):
+                latest_event_timestamp = event_timestamp
+            if bundle is not None:
+                self.send_event_bundle(work_id, bundle)
+
+        return latest_event_timestamp
+
+    def send_event_bundle(self, work_id, bundle):
+        self.helper.log_info("Sending event STIX2 bundle")
+        self.helper.send_stix2_bundle(
+            bundle, work_id=work_id, update=self.update_existing_data
+        )
+
+    def is_event_imported(self, event):
         # Prepare filters
         import_creator_orgs = None
         import_owner_orgs = None
         import_distribution_levels = None
         import_threat_levels = None
-        latest_event_timestamp = None
         if self.import_creator_orgs is not None:
             import_creator_orgs = self.import_creator_orgs.split(",")
         if self.import_owner_orgs is not None:
@@ -330,386 +965,440 @@ class Misp:
         if self.import_threat_levels is not None:
             import_threat_levels = self.import_threat_levels.split(",")
 
-        for event in events:
-            self.helper.log_info("Processing event " + event["Event"]["uuid"])
-            event_timestamp = int(event["Event"]["timestamp"])
-            # need to check if timestamp is more recent than the previous event since
-            # events are not ordered by timestamp in API response
-            if (
-                latest_event_timestamp is None
-                or event_timestamp > latest_event_timestamp
-            ):
-                latest_event_timestamp = event_timestamp
-            # Check against filter
-            if (
-                import_creator_orgs is not None
-                and not import_creator_orgs
-                and event["Event"]["Orgc"]["name"] not in import_creator_orgs
-            ):
-                self.helper.log_info(
-                    "Event creator organization "
-                    + event["Event"]["Orgc"]["name"]
-                    + " not in import_creator_orgs, do not import"
-                )
-                continue
-            if (
-                import_owner_orgs is not None
-                and not import_owner_orgs
-                and event["Event"]["Org"]["name"] not in import_owner_orgs
-            ):
-                self.helper.log_info(
-                    "Event owner organization "
-                    + event["Event"]["Org"]["name"]
-                    + " not in import_owner_orgs, do not import"
-                )
-                continue
-            if (
-                import_distribution_levels is not None
-                and event["Event"]["distribution"] not in import_distribution_levels
-            ):
-                self.helper.log_info(
-                    "Event distribution level "
-                    + event["Event"]["distribution"]
-                    + " not in import_distribution_levels, do not import"
-                )
-                continue
-            if (
-                import_threat_levels is not None
-                and event["Event"]["threat_level_id"] not in import_threat_levels
-            ):
-                self.helper.log_info(
-                    "Event threat level "
-                    + event["Event"]["threat_level_id"]
-                    + " not in import_threat_levels, do not import"
-                )
-                continue
-            if (
-                self.import_only_published is not None
-                and self.import_only_published
-                and not event["Event"]["published"]
-            ):
-                self.helper.log_info(
-                    "Event is not published and import_only_published is set, do not import"
-                )
-                continue
+        # Check against filter
+        if (
+            import_creator_orgs is not None
+            and not import_creator_orgs
+            and event["Event"]["Orgc"]["name"] not in import_creator_orgs
+        ):
+            self.helper.log_info(
+                "Event creator organization "
+                + event["Event"]["Orgc"]["name"]
+                + " not in import_creator_orgs, do not import"
+            )
+            return False
+        if (
+            import_owner_orgs is not None
+            and not import_owner_orgs
+            and event["Event"]["Org"]["name"] not in import_owner_orgs
+        ):
+            self.helper.log_info(
+                "Event owner organization "
+                + event["Event"]["Org"]["name"]
+                + " not in import_owner_orgs, do not import"
+            )
+            return False
+        if (
+            import_distribution_levels is not None
+            and event["Event"]["distribution"] not in import_distribution_levels
+        ):
+            self.helper.log_info(
+                "Event distribution level "
+                + event["Event"]["distribution"]
+                + " not in import_distribution_levels, do not import"
+            )
+            return False
+        if (
+            import_threat_levels is not None
+            and event["Event"]["threat_level_id"] not in import_threat_levels
+        ):
+            self.helper.log_info(
+                "Event threat level "
+                + event["Event"]["threat_level_id"]
+                + " not in import_threat_levels, do not import"
+            )
+            return False
+        if (
+            self.import_only_published is not None
+            and self.import_only_published
+            and not event["Event"]["published"]
+        ):
+            self.helper.log_info(
+                "Event is not published and import_only_published is set, do not import"
+            )
+            return False
 
-            ### Default variables
-            added_markings = []
-            added_entities = []
-            added_object_refs = []
-            added_sightings = []
-            added_files = []
+        return True
 
-            ### Pre-process
-            # Author
-            author = Identity(
-                id=OpenCTIStix2Utils.generate_random_stix_id("identity"),
-                name=event["Event"]["Orgc"]["name"],
-                identity_class="organization",
-            )
-            # Markings
-            if "Tag" in event["Event"]:
-                event_markings = self.resolve_markings(event["Event"]["Tag"])
-            else:
-                event_markings = [TLP_WHITE]
-            # Elements
-            event_elements = self.prepare_elements(
-                event["Event"]["Galaxy"],
-                event["Event"].get("Tag", []),
+    # Convert an event, return its timestamp and its serialized bundle (None if the event is filtered out)
+    def process_event(self, event):
+        self.helper.log_info("Processing event " + event["Event"]["uuid"])
+        event_timestamp = int(event["Event"]["timestamp"])
+        if not self.is_event_imported(event):
+            return event_timestamp, None
+
+        context = self.prepare_event(event)
+        indicators = self.process_event_attributes(
+            event, context, event["Event"]["Attribute"]
+        )
+        object_indicators, objects_observables = self.process_event_objects(
+            event, context, event["Event"]["Object"]
+        )
+        bundle = self.build_event_bundle(
+            event,
+            context,
+            indicators + object_indicators,
+            objects_observables,
+            event["Event"]["Object"],
+            event["Event"]["EventReport"],
+        )
+        return event_timestamp, bundle
+
+    def prepare_event(self, event):
+        ### Pre-process
+        # Author
+        author = Identity(
+            id=generate_organization_id(event["Event"]["Orgc"]["name"]),
+            name=event["Event"]["Orgc"]["name"],
+            identity_class="organization",
+        )
+        # Markings
+        if "Tag" in event["Event"]:
+            event_markings = self.resolve_markings(event["Event"]["Tag"])
+        else:
+            event_markings = [TLP_WHITE]
+        # Elements
+        event_elements = self.prepare_elements(
+            event["Event"].get("Galaxy", []),
+            event["Event"].get("Tag", []),
+            author,
+            event_markings,
+        )
+        # Tags
+        event_tags = []
+        if "Tag" in event["Event"]:
+            event_tags = self.resolve_tags(event["Event"]["Tag"])
+        # ExternalReference
+        if self.misp_reference_url is not None and len(self.misp_reference_url) > 0:
+            url = self.misp_reference_url + "/events/view/" + event["Event"]["uuid"]
+        else:
+            url = self.misp_url + "/events/view/" + event["Event"]["uuid"]
+        event_external_reference = ExternalReference(
+            source_name=self.helper.connect_name,
+            description=event["Event"]["info"],
+            external_id=event["Event"]["uuid"],
+            url=url,
+        )
+
+        return {
+            "author": author,
+            "markings": event_markings,
+            "elements": event_elements,
+            "tags": event_tags,
+            "external_reference": event_external_reference,
+            "external_references": [event_external_reference],
+            "files": [],
+            # MISP uuid -> STIX id of the objects of the event, and the object
+            # references not linked yet, kept across the bundles of a streamed event
+            "stix_ids": {},
+            "pending_references": [],
+        }
+
+    def process_event_attributes(self, event, context, attributes):
+        author = context["author"]
+        event_markings = context["markings"]
+        event_elements = context["elements"]
+        event_tags = context["tags"]
+        indicators = []
+        for attribute in attributes:
+            indicator = self.process_attribute(
                 author,
+                event_elements,
                 event_markings,
+                event_tags,
+                None,
+                [],
+                attribute,
+                event["Event"]["threat_level_id"],
             )
-            # Tags
-            event_tags = []
-            if "Tag" in event["Event"]:
-                event_tags = self.resolve_tags(event["Event"]["Tag"])
-            # ExternalReference
-            if self.misp_reference_url is not None and len(self.misp_reference_url) > 0:
-                url = self.misp_reference_url + "/events/view/" + event["Event"]["uuid"]
-            else:
-                url = self.misp_url + "/events/view/" + event["Event"]["uuid"]
-            event_external_reference = ExternalReference(
-                source_name=self.helper.connect_name,
-                description=event["Event"]["info"],
-                external_id=event["Event"]["uuid"],
-                url=url,
-            )
+            if attribute["type"] == "link":
+                context["external_references"].append(
+                    ExternalReference(
+                        source_name=attribute["category"],
+                        external_id=attribute["uuid"],
+                        url=attribute["value"],
+                    )
+                )
+            if indicator is not None:
+                indicators.append(indicator)
+
+            pdf_file = self._get_pdf_file(attribute)
+            if pdf_file is not None:
+                context["files"].append(pdf_file)
+
+        return indicators
+
+    def process_event_objects(self, event, context, objects):
+        author = context["author"]
+        event_markings = context["markings"]
+        event_elements = context["elements"]
+        event_tags = context["tags"]
+        indicators = []
+        objects_observables = []
+        event_threat_level = event["Event"]["threat_level_id"]
+        for object in objects:
+            attribute_external_references = []
+            for attribute in object["Attribute"]:
+                if attribute["type"] == "link":
+                    attribute_external_references.append(
+                        ExternalReference(
+                            source_name=attribute["category"],
+                            external_id=attribute["uuid"],
+                            url=attribute["value"],
+                        )
+                    )
+
+                pdf_file = self._get_pdf_file(attribute)
+                if pdf_file is not None:
+                    context["files"].append(pdf_file)
+
+            object_observable = None
+            if self.misp_create_object_observables is not None:
+                unique_key = ""
+                if len(object["Attribute"]) > 0:
+                    unique_key = (
+                        " ("
+                        + object["Attribute"][0]["type"]
+                        + "="
+                        + object["Attribute"][0]["value"]
+                        + ")"
+                    )
 
-            ### Get indicators
-            event_external_references = [event_external_reference]
-            indicators = []
-            # Get attributes of event
-            for attribute in event["Event"]["Attribute"]:
+                object_observable = SimpleObservable(
+                    id=OpenCTIStix2Utils.generate_random_stix_id(
+                        "x-opencti-simple-observable"
+                    ),
+                    key="X-OpenCTI-Text.value",
+                    value=object["name"] + unique_key,
+                    description=object["description"],
+                    x_opencti_score=self.threat_level_to_score(event_threat_level),
+                    labels=event_tags,
+                    created_by_ref=author,
+                    object_marking_refs=event_markings,
+                    external_references=attribute_external_references,
+                )
+                objects_observables.append(object_observable)
+            object_attributes = []
+            for attribute in object["Attribute"]:
                 indicator = self.process_attribute(
                     author,
                     event_elements,
                     event_markings,
                     event_tags,
-                    None,
-                    [],
+                    object_observable,
+                    attribute_external_references,
                     attribute,
                     event["Event"]["threat_level_id"],
                 )
-                if attribute["type"] == "link":
-                    event_external_references.append(
-                        ExternalReference(
-                            source_name=attribute["category"],
-                            external_id=attribute["uuid"],
-                            url=attribute["value"],
-                        )
-                    )
                 if indicator is not None:
                     indicators.append(indicator)
+                    if (
+                        indicator["indicator"] is not None
+                        and object["meta-category"] == "file"
+                        and indicator["indicator"].x_opencti_main_observable_type
+                        in FILETYPES
+                    ):
+                        object_attributes.append(indicator)
+            # TODO Extend observable
 
-                pdf_file = self._get_pdf_file(attribute)
-                if pdf_file is not None:
-                    added_files.append(pdf_file)
-
-            # Get attributes of objects
-            indicators_relationships = []
-            objects_relationships = []
-            objects_observables = []
-            event_threat_level = event["Event"]["threat_level_id"]
-            for object in event["Event"]["Object"]:
-                attribute_external_references = []
-                for attribute in object["Attribute"]:
-                    if attribute["type"] == "link":
-                        attribute_external_references.append(
-                            ExternalReference(
-                                source_name=attribute["category"],
-                                external_id=attribute["uuid"],
-                                url=attribute["value"],
-                            )
-                        )
+        return indicators, objects_observables
 
-                    pdf_file = self._get_pdf_file(attribute)
-                    if pdf_file is not None:
-                        added_files.append(pdf_file)
-
-                object_observable = None
-                if self.misp_create_object_observables is not None:
-                    unique_key = ""
-                    if len(object["Attribute"]) > 0:
-                        unique_key = (
-                            " ("
-                            + object["Attribute"][0]["type"]
-                            + "="
-                            + object["Attribute"][0]["value"]
-                            + ")"
+    def build_event_bundle(
+        self, event, context, indicators, objects_observables, objects, notes
+    ):
+        author = context["author"]
+        event_markings = context["markings"]
+        event_elements = context["elements"]
+        event_tags = context["tags"]
+
+        added_markings = set()
+        added_entities = set()
+        added_object_refs = set()
+        added_sightings = set()
+        indicators_relationships = []
+        objects_relationships = []
+
+        bundle_objects = [author]
+        object_refs = []
+        # Add event markings
+        for event_marking in event_markings:
+            if event_marking["id"] not in added_markings:
+                bundle_objects.append(event_marking)
+                added_markings.add(event_marking["id"])
+        # Add event elements
+        all_event_elements = (
+            event_elements["intrusion_sets"]
+            + event_elements["malwares"]
+            + event_elements["tools"]
+            + event_elements["attack_patterns"]
+            + event_elements["sectors"]
+            + event_elements["countries"]
+        )
+        for event_element in all_event_elements:
+            if event_element["name"] not in added_object_refs:
+                object_refs.append(event_element)
+                added_object_refs.add(event_element["name"])
+            if event_element["name"] not in added_entities:
+                bundle_objects.append(event_element)
+                added_entities.add(event_element["name"])
+        # Add indicators
+        for indicator in indicators:
+            if indicator["indicator"] is not None:
+                if indicator["indicator"]["id"] not in added_object_refs:
+                    object_refs.append(indicator["indicator"])
+                    added_object_refs.add(indicator["indicator"]["id"])
+                if indicator["indicator"]["id"] not in added_entities:
+                    bundle_objects.append(indicator["indicator"])
+                    added_entities.add(indicator["indicator"]["id"])
+            if indicator["observable"] is not None:
+                if indicator["observable"]["id"] not in added_object_refs:
+                    object_refs.append(indicator["observable"])
+                    added_object_refs.add(indicator["observable"]["id"])
+                if indicator["observable"]["id"] not in added_entities:
+                    bundle_objects.append(indicator["observable"])
+                    added_entities.add(indicator["observable"]["id"])
+
+            # Add attribute markings
+            for attribute_marking in indicator["markings"]:
+                if attribute_marking["id"] not in added_markings:
+                    bundle_objects.append(attribute_marking)
+                    added_markings.add(attribute_marking["id"])
+            # Add attribute sightings identities
+            for attribute_identity in indicator["identities"]:
+                if attribute_identity["id"] not in added_entities:
+                    bundle_objects.append(attribute_identity)
+                    added_entities.add(attribute_identity["id"])
+            # Add attribute sightings
+            for attribute_sighting in indicator["sightings"]:
+                if attribute_sighting["id"] not in added_sightings:
+                    bundle_objects.append(attribute_sighting)
+                    added_sightings.add(attribute_sighting["id"])
+            # Add attribute elements
+            all_attribute_elements = (
+                indicator["attribute_elements"]["intrusion_sets"]
+                + indicator["attribute_elements"]["malwares"]
+                + indicator["attribute_elements"]["tools"]
+                + indicator["attribute_elements"]["attack_patterns"]
+                + indicator["attribute_elements"]["sectors"]
+                + indicator["attribute_elements"]["countries"]
+            )
+            for attribute_element in all_attribute_elements:
+                if attribute_element["name"] not in added_object_refs:
+                    object_refs.append(attribute_element)
+                    added_object_refs.add(attribute_element["name"])
+                if attribute_element["name"] not in added_entities:
+                    bundle_objects.append(attribute_element)
+                    added_entities.add(attribute_element["name"])
+            # Add attribute relationships
+            for relationship in indicator["relationships"]:
+                indicators_relationships.append(relationship)
+
+        # We want to make sure these are added as lasts, so we're sure all the related objects are created
+        for indicator_relationship in indicators_relationships:
+            objects_relationships.append(indicator_relationship)
+        # Add MISP objects_observables
+        for object_observable in objects_observables:
+            object_refs.append(object_observable)
+            bundle_objects.append(object_observable)
+
+        # Link all objects with each other, now so we can find the correct entity type prefix in bundle_objects
+        bundle_index = {}
+        self.index_by_uuid(bundle_objects, bundle_index)
+        # The ends of a reference may be in a previous bundle of a streamed event, or in
+        # a next one, the reference is then linked once both ends have been built
+        stix_ids = context["stix_ids"]
+        for object_uuid, stix_object in bundle_index.items():
+            stix_ids.setdefault(object_uuid, stix_object["id"])
+        references = context["pending_references"]
+        context["pending_references"] = []
+        for object in objects:
+            references.extend(object["ObjectReference"])
+        for ref in references:
+            ref_src = ref.get("source_uuid")
+            ref_target = ref.get("referenced_uuid")
+            if ref_src is not None and ref_target is not None:
+                src_id = stix_ids.get(ref_src)
+                target_id = stix_ids.get(ref_target)
+                if src_id is not None and target_id is not None:
+                    objects_relationships.append(
+                        Relationship(
+                            id="relationship--" + ref["uuid"],
+                            relationship_type="related-to",
+                            created_by_ref=author,
+                            description="Original Relationship: "
+                            + ref["relationship_type"]
+                            + "  \nComment: "
+                            + ref["comment"],
+                            source_ref=src_id,
+                            target_ref=target_id,
+                            allow_custom=True,
                         )
-
-                    object_observable = SimpleObservable(
-                        id=OpenCTIStix2Utils.generate_random_stix_id(
-                            "x-opencti-simple-observable"
-                        ),
-                        key="X-OpenCTI-Text.value",
-                        value=object["name"] + unique_key,
-                        description=object["description"],
-                        x_opencti_score=self.threat_level_to_score(event_threat_level),
-                        labels=event_tags,
-                        created_by_ref=author,
-                        object_marking_refs=event_markings,
-                        external_references=attribute_external_references,
                     )
-                    objects_observables.append(object_observable)
-                object_attributes = []
-                for attribute in object["Attribute"]:
-                    indicator = self.process_attribute(
-                        author,
-                        event_elements,
-                        event_markings,
-                        event_tags,
-                        object_observable,
-                        attribute_external_references,
-                        attribute,
-                        event["Event"]["threat_level_id"],
+                else:
+                    context["pending_references"].append(ref)
+        # Add object_relationships
+        for object_relationship in objects_relationships:
+            object_refs.append(object_relationship)
+            bundle_objects.append(object_relationship)
+        self.index_by_uuid(objects_relationships, bundle_index)
+
+        # Create the report if needed
+        # Report in STIX must have at least one object_refs
+        if self.misp_create_report and len(object_refs) > 0:
+            report = Report(
+                id="report--" + event["Event"]["uuid"],
+                name=event["Event"]["info"],
+                description=event["Event"]["info"],
+                published=datetime.utcfromtimestamp(
+                    int(
+                        datetime.strptime(
+                            str(event["Event"]["date"]), "%Y-%m-%d"
+                        ).timestamp()
                     )
-                    if indicator is not None:
-                        indicators.append(indicator)
-                        if (
-                            indicator["indicator"] is not None
-                            and object["meta-category"] == "file"
-                            and indicator["indicator"].x_opencti_main_observable_type
-                            in FILETYPES
-                        ):
-                            object_attributes.append(indicator)
-                # TODO Extend observable
-
-            ### Prepare the bundle
-            bundle_objects = [author]
-            object_refs = []
-            # Add event markings
-            for event_marking in event_markings:
-                if event_marking["id"] not in added_markings:
-                    bundle_objects.append(event_marking)
-                    added_markings.append(event_marking["id"])
-            # Add event elements
-            all_event_elements = (
-                event_elements["intrusion_sets"]
-                + event_elements["malwares"]
-                + event_elements["tools"]
-                + event_elements["attack_patterns"]
-                + event_elements["sectors"]
-                + event_elements["countries"]
+                ),
+                created=datetime.utcfromtimestamp(
+                    int(
+                        datetime.strptime(
+                            str(event["Event"]["date"]), "%Y-%m-%d"
+                        ).timestamp()
+                    )
+                ).strftime("%Y-%m-%dT%H:%M:%SZ"),
+                modified=datetime.utcfromtimestamp(
+                    int(event["Event"]["timestamp"])
+                ).strftime("%Y-%m-%dT%H:%M:%SZ"),
+                report_types=[self.misp_report_type],
+                created_by_ref=author,
+                object_marking_refs=event_markings,
+                labels=event_tags,
+                object_refs=object_refs,
+                external_references=context["external_references"],
+                custom_properties={
+                    "x_opencti_report_status": 2,
+                    "x_opencti_files": context["files"],
+                },
+                allow_custom=True,
             )
-            for event_element in all_event_elements:
-                if event_element["name"] not in added_object_refs:
-                    object_refs.append(event_element)
-                    added_object_refs.append(event_element["name"])
-                if event_element["name"] not in added_entities:
-                    bundle_objects.append(event_element)
-                    added_entities.append(event_element["name"])
-            # Add indicators
-            for indicator in indicators:
-                if indicator["indicator"] is not None:
-                    if indicator["indicator"]["id"] not in added_object_refs:
-                        object_refs.append(indicator["indicator"])
-                        added_object_refs.append(indicator["indicator"]["id"])
-                    if indicator["indicator"]["id"] not in added_entities:
-                        bundle_objects.append(indicator["indicator"])
-                        added_entities.append(indicator["indicator"]["id"])
-                if indicator["observable"] is not None:
-                    if indicator["observable"]["id"] not in added_object_refs:
-                        object_refs.append(indicator["observable"])
-                        added_object_refs.append(indicator["observable"]["id"])
-                    if indicator["observable"]["id"] not in added_entities:
-                        bundle_objects.append(indicator["observable"])
-                        added_entities.append(indicator["observable"]["id"])
-
-                # Add attribute markings
-                for attribute_marking in indicator["markings"]:
-                    if attribute_marking["id"] not in added_markings:
-                        bundle_objects.append(attribute_marking)
-                        added_markings.append(attribute_marking["id"])
-                # Add attribute sightings identities
-                for attribute_identity in indicator["identities"]:
-                    if attribute_identity["id"] not in added_entities:
-                        bundle_objects.append(attribute_identity)
-                        added_entities.append(attribute_identity["id"])
-                # Add attribute sightings
-                for attribute_sighting in indicator["sightings"]:
-                    if attribute_sighting["id"] not in added_sightings:
-                        bundle_objects.append(attribute_sighting)
-                        added_sightings.append(attribute_sighting["id"])
-                # Add attribute elements
-                all_attribute_elements = (
-                    indicator["attribute_elements"]["intrusion_sets"]
-                    + indicator["attribute_elements"]["malwares"]
-                    + indicator["attribute_elements"]["tools"]
-                    + indicator["attribute_elements"]["attack_patterns"]
-                    + indicator["attribute_elements"]["sectors"]
-                    + indicator["attribute_elements"]["countries"]
-                )
-                for attribute_element in all_attribute_elements:
-                    if attribute_element["name"] not in added_object_refs:
-                        object_refs.append(attribute_element)
-                        added_object_refs.append(attribute_element["name"])
-                    if attribute_element["name"] not in added_entities:
-                        bundle_objects.append(attribute_element)
-                        added_entities.append(attribute_element["name"])
-                # Add attribute relationships
-                for relationship in indicator["relationships"]:
-                    indicators_relationships.append(relationship)
-
-            # We want to make sure these are added as lasts, so we're sure all the related objects are created
-            for indicator_relationship in indicators_relationships:
-                objects_relationships.append(indicator_relationship)
-            # Add MISP objects_observables
-            for object_observable in objects_observables:
-                object_refs.append(object_observable)
-                bundle_objects.append(object_observable)
-
-            # Link all objects with each other, now so we can find the correct entity type prefix in bundle_objects
-            for object in event["Event"]["Object"]:
-                for ref in object["ObjectReference"]:
-                    ref_src = ref.get("source_uuid")
-                    ref_target = ref.get("referenced_uuid")
-                    if ref_src is not None and ref_target is not None:
-                        src_result = self.find_type_by_uuid(ref_src, bundle_objects)
-                        target_result = self.find_type_by_uuid(
-                            ref_target, bundle_objects
-                        )
-                        if src_result is not None and target_result is not None:
-                            objects_relationships.append(
-                                Relationship(
-                                    id="relationship--" + ref["uuid"],
-                                    relationship_type="related-to",
-                                    created_by_ref=author,
-                                    description="Original Relationship: "
-                                    + ref["relationship_type"]
-                                    + "  \nComment: "
-                                    + ref["comment"],
-                                    source_ref=src_result["entity"]["id"],
-                                    target_ref=target_result["entity"]["id"],
-                                    allow_custom=True,
-                                )
-                            )
-            # Add object_relationships
-            for object_relationship in objects_relationships:
-                object_refs.append(object_relationship)
-                bundle_objects.append(object_relationship)
-
-            # Create the report if needed
-            # Report in STIX must have at least one object_refs
-            if self.misp_create_report and len(object_refs) > 0:
-                report = Report(
-                    id="report--" + event["Event"]["uuid"],
-                    name=event["Event"]["info"],
-                    description=event["Event"]["info"],
-                    published=datetime.utcfromtimestamp(
-                        int(
-                            datetime.strptime(
-                                str(event["Event"]["date"]), "%Y-%m-%d"
-                            ).timestamp()
-                        )
+            bundle_objects.append(report)
+            self.index_by_uuid([report], bundle_index)
+            for note in notes:
+                note = Note(
+                    id="note--" + note["uuid"],
+                    confidence=self.helper.connect_confidence_level,
+                    created=datetime.utcfromtimestamp(int(note["timestamp"])).strftime(
+                        "%Y-%m-%dT%H:%M:%SZ"
+                    ),
+                    modified=datetime.utcfromtimestamp(int(note["timestamp"])).strftime(
+                        "%Y-%m-%dT%H:%M:%SZ"
                     ),
-                    created=datetime.utcfromtimestamp(
-                        int(
-                            datetime.strptime(
-                                str(event["Event"]["date"]), "%Y-%m-%d"
-                            ).timestamp()
-                        )
-                    ).strftime("%Y-%m-%dT%H:%M:%SZ"),
-                    modified=datetime.utcfromtimestamp(
-                        int(event["Event"]["timestamp"])
-                    ).strftime("%Y-%m-%dT%H:%M:%SZ"),
-                    report_types=[self.misp_report_type],
                     created_by_ref=author,
                     object_marking_refs=event_markings,
-                    labels=event_tags,
-                    object_refs=object_refs,
-                    external_references=event_external_references,
-                    custom_properties={
-                        "x_opencti_report_status": 2,
-                        "x_opencti_files": added_files,
-                    },
-                    allow_custom=True,
+                    abstract=note["name"],
+                    content=self.process_note(note["content"], bundle_index),
+                    object_refs=[report],
                 )
-                bundle_objects.append(report)
-                for note in event["Event"]["EventReport"]:
-                    note = Note(
-                        id="note--" + note["uuid"],
-                        confidence=self.helper.connect_confidence_level,
-                        created=datetime.utcfromtimestamp(
-                            int(note["timestamp"])
-                        ).strftime("%Y-%m-%dT%H:%M:%SZ"),
-                        modified=datetime.utcfromtimestamp(
-                            int(note["timestamp"])
-                        ).strftime("%Y-%m-%dT%H:%M:%SZ"),
-                        created_by_ref=author,
-                        object_marking_refs=event_markings,
-                        abstract=note["name"],
-                        content=self.process_note(note["content"], bundle_objects),
-                        object_refs=[report],
-                    )
-                    bundle_objects.append(note)
-            bundle = Bundle(objects=bundle_objects, allow_custom=True).serialize()
-            self.helper.log_info("Sending event STIX2 bundle")
-            self.helper.send_stix2_bundle(
-                bundle, work_id=work_id, update=self.update_existing_data
-            )
-
-        return latest_event_timestamp
+                bundle_objects.append(note)
+                self.index_by_uuid([note], bundle_index)
+        return Bundle(objects=bundle_objects, allow_custom=True).serialize()
 
     def _get_pdf_file(self, attribute):
         if not self.import_with_attachments:
@@ -1224,6 +1913,30 @@ class Misp:
             }
 
     def prepare_elements(self, galaxies, tags, author, markings):
+        # Elements are shared by the attributes and events with the same author, galaxies
+        # and tags, the author id is derived from the organization name
+        key = (
+            author["id"],
+            tuple(marking["id"] for marking in markings),
+            tuple(
+                (
+                    galaxy["namespace"],
+                    galaxy["name"],
+                    tuple(
+                        galaxy_entity.get("uuid") or galaxy_entity["value"]
+                        for galaxy_entity in galaxy["GalaxyCluster"]
+                    ),
+                )
+                for galaxy in galaxies
+            ),
+            tuple(tag["name"] for tag in tags),
+        )
+        elements = self.elements_cache.get(
+            key, lambda: self._prepare_elements(galaxies, tags, author, markings)
+        )
+        return {name: list(objects) for name, objects in elements.items()}
+
+    def _prepare_elements(self, galaxies, tags, author, markings):
         elements = {
             "intrusion_sets": [],
             "malwares": [],
@@ -1232,7 +1945,7 @@ class Misp:
             "sectors": [],
             "countries": [],
         }
-        added_names = []
+        added_names = set()
         # TODO: process sector & countries from galaxies?
         for galaxy in galaxies:
             # Get the linked intrusion sets
@@ -1272,7 +1985,7 @@ class Misp:
                                 custom_properties={"x_opencti_aliases": aliases},
                             )
                         )
-                        added_names.append(name)
+                        added_names.add(name)
             # Get the linked tools
             if galaxy["namespace"] == "mitre-attack" and galaxy["name"] == "Tool":
                 for galaxy_entity in galaxy["GalaxyCluster"]:
@@ -1296,7 +2009,7 @@ class Misp:
                                 custom_properties={"x_opencti_aliases": aliases},
                             )
                         )
-                        added_names.append(name)
+                        added_names.add(name)
             # Get the linked malwares
             if (
                 (galaxy["namespace"] == "mitre-attack" and galaxy["name"] == "Malware")
@@ -1327,7 +2040,7 @@ class Misp:
                                 object_marking_refs=markings,
                             )
                         )
-                        added_names.append(name)
+                        added_names.add(name)
             # Get the linked attack_patterns
             if (
                 galaxy["namespace"] == "mitre-attack"
@@ -1360,7 +2073,7 @@ class Misp:
                                 },
                             )
                         )
-                        added_names.append(name)
+                        added_names.add(name)
             # Get the linked sectors
             if galaxy["namespace"] == "misp" and galaxy["name"] == "Sector":
                 for galaxy_entity in galaxy["GalaxyCluster"]:
@@ -1378,7 +2091,7 @@ class Misp:
                                 object_marking_refs=markings,
                             )
                         )
-                        added_names.append(name)
+                        added_names.add(name)
             # Get the linked countries
             if galaxy["namespace"] == "misp" and galaxy["name"] == "Country":
                 for galaxy_entity in galaxy["GalaxyCluster"]:
@@ -1396,7 +2109,7 @@ class Misp:
                                 object_marking_refs=markings,
                             )
                         )
-                        added_names.append(name)
+                        added_names.add(name)
         for tag in tags:
             # Get the linked intrusion sets
             if (
@@ -1434,7 +2147,7 @@ class Misp:
                             object_marking_refs=markings,
                         )
                     )
-                    added_names.append(name)
+                    added_names.add(name)
             # Get the linked tools
             if tag["name"].startswith("misp-galaxy:mitre-tool") or tag[
                 "name"
@@ -1455,7 +2168,7 @@ class Misp:
                             object_marking_refs=markings,
                         )
                     )
-                    added_names.append(name)
+                    added_names.add(name)
             # Get the linked malwares
             if (
                 tag["name"].startswith("misp-galaxy:mitre-malware")
@@ -1482,7 +2195,7 @@ class Misp:
                             object_marking_refs=markings,
                         )
                     )
-                    added_names.append(name)
+                    added_names.add(name)
             # Get the linked attack_patterns
             if tag["name"].startswith("mitre-attack:attack-pattern"):
                 tag_value_split = tag["name"].split('="')
@@ -1503,7 +2216,7 @@ class Misp:
                             object_marking_refs=markings,
                         )
                     )
-                    added_names.append(name)
+                    added_names.add(name)
             # Get the linked sectors
             if tag["name"].startswith("misp-galaxy:sector"):
                 tag_value_split = tag["name"].split('="')
@@ -1519,7 +2232,7 @@ class Misp:
                             object_marking_refs=markings,
                         )
                     )
-                    added_names.append(name)
+                    added_names.add(name)
         return elements
 
     def resolve_type(self, type, value):
@@ -1613,6 +2326,14 @@ class Misp:
             return "ipv4-addr"
 
     def resolve_markings(self, tags, with_default=True):
+        key = (tuple(tag["name"] for tag in tags), with_default)
+        return list(
+            self.markings_cache.get(
+                key, lambda: self._resolve_markings(tags, with_default)
+            )
+        )
+
+    def _resolve_markings(self, tags, with_default):
         markings = []
         for tag in tags:
             if tag["name"] == "tlp:white":
@@ -1628,40 +2349,14 @@ class Misp:
         return markings
 
     def resolve_tags(self, tags):
+        key = tuple(tag["name"] for tag in tags)
+        return list(self.tags_cache.get(key, lambda: self._resolve_tags(tags)))
+
+    def _resolve_tags(self, tags):
         opencti_tags = []
         for tag in tags:
-            if (
-                tag["name"] != "tlp:white"
-                and tag["name"] != "tlp:green"
-                and tag["name"] != "tlp:amber"
-                and tag["name"] != "tlp:red"
-                and not tag["name"].startswith("misp-galaxy:threat-actor")
-                and not tag["name"].startswith("misp-galaxy:mitre-threat-actor")
-                and not tag["name"].startswith("misp-galaxy:microsoft-activity-group")
-                and not tag["name"].startswith(
-                    "misp-galaxy:mitre-enterprise-attack-threat-actor"
-                )
-                and not tag["name"].startswith(
-                    "misp-galaxy:mitre-mobile-attack-intrusion-set"
-                )
-                and not tag["name"].startswith("misp-galaxy:mitre-intrusion-set")
-                and not tag["name"].startswith(
-                    "misp-galaxy:mitre-enterprise-attack-intrusion-set"
-                )
-                and not tag["name"].startswith("misp-galaxy:mitre-malware")
-                and not tag["name"].startswith(
-                    "misp-galaxy:mitre-enterprise-attack-malware"
-                )
-                and not tag["name"].startswith("misp-galaxy:mitre-attack-pattern")
-                and not tag["name"].startswith(
-                    "misp-galaxy:mitre-enterprise-attack-attack-pattern"
-                )
-                and not tag["name"].startswith("misp-galaxy:mitre-tool")
-                and not tag["name"].startswith("misp-galaxy:tool")
-                and not tag["name"].startswith("misp-galaxy:ransomware")
-                and not tag["name"].startswith("misp-galaxy:malpedia")
-                and not tag["name"].startswith("misp-galaxy:sector")
-                and not tag["name"].startswith("misp-galaxy:country")
+            if tag["name"] not in MARKING_TAGS and not EXCLUDED_TAG_TRIE.match(
+                tag["name"]
             ):
                 tag_value = tag["name"]
                 if '="' in tag["name"]:
@@ -1681,25 +2376,28 @@ class Misp:
                 opencti_tags.append(tag_value)
         return opencti_tags
 
-    def find_type_by_uuid(self, uuid, bundle_objects):
-        # filter by uuid
-        i_find = lambda o: o.id.endswith("--" + uuid)
-        i_result = list(filter(i_find, bundle_objects))
+    def index_by_uuid(self, stix_objects, bundle_index):
+        # The first object of an uuid wins, like in a scan of the bundle objects
+        for stix_object in stix_objects:
+            uuid = stix_object["id"].split("--", 1)[-1]
+            if uuid not in bundle_index:
+                bundle_index[uuid] = stix_object
 
-        if len(i_result) > 0:
-            uuid = i_result[0]["id"]
+    def find_type_by_uuid(self, uuid, bundle_index):
+        entity = bundle_index.get(uuid)
+        if entity is not None:
             return {
-                "entity": i_result[0],
-                "type": uuid[: uuid.index("--")],
+                "entity": entity,
+                "type": entity["id"][: entity["id"].index("--")],
             }
         return None
 
     # Markdown object, attribute & tag links should be converted from MISP links to OpenCTI links
-    def process_note(self, content, bundle_objects):
+    def process_note(self, content, bundle_index):
         def reformat(match):
             type = match.group(1)
             uuid = match.group(2)
-            result = self.find_type_by_uuid(uuid, bundle_objects)
+            result = self.find_type_by_uuid(uuid, bundle_index)
             if result is None:
                 return "[{}:{}](/dashboard/search/{})".format(type, uuid, uuid)
             if result["type"] == "indicator":
@@ -0,0 +1,5 @@
+import os
+import sys
+
+# The connector is a script of the src directory, not a package
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
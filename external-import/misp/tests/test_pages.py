@@ -0,0 +1,120 @@
+import pytest
+
+import misp as misp_module
+from misp import Misp, PageSizer
+
+
+class StopRun(Exception):
+    pass
+
+
+class FakeWork:
+    def __init__(self):
+        self.processed = []
+
+    def initiate_work(self, connect_id, friendly_name):
+        return "work"
+
+    def to_processed(self, work_id, message, in_error=False):
+        self.processed.append((message, in_error))
+
+
+class FakeApi:
+    def __init__(self):
+        self.work = FakeWork()
+
+
+class FakeHelper:
+    connect_id = "connector"
+
+    def __init__(self, state):
+        self.state = state
+        self.states = []
+        self.api = FakeApi()
+
+    def log_debug(self, msg):
+        pass
+
+    def log_info(self, msg):
+        pass
+
+    def log_error(self, msg):
+        pass
+
+    def get_state(self):
+        return self.state
+
+    def set_state(self, state):
+        self.state = state
+        self.states.append(state)
+
+
+class PagedMisp:
+    """Serves events by pages, the search of one page fails"""
+
+    def __init__(self, events, failing_page):
+        self.events = events
+        self.failing_page = failing_page
+        self.pages = []
+
+    def search(self, controller, **kwargs):
+        self.pages.append((kwargs["page"], kwargs["limit"]))
+        if kwargs["page"] == self.failing_page:
+            raise ConnectionError("MISP is unavailable")
+        offset = (kwargs["page"] - 1) * kwargs["limit"]
+        return self.events[offset : offset + kwargs["limit"]]
+
+
+def build_connector(helper, misp):
+    connector = Misp.__new__(Misp)
+    connector.helper = helper
+    connector.misp = misp
+    connector.misp_interval = 5
+    connector.misp_import_tags = None
+    connector.misp_import_tags_not = None
+    connector.misp_import_from_date = None
+    connector.misp_datetime_attribute = "timestamp"
+    connector.import_with_attachments = False
+    connector.stream_event_attributes = 0
+    connector.pipeline_workers = 1
+    connector.resolution_cache_size = 100
+    connector.init_caches()
+    connector.page_sizer = PageSizer(2, 4, 30, 50000)
+    # Events are not converted, only their timestamp matters here
+    connector.process_events = lambda work_id, events: max(
+        int(event["Event"]["timestamp"]) for event in events
+    )
+    return connector
+
+
+def test_failed_page_keeps_the_run(monkeypatch):
+    events = [{"Event": {"timestamp": str(1000 + n)}} for n in range(10)]
+    helper = FakeHelper({"last_run": 900, "latest_event_timestamp": 900})
+    misp = PagedMisp(events, failing_page=2)
+    connector = build_connector(helper, misp)
+
+    def sleep(seconds):
+        raise StopRun()
+
+    monkeypatch.setattr(misp_module.time, "sleep", sleep)
+    with pytest.raises(StopRun):
+        connector.run()
+
+    # The first page is checkpointed, the failed one is fetched again
+    assert misp.pages == [(1, 4), (2, 4), (2, 4)]
+    current_run = helper.state["current_run"]
+    assert current_run["offset"] == 4
+    assert current_run["page_size"] == 2
+    assert current_run["query"]["timestamp"] == 901
+    assert current_run["latest_event_timestamp"] == 1003
+    assert helper.state["latest_event_timestamp"] == 900
+    assert helper.api.work.processed[-1][1] is True
+
+    # The next run resumes from the failed page, with smaller pages
+    misp.failing_page = None
+    with pytest.raises(StopRun):
+        connector.run()
+
+    assert misp.pages[3] == (3, 2)
+    assert "current_run" not in helper.state
+    assert helper.state["latest_event_timestamp"] == 1009
@@ -0,0 +1,207 @@
+import json
+
+import pytest
+
+from misp import Misp, PageSizer
+
+EVENT_UUID = "5f1b5d62-0d8c-4a8e-9d7c-6f1c3a2b0001"
+
+
+class FakeHelper:
+    connect_name = "MISP"
+    connect_confidence_level = 15
+
+    def __init__(self):
+        self.bundles = []
+
+    def log_debug(self, msg):
+        pass
+
+    def log_info(self, msg):
+        pass
+
+    def log_error(self, msg):
+        pass
+
+    def send_stix2_bundle(self, bundle, work_id=None, update=False):
+        self.bundles.append(json.loads(bundle)["objects"])
+        return []
+
+
+class FakeMisp:
+    """Serves the attributes and objects of one event by pages"""
+
+    def __init__(self, attributes, objects):
+        self.attributes = attributes
+        self.objects = objects
+
+    def search(self, controller, **kwargs):
+        offset = (kwargs["page"] - 1) * kwargs["limit"]
+        if controller == "attributes":
+            return {"Attribute": self.attributes[offset : offset + kwargs["limit"]]}
+        return [
+            {"Object": misp_object}
+            for misp_object in self.objects[offset : offset + kwargs["limit"]]
+        ]
+
+
+def attribute(uuid, value):
+    return {
+        "uuid": uuid,
+        "type": "domain",
+        "category": "Network activity",
+        "value": value,
+        "comment": "",
+        "to_ids": True,
+        "timestamp": "1640995200",
+        "Tag": [],
+    }
+
+
+def misp_object(attributes, references):
+    return {
+        "name": "domain-ip",
+        "meta-category": "network",
+        "description": "Domain and IP",
+        "Attribute": attributes,
+        "ObjectReference": [
+            {
+                "uuid": uuid,
+                "source_uuid": source_uuid,
+                "referenced_uuid": referenced_uuid,
+                "relationship_type": "connects-to",
+                "comment": "",
+            }
+            for uuid, source_uuid, referenced_uuid in references
+        ],
+    }
+
+
+def build_connector(helper, misp, bundle_size):
+    connector = Misp.__new__(Misp)
+    connector.helper = helper
+    connector.misp = misp
+    connector.misp_url = "https://misp.example.com"
+    connector.misp_reference_url = None
+    connector.misp_create_report = True
+    connector.misp_create_indicators = True
+    connector.misp_create_observables = True
+    connector.misp_create_object_observables = False
+    connector.misp_report_type = "MISP Event"
+    connector.import_creator_orgs = None
+    connector.import_owner_orgs = None
+    connector.import_distribution_levels = None
+    connector.import_threat_levels = None
+    connector.import_only_published = None
+    connector.import_with_attachments = False
+    connector.import_to_ids_no_score = None
+    connector.import_unsupported_observables_as_text = False
+    connector.update_existing_data = False
+    connector.resolution_cache_size = 100
+    connector.stream_event_attributes = 1
+    connector.stream_bundle_size = bundle_size
+    connector.init_caches()
+    connector.page_sizer = PageSizer(25, 800, 30, 50000)
+    return connector
+
+
+def test_object_references_across_bundles():
+    uuids = ["5f1b5d62-0d8c-4a8e-9d7c-6f1c3a2b%04d" % n for n in range(10, 20)]
+    attributes = [attribute(uuids[0], "a.example.com")]
+    objects = [
+        # Reference to an attribute of a previous bundle
+        misp_object(
+            [attribute(uuids[1], "b.example.com")],
+            [(uuids[5], uuids[1], uuids[0])],
+        ),
+        # Reference to an object of a next bundle
+        misp_object(
+            [attribute(uuids[2], "c.example.com")],
+            [(uuids[6], uuids[2], uuids[3])],
+        ),
+        misp_object([attribute(uuids[3], "d.example.com")], []),
+        # Reference to an object of the event which does not exist
+        misp_object(
+            [attribute(uuids[4], "e.example.com")],
+            [(uuids[7], uuids[4], uuids[9])],
+        ),
+    ]
+    event = {
+        "Event": {
+            "id": "1",
+            "uuid": EVENT_UUID,
+            "info": "Streamed event",
+            "date": "2022-01-01",
+            "timestamp": "1640995200",
+            "threat_level_id": "2",
+            "distribution": "1",
+            "published": True,
+            "attribute_count": "5",
+            "Orgc": {"name": "Author"},
+            "Org": {"name": "Owner"},
+            "Tag": [],
+            "Galaxy": [],
+            "EventReport": [],
+        }
+    }
+    helper = FakeHelper()
+    connector = build_connector(helper, FakeMisp(attributes, objects), 1)
+
+    connector.stream_event(None, event)
+
+    assert len(helper.bundles) > 2
+    relationships = {
+        stix_object["id"]: (stix_object["source_ref"], stix_object["target_ref"])
+        for objects in helper.bundles
+        for stix_object in objects
+        if stix_object["type"] == "relationship"
+        and stix_object.get("description", "").startswith("Original Relationship")
+    }
+    assert relationships == {
+        "relationship--"
+        + uuids[5]: (
+            "indicator--" + uuids[1],
+            "indicator--" + uuids[0],
+        ),
+        "relationship--"
+        + uuids[6]: (
+            "indicator--" + uuids[2],
+            "indicator--" + uuids[3],
+        ),
+    }
+
+
+class FailingMisp(FakeMisp):
+    """Fails to serve a controller"""
+
+    def __init__(self, attributes, objects, failing_controller):
+        super().__init__(attributes, objects)
+        self.failing_controller = failing_controller
+
+    def search(self, controller, **kwargs):
+        if controller == self.failing_controller:
+            raise ConnectionError("MISP is unavailable")
+        return super().search(controller, **kwargs)
+
+
+def test_failed_slice_stops_the_event():
+    attributes = [
+        attribute("5f1b5d62-0d8c-4a8e-9d7c-6f1c3a2b%04d" % n, "a%d.example.com" % n)
+        for n in range(10, 12)
+    ]
+    helper = FakeHelper()
+    connector = build_connector(helper, FailingMisp(attributes, [], "objects"), 10)
+
+    with pytest.raises(ConnectionError):
+        for _ in connector.fetch_event_slices({"Event": {"id": "1"}}):
+            pass
+
+
+def test_failed_full_events_stop_the_page():
+    helper = FakeHelper()
+    connector = build_connector(helper, FailingMisp([], [], "events"), 10)
+    connector.stream_event_attributes = 100
+    events = [{"Event": {"id": "1", "uuid": EVENT_UUID, "attribute_count": "2"}}]
+
+    with pytest.raises(ConnectionError):
+        connector.fetch_full_events(events)
@@ -0,0 +1,151 @@
+"""
+Benchmark of the resolution of the missing references of a restore
+
+Writes a synthetic backup of one file per entity, where each report references
+an author and markings stored in later directories, and resolves the missing
+references of the first directories with a walk of the backup tree for each
+reference (as restore-files did before the catalogue) and with the SQLite
+catalogue. Both must find the same elements.
+
+Usage: PYTHONPATH=src python benchmarks/resolve_missing.py [directories] [files per directory]
+"""
+
+import datetime
+import importlib.util
+import json
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+
+from catalogue import Catalogue
+
+SAMPLE_DIRECTORIES = 20
+
+spec = importlib.util.spec_from_file_location(
+    "restore_files",
+    os.path.join(os.path.dirname(__file__), "..", "src", "restore-files.py"),
+)
+restore_files = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(restore_files)
+
+
+def walk_find_element(backup_path, dir_date, id):
+    name = id + ".json"
+    path = backup_path + "/opencti_data"
+    for root, dirs, files in os.walk(path):
+        if name in files:
+            if restore_files.date_convert(os.path.basename(root)) > dir_date:
+                return restore_files.fetch_stix_data(os.path.join(root, name))[0]
+    return None
+
+
+def write_backup(backup_path, directories, files, rng):
+    start = datetime.datetime(2022, 1, 1)
+    names = [
+        (start + datetime.timedelta(minutes=n)).strftime("%Y%m%dT%H%M%SZ")
+        for n in range(directories)
+    ]
+    for name in names:
+        os.makedirs(os.path.join(backup_path, "opencti_data", name))
+
+    def write(directory, entity):
+        path = os.path.join(backup_path, "opencti_data", directory, entity["id"])
+        with open(path + ".json", "w") as file:
+            json.dump({"type": "bundle", "objects": [entity]}, file)
+
+    markings = [f"marking-definition--{n:036d}" for n in range(4)]
+    authors = [f"identity--{n:036d}" for n in range(50)]
+    # Authors and markings updated later land in the last directories
+    for marking in markings:
+        write(names[-1], {"id": marking, "type": "marking-definition"})
+    for number, author in enumerate(authors):
+        write(
+            names[directories - 1 - number % 10],
+            {"id": author, "type": "identity", "object_marking_refs": markings[:1]},
+        )
+    for directory in names[:-10]:
+        for _ in range(files):
+            write(
+                directory,
+                {
+                    "id": f"report--{rng.getrandbits(128):036d}",
+                    "type": "report",
+                    "created_by_ref": rng.choice(authors),
+                    "object_marking_refs": [rng.choice(markings)],
+                },
+            )
+    return names
+
+
+def resolve(find_element, backup_path, names):
+    resolved = []
+    for name in names[:SAMPLE_DIRECTORIES]:
+        directory = os.path.join(backup_path, "opencti_data", name)
+        objects = restore_files.fetch_directory_data(directory)
+        ids = set(element["id"] for element in objects)
+        acc, acc_ids = [], set()
+        pending = list(objects)
+        while len(pending) > 0:
+            for ref in restore_files.ref_extractors([pending.pop()]):
+                if ref in ids or ref in acc_ids:
+                    continue
+                element = find_element(name, ref)
+                if element is not None:
+                    acc.insert(0, element)
+                    acc_ids.add(ref)
+                    pending.append(element)
+        resolved.append(sorted(acc_ids))
+    return resolved
+
+
+def main():
+    directories = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    files = int(sys.argv[2]) if len(sys.argv) > 2 else 50
+
+    with tempfile.TemporaryDirectory() as backup_path:
+        names = write_backup(backup_path, directories, files, random.Random(42))
+        print(f"Backup of {directories} directories of {files} files")
+
+        start = time.perf_counter()
+        walked = resolve(
+            lambda name, ref: walk_find_element(
+                backup_path, restore_files.date_convert(name), ref
+            ),
+            backup_path,
+            names,
+        )
+        walk_time = time.perf_counter() - start
+
+        start = time.perf_counter()
+        catalogue = Catalogue(os.path.join(backup_path, "catalogue.sqlite"))
+        catalogue.update(os.path.join(backup_path, "opencti_data"))
+        build_time = time.perf_counter() - start
+
+        connector = object.__new__(restore_files.RestoreFilesConnector)
+        connector.backup_path = backup_path
+        connector.catalogue_path = os.path.join(backup_path, "catalogue.sqlite")
+        connector.local = threading.local()
+        connector.local.catalogue = catalogue
+        start = time.perf_counter()
+        looked_up = resolve(connector.find_element, backup_path, names)
+        lookup_time = time.perf_counter() - start
+
+        start = time.perf_counter()
+        catalogue.update(os.path.join(backup_path, "opencti_data"))
+        update_time = time.perf_counter() - start
+        catalogue.close()
+
+    assert walked == looked_up, "Resolved elements differ"
+    print(f"Tree walk: {walk_time:.2f}s for {SAMPLE_DIRECTORIES} directories")
+    print(
+        f"Catalogue: {lookup_time:.2f}s for {SAMPLE_DIRECTORIES} directories"
+        f" ({build_time:.2f}s to build, {update_time:.3f}s to update unchanged)"
+    )
+    print("Resolved elements are identical")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,152 @@
+################################
+# OpenCTI Restore Catalogue    #
+################################
+#
+# SQLite catalogue of the entities of a backup, giving the directory and the
+# file (or the segment and the offset) of each entity. It is built in one pass
+# over the backup and then only updated for the directories which changed:
+# directories of one file per entity are scanned again when their mtime
+# changes, the index of segment directories is read from its last known size,
+# or from its start when it was replaced (repaired after a crash) or shrank.
+# The records of the segments win over the files of the same entity.
+import os
+import sqlite3
+
+from segments import INDEX_NAME, read_index
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS entities (
+    id TEXT NOT NULL,
+    directory TEXT NOT NULL,
+    file TEXT NOT NULL,
+    offset INTEGER,
+    PRIMARY KEY (id, directory)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS directories (
+    directory TEXT PRIMARY KEY,
+    mtime INTEGER NOT NULL,
+    index_size INTEGER NOT NULL,
+    index_inode INTEGER
+) WITHOUT ROWID;
+"""
+
+
+class Catalogue:
+    def __init__(self, db_path):
+        self.db = sqlite3.connect(db_path)
+        columns = [row[1] for row in self.db.execute("PRAGMA table_info(directories)")]
+        if len(columns) > 0 and "index_inode" not in columns:
+            # Catalogue of a previous version, built again from the backup
+            with self.db:
+                self.db.execute("DROP TABLE entities")
+                self.db.execute("DROP TABLE directories")
+        self.db.executescript(SCHEMA)
+
+    def close(self):
+        self.db.close()
+
+    def update(self, data_path):
+        """Catalogue the directories added or changed since the last update"""
+        known = {
+            row[0]: (row[1], row[2], row[3])
+            for row in self.db.execute(
+                "SELECT directory, mtime, index_size, index_inode FROM directories"
+            )
+        }
+        updated = 0
+        for entry in os.scandir(data_path):
+            if not entry.is_dir():
+                continue
+            mtime, index_size, index_inode = known.pop(entry.name, (None, 0, None))
+            with self.db:
+                if self._update_directory(entry, mtime, index_size, index_inode):
+                    updated += 1
+        # Directories removed from the backup
+        with self.db:
+            for directory in known:
+                self.db.execute(
+                    "DELETE FROM entities WHERE directory = ?", (directory,)
+                )
+                self.db.execute(
+                    "DELETE FROM directories WHERE directory = ?", (directory,)
+                )
+        return updated
+
+    def _update_directory(self, entry, mtime, index_size, index_inode):
+        changed = False
+        current_mtime = entry.stat().st_mtime_ns
+        if current_mtime != mtime:
+            # Files of one entity, named after the entity
+            files = [
+                file.name
+                for file in os.scandir(entry.path)
+                if file.is_file() and file.name.endswith(".json")
+            ]
+            if len(files) > 0:
+                # Files left by the connector before its upgrade to the segments
+                # are replaced by the records of their entities, deleted or not
+                indexed = read_index(entry.path, keep_deleted=True)
+                files = [name for name in files if name[: -len(".json")] not in indexed]
+            self.db.execute(
+                "DELETE FROM entities WHERE directory = ? AND offset IS NULL",
+                (entry.name,),
+            )
+            self.db.executemany(
+                "INSERT OR IGNORE INTO entities VALUES (?, ?, ?, NULL)",
+                ((name[: -len(".json")], entry.name, name) for name in files),
+            )
+            changed = True
+
+        index_path = os.path.join(entry.path, INDEX_NAME)
+        index_stat = os.stat(index_path) if os.path.isfile(index_path) else None
+        if (index_stat is None and index_inode is not None) or (
+            index_stat is not None
+            and (index_stat.st_ino != index_inode or index_stat.st_size < index_size)
+        ):
+            # Index rewritten since the last update, its records are read again
+            self.db.execute(
+                "DELETE FROM entities WHERE directory = ? AND offset IS NOT NULL",
+                (entry.name,),
+            )
+            index_size = 0
+            index_inode = index_stat.st_ino if index_stat is not None else None
+            changed = True
+        if index_stat is not None and index_stat.st_size > index_size:
+            with open(index_path, "rb") as index:
+                index.seek(index_size)
+                for line in index:
+                    if not line.endswith(b"\n"):
+                        # Line being written, read again on the next update
+                        break
+                    index_size += len(line)
+                    entity_id, segment, offset = line.decode("utf-8")[:-1].split("\t")
+                    if int(offset) < 0:
+                        self.db.execute(
+                            "DELETE FROM entities WHERE id = ? AND directory = ?",
+                            (entity_id, entry.name),
+                        )
+                    else:
+                        self.db.execute(
+                            "INSERT OR REPLACE INTO entities VALUES (?, ?, ?, ?)",
+                            (entity_id, entry.name, segment, int(offset)),
+                        )
+            changed = True
+
+        if changed:
+            self.db.execute(
+                "INSERT OR REPLACE INTO directories VALUES (?, ?, ?, ?)",
+                (entry.name, current_mtime, index_size, index_inode),
+            )
+        return changed
+
+    def locate(self, entity_id, after_directory):
+        """
+        Return the first (directory, file, offset) of an entity in the
+        directories after the given one, the offset is None for the files of a
+        single entity
+        """
+        return self.db.execute(
+            "SELECT directory, file, offset FROM entities"
+            " WHERE id = ? AND directory > ? ORDER BY directory LIMIT 1",
+            (entity_id, after_directory),
+        ).fetchone()
@@ -5,10 +5,21 @@ import os
 import yaml
 import json
 import datetime
+import itertools
 import sys
+import threading
 
-from pycti import OpenCTIConnectorHelper, get_config_variable, OpenCTIStix2Splitter
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from pycti import (
+    OpenCTIApiClient,
+    OpenCTIConnectorHelper,
+    get_config_variable,
+    OpenCTIStix2Splitter,
+)
 from pathlib import Path
+from catalogue import Catalogue
+from segments import read_directory, read_index, read_record
 
 
 def ref_extractors(objects):
@@ -32,6 +43,24 @@ def fetch_stix_data(file):
     return file_json["objects"]
 
 
+def fetch_directory_data(directory):
+    """Return the objects of a backup directory, in segments or in files"""
+    objects = []
+    for bundle in read_directory(directory):
+        objects.extend(bundle["objects"])
+    # Directories not converted yet hold one file per entity, the records of
+    # the segments replace the files left by the connector before its upgrade
+    indexed = read_index(directory, keep_deleted=True)
+    for file in os.scandir(directory):
+        if (
+            file.is_file()
+            and file.name.endswith(".json")
+            and file.name[: -len(".json")] not in indexed
+        ):
+            objects.extend(fetch_stix_data(file))
+    return objects
+
+
 def date_convert(name):
     return datetime.datetime.strptime(name, "%Y%m%dT%H%M%SZ")
 
@@ -58,107 +87,180 @@ class RestoreFilesConnector:
         self.backup_path = get_config_variable(
             "BACKUP_PATH", ["backup", "path"], config
         )
+        self.catalogue_path = get_config_variable(
+            "BACKUP_CATALOGUE_PATH",
+            ["backup", "catalogue_path"],
+            config,
+            default=self.backup_path + "/restore-catalogue.sqlite",
+        )
+        self.read_workers = get_config_variable(
+            "BACKUP_READ_WORKERS", ["backup", "read_workers"], config, True, 4
+        )
+        self.import_workers = get_config_variable(
+            "BACKUP_IMPORT_WORKERS", ["backup", "import_workers"], config, True, 4
+        )
+        self.bundle_size = get_config_variable(
+            "BACKUP_BUNDLE_SIZE", ["backup", "bundle_size"], config, True, 100
+        )
+        # Catalogue connection and API client of each thread
+        self.local = threading.local()
 
-    def find_element(self, dir_date, id):
-        name = id + ".json"
-        path = self.backup_path + "/opencti_data"
-        for root, dirs, files in os.walk(path):
-            if name in files:
-                # If find dir is before, no need to process the element as missing
-                path = os.path.basename(root)
-                if date_convert(path) > dir_date:
-                    return fetch_stix_data(os.path.join(root, name))[0]
-        return None
-
-    def resolve_missing(self, dir_date, element_ids, data, acc=[]):
-        refs = ref_extractors([data])
-        for ref in refs:
-            if ref not in element_ids:
-                not_in = next((x for x in acc if x["id"] == ref), None)
-                if not_in is None:
-                    missing_element = self.find_element(dir_date, ref)
+    def get_catalogue(self):
+        if getattr(self.local, "catalogue", None) is None:
+            self.local.catalogue = Catalogue(self.catalogue_path)
+        return self.local.catalogue
+
+    def get_api(self):
+        if getattr(self.local, "api", None) is None:
+            self.local.api = OpenCTIApiClient(
+                self.helper.opencti_url,
+                self.helper.opencti_token,
+                self.helper.log_level,
+                json_logging=self.helper.opencti_json_logging,
+            )
+        return self.local.api
+
+    def find_element(self, directory, id):
+        # Only the elements of the next directories are processed as missing
+        location = self.get_catalogue().locate(id, directory)
+        if location is None:
+            return None
+        directory, file, offset = location
+        path = os.path.join(self.backup_path, "opencti_data", directory, file)
+        if offset is None:
+            return fetch_stix_data(path)[0]
+        return read_record(path, offset)["bundle"]["objects"][0]
+
+    def resolve_missing(self, directory, element_ids, data, acc, acc_ids):
+        pending = [data]
+        while len(pending) > 0:
+            for ref in ref_extractors([pending.pop()]):
+                if ref in element_ids or ref in acc_ids:
+                    continue
+                missing_element = self.find_element(directory, ref)
+                if missing_element is not None:
                     acc.insert(0, missing_element)
-                    self.resolve_missing(dir_date, element_ids, missing_element, acc)
+                    acc_ids.add(ref)
+                    # Restart the process to handle recursive resolution
+                    pending.append(missing_element)
+
+    def read_directory(self, entry):
+        # 00 - Create a bundle for the directory
+        files_data = fetch_directory_data(entry)
+        ids = set(map(lambda x: x["id"], files_data))
+        # Ensure the bundle is consistent (include meta elements)
+        # 01 - Scan bundle to detect missing elements
+        acc = []
+        acc_ids = set()
+        for element in files_data:
+            # 02 - If missing, look for the elements in the catalogue
+            # 03 - Resolve the references of the missing elements as well
+            self.resolve_missing(entry.name, ids, element, acc, acc_ids)
+        # 04 - Add elements to the bundle
+        return acc + files_data
+
+    def import_bundle(self, objects):
+        self.get_api().stix2.import_bundle_from_json(
+            json.dumps({"type": "bundle", "objects": objects}), True
+        )
+
+    def import_directory(self, importers, entry, stix_bundle):
+        # Bundle must be split for reordering
+        bundles = OpenCTIStix2Splitter().split_bundle(stix_bundle, False)
+        # The bundles are sorted by number of dependencies, an element always
+        # having more than the elements it references: the bundles with the
+        # same number of dependencies are independent and imported together
+        levels = [
+            [bundle["objects"][0] for bundle in level]
+            for _, level in itertools.groupby(
+                bundles, key=lambda bundle: bundle["objects"][0]["nb_deps"]
+            )
+        ]
+        self.helper.log_info(
+            "restore dir "
+            + entry.name
+            + " with "
+            + str(len(bundles))
+            + " elements in "
+            + str(len(levels))
+            + " levels (direct creation)"
+        )
+        for level in levels:
+            imports = [
+                importers.submit(self.import_bundle, level[i : i + self.bundle_size])
+                for i in range(0, len(level), self.bundle_size)
+            ]
+            # Wait for the whole level, raising the first error
+            for result in imports:
+                result.result()
 
     def restore_files(self):
-        stix2_splitter = OpenCTIStix2Splitter()
         state = self.helper.get_state()
         start_directory = state["current"] if state is not None else None
         start_date = (
             date_convert(start_directory) if start_directory is not None else None
         )
         path = self.backup_path + "/opencti_data"
-        dirs = sorted(Path(path).iterdir(), key=lambda d: date_convert(d.name))
-        for entry in dirs:
-            friendly_name = "Restore run directory @ " + entry.name
-            self.helper.log_info(friendly_name)
-            dir_date = date_convert(entry.name)
-            if start_date is not None and dir_date <= start_date:
-                continue
-            # 00 - Create a bundle for the directory
-            files_data = []
-            element_ids = []
-            # 01 - build all _ref / _refs contained in the bundle
-            element_refs = []
-            for file in os.scandir(entry):
-                if file.is_file():
-                    objects = fetch_stix_data(file)
-                    object_ids = set(map(lambda x: x["id"], objects))
-                    element_refs.extend(ref_extractors(objects))
-                    files_data.extend(objects)
-                    element_ids.extend(object_ids)
-            # Ensure the bundle is consistent (include meta elements)
-            # 02 - Scan bundle to detect missing elements
-            acc = []
-            ids = set(element_ids)
-            refs = set(element_refs)
-            for ref in refs:
-                if ref not in ids:
-                    # 03 - If missing, scan the other dir/files to find the elements
-                    missing_element = self.find_element(dir_date, ref)
-                    if missing_element is not None:
-                        acc.insert(0, missing_element)
-                        # 04 - Restart the process to handle recursive resolution
-                        self.resolve_missing(dir_date, ids, missing_element, acc)
-            # 05 - Add elements to the bundle
-            objects_with_missing = acc + files_data
-            if len(objects_with_missing) > 0:
-                # Create the work
-                work_id = self.helper.api.work.initiate_work(
-                    self.helper.connect_id, friendly_name
-                )
-                # 06 - Send the bundle to the worker queue
-                stix_bundle = {
-                    "type": "bundle",
-                    "objects": objects_with_missing,
-                }
-                if self.direct_creation:
-                    # Bundle must be split for reordering
-                    bundles = stix2_splitter.split_bundle(stix_bundle, False)
-                    self.helper.log_info(
-                        "restore dir "
-                        + entry.name
-                        + " with "
-                        + str(len(bundles))
-                        + " bundles (direct creation)"
+        self.helper.log_info(
+            "Catalogued "
+            + str(self.get_catalogue().update(path))
+            + " new or changed directories"
+        )
+        dirs = iter(
+            entry
+            for entry in sorted(
+                Path(path).iterdir(), key=lambda d: date_convert(d.name)
+            )
+            if start_date is None or date_convert(entry.name) > start_date
+        )
+
+        readers = ThreadPoolExecutor(max_workers=self.read_workers)
+        importers = ThreadPoolExecutor(max_workers=self.import_workers)
+        try:
+            # Directories are read ahead by the readers, but restored in order
+            reads = deque(
+                (entry, readers.submit(self.read_directory, entry))
+                for entry in itertools.islice(dirs, 2 * self.read_workers)
+            )
+            while len(reads) > 0:
+                entry, read = reads.popleft()
+                objects_with_missing = read.result()
+                for next_entry in itertools.islice(dirs, 1):
+                    reads.append(
+                        (next_entry, readers.submit(self.read_directory, next_entry))
                     )
-                    for bundle in bundles:
-                        self.helper.api.stix2.import_bundle_from_json(
-                            json.dumps(bundle), True
+
+                friendly_name = "Restore run directory @ " + entry.name
+                self.helper.log_info(friendly_name)
+                if len(objects_with_missing) > 0:
+                    # 05 - Send the bundle to the worker queue
+                    stix_bundle = {
+                        "type": "bundle",
+                        "objects": objects_with_missing,
+                    }
+                    if self.direct_creation:
+                        self.import_directory(importers, entry, stix_bundle)
+                    else:
+                        # Create the work
+                        work_id = self.helper.api.work.initiate_work(
+                            self.helper.connect_id, friendly_name
                         )
-                    # 06 - Save the state
-                    self.helper.set_state({"current": entry.name})
-                else:
-                    self.helper.log_info("restore dir (worker bundles):" + entry.name)
-                    self.helper.send_stix2_bundle(
-                        json.dumps(stix_bundle), work_id=work_id
-                    )
-                    message = "Restore dir run, storing last_run as {0}".format(
-                        entry.name
-                    )
-                    self.helper.api.work.to_processed(work_id, message)
-                    # 06 - Save the state
-                    self.helper.set_state({"current": entry.name})
+                        self.helper.log_info(
+                            "restore dir (worker bundles):" + entry.name
+                        )
+                        self.helper.send_stix2_bundle(
+                            json.dumps(stix_bundle), work_id=work_id
+                        )
+                        message = "Restore dir run, storing last_run as {0}".format(
+                            entry.name
+                        )
+                        self.helper.api.work.to_processed(work_id, message)
+                # 06 - Save the state, once the directory and all the previous
+                # ones are restored
+                self.helper.set_state({"current": entry.name})
+        finally:
+            readers.shutdown(wait=False, cancel_futures=True)
+            importers.shutdown(wait=True)
         self.helper.log_info("restore run completed")
 
     def start(self):
@@ -0,0 +1,103 @@
+################################
+# OpenCTI Backup Segments      #
+################################
+#
+# Reader of the segments written by the backup-files stream connector. Each
+# backup directory (one per rounded minute of creation) holds append-only
+# segments of gzip compressed JSON lines, one gzip member per record, and an
+# index giving the segment and the offset of the records of each entity.
+#
+# A record is either {"id": ..., "bundle": {...}} for the last version of an
+# entity, or {"id": ..., "deleted": true} once the entity is deleted. The last
+# line of an entity in the index is its current record (offset -1 once deleted).
+import json
+import os
+import zlib
+
+SEGMENT_PREFIX = "segment-"
+SEGMENT_SUFFIX = ".jsonl.gz"
+INDEX_NAME = "index.tsv"
+READ_CHUNK_SIZE = 64 * 1024
+
+
+def list_segments(directory):
+    return sorted(
+        name
+        for name in os.listdir(directory)
+        if name.startswith(SEGMENT_PREFIX) and name.endswith(SEGMENT_SUFFIX)
+    )
+
+
+def decode_member(file):
+    """Decompress the gzip member starting at the current position of a file"""
+    decompressor = zlib.decompressobj(wbits=31)
+    data = b""
+    while not decompressor.eof:
+        chunk = file.read(READ_CHUNK_SIZE)
+        if len(chunk) == 0:
+            # Member interrupted while writing
+            return None
+        try:
+            data += decompressor.decompress(chunk)
+        except zlib.error:
+            # Member corrupted by a crash while writing
+            return None
+    file.seek(-len(decompressor.unused_data), os.SEEK_CUR)
+    return data
+
+
+def read_record(path, offset):
+    with open(path, "rb") as file:
+        file.seek(offset)
+        data = decode_member(file)
+    return json.loads(data) if data is not None else None
+
+
+def iter_records(path):
+    """
+    Yield the offset and the content of the records of a segment, up to the
+    first incomplete or corrupted one
+    """
+    with open(path, "rb") as file:
+        while True:
+            offset = file.tell()
+            data = decode_member(file)
+            if data is None:
+                return
+            yield offset, json.loads(data)
+
+
+def read_index(directory, keep_deleted=False):
+    """
+    Return the current (segment, offset) of the entities of a directory, the
+    deleted entities are kept with an offset of -1 if `keep_deleted`
+    """
+    index = {}
+    path = os.path.join(directory, INDEX_NAME)
+    if not os.path.isfile(path):
+        return index
+    with open(path, encoding="utf-8") as file:
+        for line in file:
+            parts = line.rstrip("\n").split("\t")
+            if len(parts) != 3:
+                # Line interrupted while writing
+                continue
+            entity_id, segment, offset = parts
+            if int(offset) < 0 and not keep_deleted:
+                index.pop(entity_id, None)
+            else:
+                index[entity_id] = (segment, int(offset))
+    return index
+
+
+def read_directory(directory):
+    """Return the bundles of the entities of a directory, in write order"""
+    bundles = {}
+    for segment in list_segments(directory):
+        for _, record in iter_records(os.path.join(directory, segment)):
+            # Keep the order of the first write, with the last version
+            if record.get("deleted", False):
+                bundles.pop(record["id"], None)
+            else:
+                bundles[record["id"]] = record["bundle"]
+    return list(bundles.values())
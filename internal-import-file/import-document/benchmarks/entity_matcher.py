@@ -0,0 +1,162 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmark of the entity matching of the ReportParser
+
+Compares the Aho-Corasick EntityMatcher with the previous per-regex path, kept
+here, on a synthetic entity catalogue and checks that both return the same
+results.
+
+Usage: PYTHONPATH=src python benchmarks/entity_matcher.py [entities] [lines]
+"""
+
+import random
+import re
+import string
+import sys
+import time
+
+from reportimporter.entity_matcher import EntityMatcher
+from reportimporter.models import EntityConfig
+from reportimporter.report_parser import ReportParser
+
+
+class BenchmarkHelper:
+    def log_debug(self, msg: str) -> None:
+        pass
+
+    def log_info(self, msg: str) -> None:
+        pass
+
+    def log_error(self, msg: str) -> None:
+        print(msg)
+
+
+def random_name(rng: random.Random) -> str:
+    words = rng.randint(1, 3)
+    return " ".join(
+        "".join(rng.choices(string.ascii_letters, k=rng.randint(3, 9)))
+        for _ in range(words)
+    )
+
+
+def build_catalogue(rng: random.Random, size: int) -> list:
+    return [
+        {
+            "standard_id": f"intrusion-set--{index:08d}",
+            "name": random_name(rng),
+            "aliases": [random_name(rng) for _ in range(rng.randint(0, 4))],
+        }
+        for index in range(size)
+    ]
+
+
+def build_lines(rng: random.Random, catalogue: list, count: int) -> list:
+    lines = []
+    for _ in range(count):
+        words = [random_name(rng) for _ in range(12)]
+        for _ in range(rng.randint(0, 3)):
+            item = rng.choice(catalogue)
+            name = rng.choice([item["name"]] + item["aliases"])
+            words.insert(rng.randint(0, len(words)), rng.choice([name, name.upper()]))
+        words.append("apt-domain.example.com")
+        lines.append(" ".join(words) + ".")
+    return lines
+
+
+def compile_regexes(entities: list) -> list:
+    return [
+        [
+            re.compile(f"\\b{re.escape(value)}\\b", re.IGNORECASE)
+            for value in entity.patterns
+        ]
+        for entity in entities
+    ]
+
+
+def extract_entity(
+    parser: ReportParser, entity, regex_list: list, list_matches: dict, data: str
+) -> dict:
+    match_dict = {}
+    match_key = ""
+
+    # Run all regexes for entity X
+    for regex in regex_list:
+        for match in regex.finditer(data):
+            match_key = match.group()
+            if match_key in match_dict:
+                match_dict[match_key].append(match.span())
+            else:
+                match_dict[match_key] = [match.span()]
+
+    return parser._process_entity_matches(entity, list_matches, match_dict, match_key)
+
+
+def run_regex(parser: ReportParser, regexes: list, lines: list) -> list:
+    results = []
+    for line in lines:
+        list_matches = {}
+        for entity, regex_list in zip(parser.entity_list, regexes):
+            list_matches = extract_entity(
+                parser, entity, regex_list, list_matches, line
+            )
+        results.append(list_matches)
+    return results
+
+
+def run_matcher(parser: ReportParser, lines: list) -> list:
+    return [parser._extract_entities({}, line) for line in lines]
+
+
+def main() -> None:
+    entity_count = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    line_count = int(sys.argv[2]) if len(sys.argv) > 2 else 200
+    rng = random.Random(42)
+    helper = BenchmarkHelper()
+
+    entity_config = EntityConfig(
+        name="intrusion_set",
+        stix_class="intrusion_set",
+        filter="null",
+        fields="name\naliases",
+        omit_match_in="Domain-Name.value",
+    )
+    catalogue = build_catalogue(rng, entity_count)
+    lines = build_lines(rng, catalogue, line_count)
+
+    start = time.perf_counter()
+    entities = entity_config.convert_to_entity(catalogue, helper)
+    print(f"Converted {len(entities)} entities in {time.perf_counter() - start:.2f}s")
+
+    start = time.perf_counter()
+    matcher = EntityMatcher(entities)
+    print(
+        f"Built automaton of {len(matcher)} values in {time.perf_counter() - start:.2f}s"
+    )
+
+    parser = ReportParser(helper, entities, [], matcher)
+
+    start = time.perf_counter()
+    matcher_results = run_matcher(parser, lines)
+    matcher_time = time.perf_counter() - start
+    print(f"EntityMatcher: {line_count} lines in {matcher_time:.3f}s")
+
+    start = time.perf_counter()
+    regexes = compile_regexes(entities)
+    print(f"Compiled the per-value regexes in {time.perf_counter() - start:.2f}s")
+
+    start = time.perf_counter()
+    regex_results = run_regex(parser, regexes, lines)
+    regex_time = time.perf_counter() - start
+    print(f"Per-regex:     {line_count} lines in {regex_time:.3f}s")
+
+    if matcher_results != regex_results:
+        raise SystemExit("EntityMatcher and per-regex results differ")
+
+    matched = sum(len(result) for result in matcher_results)
+    print(
+        f"Identical results ({matched} matches), speedup x{regex_time / matcher_time:.1f}"
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,141 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmark of the PDF parsing of the ReportParser
+
+Generates a synthetic multi-page PDF and compares the serial parsing with the
+parallel parsing by a pool of worker processes.
+
+Usage: PYTHONPATH=src python benchmarks/pdf_parser.py [pages] [workers]
+"""
+
+import os
+import random
+import sys
+import tempfile
+import time
+
+from entity_matcher import BenchmarkHelper, build_catalogue, random_name
+from reportimporter.core import ReportImporter
+from reportimporter.models import EntityConfig, Observable
+from reportimporter.report_parser import ReportParser
+
+OBSERVABLE_CONFIG = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)),
+    "..",
+    "src",
+    "reportimporter",
+    "config",
+    "observable_config.ini",
+)
+
+
+def build_page_lines(rng: random.Random, catalogue: list) -> list:
+    lines = []
+    for _ in range(40):
+        words = [random_name(rng) for _ in range(4)]
+        words.append(rng.choice(catalogue)["name"])
+        words.append(
+            rng.choice(
+                [
+                    f"{rng.randint(1, 223)}.{rng.randint(0, 255)}.{rng.randint(0, 255)}.{rng.randint(1, 254)}",
+                    f"{random_name(rng).split()[0].lower()}.example.org",
+                    "".join(rng.choices("0123456789abcdef", k=32)),
+                    f"T{rng.randint(1000, 1999)}",
+                ]
+            )
+        )
+        lines.append(" ".join(words))
+    return lines
+
+
+def write_pdf(path: str, pages: list) -> None:
+    objects = [
+        b"<< /Type /Catalog /Pages 2 0 R >>",
+        None,
+        b"<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>",
+    ]
+    page_ids = []
+    for lines in pages:
+        text = "BT /F1 9 Tf 12 TL 40 800 Td "
+        text += " ".join(f"({line}) '" for line in lines)
+        text += " ET"
+        stream = text.encode("latin-1")
+        objects.append(
+            b"<< /Length %d >>\nstream\n%s\nendstream" % (len(stream), stream)
+        )
+        content_id = len(objects)
+        objects.append(
+            b"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 595 842] "
+            b"/Resources << /Font << /F1 3 0 R >> >> /Contents %d 0 R >>" % content_id
+        )
+        page_ids.append(len(objects))
+
+    kids = b" ".join(b"%d 0 R" % page_id for page_id in page_ids)
+    objects[1] = b"<< /Type /Pages /Kids [%s] /Count %d >>" % (kids, len(page_ids))
+
+    with open(path, "wb") as f:
+        f.write(b"%PDF-1.4\n")
+        offsets = []
+        for index, content in enumerate(objects, start=1):
+            offsets.append(f.tell())
+            f.write(b"%d 0 obj\n%s\nendobj\n" % (index, content))
+        xref = f.tell()
+        f.write(b"xref\n0 %d\n0000000000 65535 f \n" % (len(objects) + 1))
+        for offset in offsets:
+            f.write(b"%010d 00000 n \n" % offset)
+        f.write(
+            b"trailer\n<< /Size %d /Root 1 0 R >>\nstartxref\n%d\n%%%%EOF\n"
+            % (len(objects) + 1, xref)
+        )
+
+
+def run(parser: ReportParser, path: str) -> tuple:
+    start = time.perf_counter()
+    with open(path, "rb") as file_data:
+        result = parser._parse_pdf(file_data)
+    return result, time.perf_counter() - start
+
+
+def main() -> None:
+    page_count = int(sys.argv[1]) if len(sys.argv) > 1 else 300
+    workers = int(sys.argv[2]) if len(sys.argv) > 2 else os.cpu_count()
+    rng = random.Random(42)
+    helper = BenchmarkHelper()
+
+    entity_config = EntityConfig(
+        name="intrusion_set",
+        stix_class="intrusion_set",
+        filter="null",
+        fields="name\naliases",
+        omit_match_in="Domain-Name.value",
+    )
+    catalogue = build_catalogue(rng, 2000)
+    entities = entity_config.convert_to_entity(catalogue, helper)
+    observables = ReportImporter._parse_config(OBSERVABLE_CONFIG, Observable)
+
+    pdf_path = tempfile.mktemp(suffix=".pdf")
+    write_pdf(pdf_path, [build_page_lines(rng, catalogue) for _ in range(page_count)])
+    print(f"Generated {page_count} pages PDF ({os.path.getsize(pdf_path)} bytes)")
+
+    try:
+        serial = ReportParser(helper, entities, observables)
+        serial_result, serial_time = run(serial, pdf_path)
+        print(f"Serial:             {serial_time:.2f}s")
+
+        parallel = ReportParser(helper, entities, observables, pdf_workers=workers)
+        parallel_result, parallel_time = run(parallel, pdf_path)
+        print(f"Parallel ({workers} workers): {parallel_time:.2f}s")
+    finally:
+        os.remove(pdf_path)
+
+    if list(serial_result.items()) != list(parallel_result.items()):
+        raise SystemExit("Serial and parallel results differ")
+
+    print(
+        f"Identical results ({len(serial_result)} matches), "
+        f"speedup x{serial_time / parallel_time:.1f}"
+    )
+
+
+if __name__ == "__main__":
+    main()
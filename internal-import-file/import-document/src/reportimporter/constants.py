@@ -10,6 +10,13 @@ RESULT_FORMAT_RANGE = "range"
 ENTITY_CLASS = "entity"
 OBSERVABLE_CLASS = "observable"
 
+# Text and HTML files are parsed in overlapping windows, the next window starts on
+# the first whitespace of the overlap and the matches starting there are left to it
+TEXT_WINDOW_SIZE = 16384
+TEXT_WINDOW_OVERLAP = 1024
+# Seconds a PDF worker may spend per page before its pages are parsed serially
+PDF_PAGE_TIMEOUT = 30
+
 CONFIG_PATH = "filter_list"
 COMMENT_INDICATOR = "#"
 
@@ -19,7 +19,8 @@ from reportimporter.constants import (
     OBSERVABLE_CLASS,
     ENTITY_CLASS,
 )
-from reportimporter.models import Observable, EntityConfig, Entity
+from reportimporter.entity_cache import EntityCache
+from reportimporter.models import Observable, EntityConfig
 from reportimporter.report_parser import ReportParser
 from reportimporter.util import MyConfigParser
 from stix2 import Report, Bundle
@@ -42,6 +43,27 @@ class ReportImporter:
             ["import_document", "create_indicator"],
             config,
         )
+        self.pdf_workers = get_config_variable(
+            "IMPORT_DOCUMENT_PDF_WORKERS",
+            ["import_document", "pdf_workers"],
+            config,
+            True,
+            1,
+        )
+        self.pdf_worker_pages = get_config_variable(
+            "IMPORT_DOCUMENT_PDF_WORKER_PAGES",
+            ["import_document", "pdf_worker_pages"],
+            config,
+            True,
+            10,
+        )
+        self.pdf_worker_memory_limit = get_config_variable(
+            "IMPORT_DOCUMENT_PDF_WORKER_MEMORY_LIMIT",
+            ["import_document", "pdf_worker_memory_limit"],
+            config,
+            True,
+            0,
+        )
 
         # Load Entity and Observable configs
         observable_config_file = base_path + "/config/observable_config.ini"
@@ -61,6 +83,46 @@ class ReportImporter:
         else:
             raise FileNotFoundError(f"{entity_config_file} was not found")
 
+        # Catalogue of the OpenCTI entities, refreshed incrementally. A relative
+        # cache path is resolved from the connector directory, like config.yml
+        entity_cache_path = get_config_variable(
+            "IMPORT_DOCUMENT_ENTITY_CACHE_PATH",
+            ["import_document", "entity_cache_path"],
+            config,
+            False,
+            "entity_cache.pickle",
+        )
+        if entity_cache_path and not os.path.isabs(entity_cache_path):
+            entity_cache_path = os.path.join(
+                os.path.dirname(base_path), entity_cache_path
+            )
+        self.entity_cache = EntityCache(
+            self.helper,
+            self.entity_config,
+            entity_cache_path,
+            get_config_variable(
+                "IMPORT_DOCUMENT_ENTITY_CACHE_REFRESH_INTERVAL",
+                ["import_document", "entity_cache_refresh_interval"],
+                config,
+                True,
+                300,
+            ),
+            get_config_variable(
+                "IMPORT_DOCUMENT_ENTITY_CACHE_TTL",
+                ["import_document", "entity_cache_ttl"],
+                config,
+                True,
+                86400,
+            ),
+            get_config_variable(
+                "IMPORT_DOCUMENT_ENTITY_CACHE_MAX_ENTITIES",
+                ["import_document", "entity_cache_max_entities"],
+                config,
+                True,
+                500000,
+            ),
+        )
+
     def _process_message(self, data: Dict) -> str:
         self.helper.log_info("Processing new message")
         file_name = self._download_import_file(data)
@@ -74,11 +136,19 @@ class ReportImporter:
         if self.helper.get_only_contextual() and entity is None:
             return "Connector is only contextual and entity is not defined. Nothing was imported"
 
-        # Retrieve entity set from OpenCTI
-        entity_indicators = self._collect_stix_objects(self.entity_config)
+        # Retrieve entity set from the cached OpenCTI catalogue
+        entity_indicators, entity_matcher = self.entity_cache.get()
 
         # Parse report
-        parser = ReportParser(self.helper, entity_indicators, self.observable_config)
+        parser = ReportParser(
+            self.helper,
+            entity_indicators,
+            self.observable_config,
+            entity_matcher,
+            self.pdf_workers,
+            self.pdf_worker_pages,
+            self.pdf_worker_memory_limit,
+        )
         parsed = parser.run_parser(file_name, data["file_mime"])
         os.remove(file_name)
 
@@ -119,25 +189,6 @@ class ReportImporter:
 
         return file_name
 
-    def _collect_stix_objects(
-        self, entity_config_list: List[EntityConfig]
-    ) -> List[Entity]:
-        base_func = self.helper.api
-        entity_list = []
-        for entity_config in entity_config_list:
-            func_format = entity_config.stix_class
-            try:
-                custom_function = getattr(base_func, func_format)
-                entries = custom_function.list(
-                    getAll=True, filters=entity_config.filter
-                )
-                entity_list += entity_config.convert_to_entity(entries, self.helper)
-            except AttributeError:
-                e = "Selected parser format is not supported: {}".format(func_format)
-                raise NotImplementedError(e)
-
-        return entity_list
-
     @staticmethod
     def _parse_config(config_file: str, file_class: Callable) -> List[BaseModel]:
         config = MyConfigParser()
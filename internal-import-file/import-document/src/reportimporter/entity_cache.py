@@ -0,0 +1,202 @@
+import os
+import pickle
+import time
+from typing import Dict, List, Optional, Tuple
+
+from pycti import OpenCTIConnectorHelper
+from reportimporter.entity_matcher import EntityMatcher
+from reportimporter.models import Entity, EntityConfig
+
+CACHE_FORMAT_VERSION = 2
+
+
+class EntityCache(object):
+    """
+    Persistent catalogue of the OpenCTI entities used by the ReportParser
+
+    The catalogue and its compiled EntityMatcher are kept in memory and on disk.
+    Entities modified since the last refresh are fetched with an updated_at
+    filter every refresh_interval seconds, the whole catalogue is reloaded
+    once it is older than ttl seconds (this also drops deleted entities).
+    """
+
+    def __init__(
+        self,
+        helper: OpenCTIConnectorHelper,
+        entity_config_list: List[EntityConfig],
+        cache_path: Optional[str],
+        refresh_interval: int,
+        ttl: int,
+        max_entities: int,
+    ) -> None:
+        self.helper = helper
+        self.entity_config_list = entity_config_list
+        self.cache_path = cache_path
+        self.refresh_interval = refresh_interval
+        self.ttl = ttl
+        self.max_entities = max_entities
+
+        # Entity config name -> stix_id -> Entity / updated_at
+        self._entities: Dict[str, Dict[str, Entity]] = {}
+        self._updated_at: Dict[str, Dict[str, str]] = {}
+        self._last_full_load = 0.0
+        self._last_refresh = 0.0
+        self._matcher: Optional[EntityMatcher] = None
+
+        self._load()
+
+    def get(self) -> Tuple[List[Entity], EntityMatcher]:
+        now = time.time()
+        if self._matcher is None or now - self._last_full_load > self.ttl:
+            self._full_load(now)
+        elif now - self._last_refresh > self.refresh_interval:
+            self._refresh(now)
+
+        return self._matcher.entity_list, self._matcher
+
+    def _full_load(self, now: float) -> None:
+        self.helper.log_info("Loading the entity catalogue from OpenCTI")
+        self._entities = {}
+        self._updated_at = {}
+        for entity_config in self.entity_config_list:
+            self._entities[entity_config.name] = {}
+            self._updated_at[entity_config.name] = {}
+            entries = self._list_entries(entity_config, None)
+            self._update_entries(entity_config, entries)
+
+        self._last_full_load = now
+        self._last_refresh = now
+        self._rebuild()
+
+    def _refresh(self, now: float) -> None:
+        changed = 0
+        for entity_config in self.entity_config_list:
+            updated_at = self._updated_at.get(entity_config.name, {}).values()
+            since = max(updated_at, default="") or None
+            entries = self._list_entries(entity_config, since)
+            changed += self._update_entries(entity_config, entries)
+
+        self._last_refresh = now
+        if changed > 0:
+            self.helper.log_info(f"Refreshed {changed} entities of the catalogue")
+            self._rebuild()
+
+    def _list_entries(
+        self, entity_config: EntityConfig, since: Optional[str]
+    ) -> List[Dict]:
+        filters = []
+        if entity_config.filter is not None:
+            filters.append(entity_config.filter)
+        if since is not None:
+            filters.append({"key": "updated_at", "values": [since], "operator": "gt"})
+
+        func_format = entity_config.stix_class
+        try:
+            custom_function = getattr(self.helper.api, func_format)
+            return custom_function.list(
+                getAll=True, filters=filters if len(filters) > 0 else None
+            )
+        except AttributeError:
+            e = "Selected parser format is not supported: {}".format(func_format)
+            raise NotImplementedError(e)
+
+    def _update_entries(self, entity_config: EntityConfig, entries: List[Dict]) -> int:
+        entities = self._entities.setdefault(entity_config.name, {})
+        updated_at = self._updated_at.setdefault(entity_config.name, {})
+
+        converted = {
+            entity.stix_id: entity
+            for entity in entity_config.convert_to_entity(entries, self.helper)
+        }
+        for entry in entries:
+            stix_id = entry.get("standard_id")
+            updated_at[stix_id] = entry.get("updated_at") or ""
+            if stix_id in converted:
+                entities[stix_id] = converted[stix_id]
+            else:
+                # All values of the entity are excluded now
+                entities.pop(stix_id, None)
+
+        return len(entries)
+
+    def _rebuild(self) -> None:
+        entity_count = sum(len(entities) for entities in self._entities.values())
+        if entity_count > self.max_entities:
+            self._evict(entity_count - self.max_entities)
+
+        entity_list = [
+            entity
+            for entity_config in self.entity_config_list
+            for entity in self._entities.get(entity_config.name, {}).values()
+        ]
+        self._matcher = EntityMatcher(entity_list)
+        self._save()
+
+    def _evict(self, count: int) -> None:
+        self.helper.log_warning(
+            f"Entity catalogue exceeds {self.max_entities} entities, "
+            f"dropping the {count} least recently updated ones"
+        )
+        candidates = sorted(
+            (self._updated_at[name].get(stix_id, ""), name, stix_id)
+            for name, entities in self._entities.items()
+            for stix_id in entities
+        )
+        for _, name, stix_id in candidates[:count]:
+            del self._entities[name][stix_id]
+            self._updated_at[name].pop(stix_id, None)
+
+    def _config_fingerprint(self) -> List[Dict]:
+        # A change of the entity configs invalidates the cache
+        return [
+            entity_config.dict(exclude={"regex"})
+            for entity_config in self.entity_config_list
+        ]
+
+    def _load(self) -> None:
+        if not self.cache_path or not os.path.isfile(self.cache_path):
+            return
+
+        try:
+            with open(self.cache_path, "rb") as f:
+                cache = pickle.load(f)
+        except Exception as e:
+            self.helper.log_warning(f"Unable to load the entity cache: {e}")
+            return
+
+        if (
+            cache.get("version") != CACHE_FORMAT_VERSION
+            or cache.get("configs") != self._config_fingerprint()
+        ):
+            self.helper.log_info("Entity cache is outdated and will be reloaded")
+            return
+
+        self._entities = cache["entities"]
+        self._updated_at = cache["updated_at"]
+        self._last_full_load = cache["last_full_load"]
+        self._last_refresh = cache["last_refresh"]
+        self._matcher = cache["matcher"]
+        self.helper.log_info(
+            f"Loaded {len(self._matcher.entity_list)} entities from the entity cache"
+        )
+
+    def _save(self) -> None:
+        if not self.cache_path:
+            return
+
+        cache = {
+            "version": CACHE_FORMAT_VERSION,
+            "configs": self._config_fingerprint(),
+            "entities": self._entities,
+            "updated_at": self._updated_at,
+            "last_full_load": self._last_full_load,
+            "last_refresh": self._last_refresh,
+            "matcher": self._matcher,
+        }
+        tmp_path = self.cache_path + ".tmp"
+        try:
+            with open(tmp_path, "wb") as f:
+                pickle.dump(cache, f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp_path, self.cache_path)
+        except OSError as e:
+            self.helper.log_warning(f"Unable to write the entity cache: {e}")
@@ -0,0 +1,154 @@
+from collections import deque
+from typing import Dict, List, Tuple
+
+from reportimporter.models import Entity
+
+
+def _is_word_char(char: str) -> bool:
+    # Same definition of a word character as the unicode "\w" class of re
+    return char.isalnum() or char == "_"
+
+
+def _fold_case(text: str) -> str:
+    folded = text.lower()
+    if len(folded) == len(text):
+        return folded
+
+    # Some characters expand when lowered (e.g. 'İ'), keep them untouched so
+    # that the positions in the folded text still match the original text
+    return "".join(c.lower() if len(c.lower()) == 1 else c for c in text)
+
+
+class EntityMatcher(object):
+    """
+    Aho-Corasick automaton over all values of a list of entities
+
+    Matching is case-insensitive and word-boundary aware, so a hit of the
+    automaton is equivalent to a hit of a `\\bvalue\\b` regex (re.IGNORECASE)
+    per value, while the text is only scanned once.
+    """
+
+    def __init__(self, entity_list: List[Entity]) -> None:
+        self.entity_list = entity_list
+
+        # Trie of the folded pattern values
+        self._goto: List[Dict[str, int]] = [{}]
+        self._fail: List[int] = [0]
+        self._output: List[List[int]] = [[]]
+
+        # Pattern key -> length, owners as (entity index, pattern index)
+        self._pattern_length: List[int] = []
+        self._pattern_owners: List[List[Tuple[int, int]]] = []
+
+        pattern_keys = {}
+        for entity_index, entity in enumerate(entity_list):
+            for pattern_index, value in enumerate(entity.patterns):
+                folded = _fold_case(value)
+                if len(folded) == 0:
+                    continue
+
+                pattern_key = pattern_keys.get(folded, None)
+                if pattern_key is None:
+                    pattern_key = len(self._pattern_length)
+                    pattern_keys[folded] = pattern_key
+                    self._pattern_length.append(len(folded))
+                    self._pattern_owners.append([])
+                    self._add_pattern(folded, pattern_key)
+
+                self._pattern_owners[pattern_key].append((entity_index, pattern_index))
+
+        self._build_failure_links()
+
+    def __len__(self) -> int:
+        return len(self._pattern_length)
+
+    def _add_pattern(self, value: str, pattern_key: int) -> None:
+        state = 0
+        for char in value:
+            next_state = self._goto[state].get(char, None)
+            if next_state is None:
+                next_state = len(self._goto)
+                self._goto[state][char] = next_state
+                self._goto.append({})
+                self._fail.append(0)
+                self._output.append([])
+            state = next_state
+
+        self._output[state].append(pattern_key)
+
+    def _build_failure_links(self) -> None:
+        queue = deque(self._goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for char, next_state in self._goto[state].items():
+                queue.append(next_state)
+
+                fallback = self._fail[state]
+                while fallback and char not in self._goto[fallback]:
+                    fallback = self._fail[fallback]
+                fail_state = self._goto[fallback].get(char, 0)
+
+                self._fail[next_state] = fail_state
+                # Patterns which are a suffix of this state are reported as well
+                self._output[next_state] = (
+                    self._output[next_state] + self._output[fail_state]
+                )
+
+    def _has_boundaries(self, data: str, start: int, end: int) -> bool:
+        before = start > 0 and _is_word_char(data[start - 1])
+        if before == _is_word_char(data[start]):
+            return False
+
+        after = end < len(data) and _is_word_char(data[end])
+        return after != _is_word_char(data[end - 1])
+
+    def match(self, data: str) -> List[Tuple[Entity, List[Tuple[str, Tuple]]]]:
+        """
+        Scan the text once and return all matched entities (in the order of
+        entity_list) with their hits as (matched text, span). The hits of an
+        entity are ordered like the per-regex path: by pattern, then position.
+        """
+        goto = self._goto
+        fail = self._fail
+        output = self._output
+        pattern_length = self._pattern_length
+
+        # Like re.finditer, a pattern does not match again inside its last hit
+        last_end = {}
+        hits = []
+
+        state = 0
+        for index, char in enumerate(_fold_case(data)):
+            while state and char not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(char, 0)
+
+            for pattern_key in output[state]:
+                end = index + 1
+                start = end - pattern_length[pattern_key]
+                if start < last_end.get(pattern_key, 0):
+                    continue
+                if not self._has_boundaries(data, start, end):
+                    continue
+
+                last_end[pattern_key] = end
+                hits.append((pattern_key, start, end))
+
+        entity_hits = {}
+        for pattern_key, start, end in hits:
+            for entity_index, pattern_index in self._pattern_owners[pattern_key]:
+                entity_hits.setdefault(entity_index, []).append(
+                    (pattern_index, start, data[start:end], (start, end))
+                )
+
+        results = []
+        for entity_index in sorted(entity_hits):
+            ordered_hits = sorted(entity_hits[entity_index])
+            results.append(
+                (
+                    self.entity_list[entity_index],
+                    [(match, span) for _, _, match, span in ordered_hits],
+                )
+            )
+
+        return results
@@ -26,14 +26,14 @@ class Observable(BaseModel):
 
     # Whitelisting options
     filter_config: List[str] = []
-    filter_regex: List[Pattern] = []
+    filter_values: List[str] = []
 
     def __init__(self, **data: Any) -> None:
         super().__init__(**data)
         if self.detection_option == OBSERVABLE_DETECTION_CUSTOM_REGEX:
             self.regex = self._load_regex_pattern(self.regex_patterns)
 
-        self.filter_regex = self._load_filter_values(self.filter_config)
+        self.filter_values = self._load_filter_values(self.filter_config)
 
     @validator("detection_option")
     def validate_detection_value(cls, value: str) -> str:
@@ -78,11 +78,11 @@ class Observable(BaseModel):
 
         return regexes
 
-    def _load_filter_values(self, filter_config_paths: List[str]) -> List[Pattern]:
+    def _load_filter_values(self, filter_config_paths: List[str]) -> List[str]:
         if len(filter_config_paths) == 0:
             return []
 
-        filter_patterns = []
+        filter_values = []
         for filter_file in filter_config_paths:
             with open(filter_file, "r") as f:
                 for line in f:
@@ -91,10 +91,9 @@ class Observable(BaseModel):
                     if len(line) == 0 or line.startswith(COMMENT_INDICATOR):
                         continue
 
-                    filter_patterns.append("\\b{}\\b".format(line))
+                    filter_values.append(line)
 
-        filter_patterns = self._load_regex_pattern(filter_patterns)
-        return filter_patterns
+        return filter_values
 
 
 class Entity(BaseModel):
@@ -102,7 +101,7 @@ class Entity(BaseModel):
     stix_class: str
     stix_id: str
     values: List[str]
-    regex: List[Pattern] = []
+    patterns: List[str] = []
     omit_match_in: List[str] = []
 
 
@@ -142,7 +141,7 @@ class EntityConfig(BaseModel):
                     elif type(elem) == str:
                         item_values.add(elem)
 
-            indicators = []
+            patterns = []
             for value in item_values:
                 # Remove SDO names which are defined to be excluded in the entity config
                 if value.lower() in self.exclude_values:
@@ -151,17 +150,10 @@ class EntityConfig(BaseModel):
                     )
                     continue
 
-                value = re.escape(value)
-                value = f"\\b{value}\\b"
-                try:
-                    compiled_re = re.compile(value, re.IGNORECASE)
-                    indicators.append(compiled_re)
-                except re.error as e:
-                    helper.log_error(
-                        f"Entity {self.name}: Unable to create regex from value '{value}' ({e})"
-                    )
+                # Values are matched by the EntityMatcher of the ReportParser
+                patterns.append(value)
 
-            if len(indicators) == 0:
+            if len(patterns) == 0:
                 continue
 
             entity = Entity(
@@ -169,7 +161,7 @@ class EntityConfig(BaseModel):
                 stix_class=self.stix_class,
                 stix_id=_id,
                 values=item_values,
-                regex=indicators,
+                patterns=patterns,
                 omit_match_in=self.omit_match_in,
             )
             entities.append(entity)
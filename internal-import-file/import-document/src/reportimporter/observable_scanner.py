@@ -0,0 +1,283 @@
+import re
+from typing import Dict, List, Optional, Pattern, Tuple
+
+from reportimporter.constants import OBSERVABLE_DETECTION_CUSTOM_REGEX
+from reportimporter.models import Observable
+
+REGEX_SPECIAL_CHARS = set(".^$*+?{}[]|()\\")
+BACKREFERENCE_DIGITS = set("123456789")
+
+
+def _is_word_char(char: str) -> bool:
+    # Same definition of a word character as the unicode "\w" class of re
+    return char.isalnum() or char == "_"
+
+
+def _unescape_literal(value: str) -> Optional[str]:
+    """Return the text matched by a regex if it is a plain literal, else None"""
+    literal = []
+    escaped = False
+    for char in value:
+        if escaped:
+            # Escaped letters and digits are classes (\d, \w) or anchors (\b)
+            if char.isalnum():
+                return None
+            literal.append(char)
+            escaped = False
+        elif char == "\\":
+            escaped = True
+        elif char in REGEX_SPECIAL_CHARS:
+            return None
+        else:
+            literal.append(char)
+
+    if escaped or len(literal) == 0:
+        return None
+    return "".join(literal)
+
+
+def _merge_pattern(pattern: str) -> Optional[str]:
+    """
+    Rewrite the capturing groups of a regex as non-capturing ones, so that it
+    can be merged in an alternation without shifting the group numbers of the
+    other regexes. Returns None if the regex refers to its own groups
+    (backreferences, conditional groups), it must be run on its own then.
+    """
+    merged = []
+    in_class = False
+    index = 0
+    while index < len(pattern):
+        char = pattern[index]
+        if char == "\\":
+            escape = pattern[index : index + 2]
+            # A digit escape outside of a class is a numbered backreference
+            if not in_class and escape[1:2] in BACKREFERENCE_DIGITS:
+                return None
+            merged.append(escape)
+            index += 2
+            continue
+
+        if in_class:
+            if char == "]":
+                in_class = False
+        elif char == "[":
+            in_class = True
+            # A bracket right after the opening one is part of the class
+            for prefix in ("[^]", "[]"):
+                if pattern.startswith(prefix, index):
+                    merged.append(prefix)
+                    index += len(prefix)
+                    break
+            else:
+                merged.append(char)
+                index += 1
+            continue
+        elif char == "(":
+            if pattern.startswith("(?P=", index) or pattern.startswith("(?(", index):
+                return None
+            if pattern.startswith("(?P<", index):
+                end = pattern.find(">", index)
+                if end < 0:
+                    return None
+                merged.append("(?:")
+                index = end + 1
+                continue
+            if not pattern.startswith("(?", index):
+                merged.append("(?:")
+                index += 1
+                continue
+
+        merged.append(char)
+        index += 1
+
+    return "".join(merged)
+
+
+class Whitelist(object):
+    """
+    Filter values of an observable
+
+    A value is whitelisted if one of the `\\bvalue\\b` filter regexes is found in
+    it. Literal filter values are looked up in a set of all word-bounded
+    substrings of the value, the remaining ones are merged in a single regex
+    unless they use backreferences.
+    """
+
+    def __init__(self, filter_values: List[str]) -> None:
+        self.literals = set()
+        patterns = []
+        self.regexes: List[Pattern] = []
+        for filter_value in filter_values:
+            literal = _unescape_literal(filter_value)
+            if literal is not None:
+                self.literals.add(literal.lower())
+                continue
+
+            pattern = f"\\b{filter_value}\\b"
+            try:
+                regex = re.compile(pattern, re.IGNORECASE)
+            except re.error as e:
+                raise ValueError(
+                    f"Unable to create filter regex from value '{filter_value}' ({e})"
+                )
+            merged = _merge_pattern(pattern)
+            if merged is not None:
+                patterns.append(f"(?:{merged})")
+            else:
+                self.regexes.append(regex)
+
+        self.max_literal_length = max((len(x) for x in self.literals), default=0)
+        self.regex: Optional[Pattern] = None
+        if patterns:
+            try:
+                self.regex = re.compile("|".join(patterns), re.IGNORECASE)
+            except re.error:
+                # e.g. inline flags which are only allowed at the start
+                self.regexes.extend(re.compile(x, re.IGNORECASE) for x in patterns)
+
+    def __bool__(self) -> bool:
+        return len(self.literals) > 0 or self.regex is not None or len(self.regexes) > 0
+
+    def _find_literal(self, value: str) -> Optional[str]:
+        # Positions matched by \b
+        boundaries = [
+            index
+            for index in range(len(value) + 1)
+            if (index > 0 and _is_word_char(value[index - 1]))
+            != (index < len(value) and _is_word_char(value[index]))
+        ]
+
+        folded = value.lower()
+        if len(folded) != len(value):
+            folded = "".join(c.lower() if len(c.lower()) == 1 else c for c in value)
+
+        for position, start in enumerate(boundaries):
+            for end in boundaries[position + 1 :]:
+                if end - start > self.max_literal_length:
+                    break
+                if folded[start:end] in self.literals:
+                    return folded[start:end]
+
+        return None
+
+    def match(self, value: str) -> Optional[str]:
+        """Return the filter value matching the value, if any"""
+        if self.literals:
+            literal = self._find_literal(value)
+            if literal is not None:
+                return literal
+
+        for regex in ([self.regex] if self.regex is not None else []) + self.regexes:
+            result = regex.search(value)
+            if result:
+                return result.group()
+
+        return None
+
+
+class ObservableScanner(object):
+    """
+    Combined scanner of all custom regexes of a list of observables
+
+    The regexes are merged in one alternation with a named group per regex, so
+    a text is scanned once. Their own groups are made non-capturing, regexes
+    using backreferences are run on their own. Regexes overlapping the winning
+    alternative of a match are rechecked within its span, so the result is the
+    same as running each regex independently with finditer.
+    """
+
+    def __init__(self, observable_list: List[Observable]) -> None:
+        self.observable_list = observable_list
+
+        # Regex index -> observable index
+        self._observables: List[int] = []
+        self._regexes: List[Pattern] = []
+        # Group name -> index of the merged regex
+        self._group_regex: Dict[str, int] = {}
+        self._standalone: List[int] = []
+        alternatives = []
+        for observable_index, observable in enumerate(observable_list):
+            if observable.detection_option != OBSERVABLE_DETECTION_CUSTOM_REGEX:
+                continue
+            for regex_index, regex in enumerate(observable.regex):
+                index = len(self._regexes)
+                self._observables.append(observable_index)
+                self._regexes.append(regex)
+
+                merged = _merge_pattern(regex.pattern)
+                if merged is None:
+                    self._standalone.append(index)
+                    continue
+                group_name = f"o{observable_index}_{regex_index}"
+                self._group_regex[group_name] = index
+                alternatives.append(f"(?P<{group_name}>{merged})")
+
+        self.regex: Optional[Pattern] = None
+        if alternatives:
+            try:
+                self.regex = re.compile("|".join(alternatives), re.IGNORECASE)
+            except re.error:
+                # e.g. inline flags which are only allowed at the start
+                self._group_regex = {}
+                self._standalone = list(range(len(self._regexes)))
+
+        self.whitelists = {
+            observable.name: Whitelist(observable.filter_values)
+            for observable in observable_list
+        }
+
+    def _scan_combined(self, data: str, matches: List[List[Tuple[str, Tuple]]]):
+        last_end = [0] * len(self._regexes)
+        merged = list(self._group_regex.values())
+
+        def add(index: int, match: re.Match) -> int:
+            matches[index].append((match.group(), match.span()))
+            # Like finditer, an empty match moves the next search forward
+            last_end[index] = max(match.end(), match.start() + 1)
+            return last_end[index]
+
+        for match in self.regex.finditer(data):
+            winner = self._group_regex[match.lastgroup]
+            start, end = match.span()
+
+            accepted = start >= last_end[winner]
+            if accepted:
+                add(winner, match)
+
+            # Other regexes may match inside the span of the winning alternative
+            for index in merged:
+                if index == winner and accepted:
+                    continue
+                regex = self._regexes[index]
+                position = max(start, last_end[index])
+                while position < end:
+                    other = regex.match(data, position)
+                    if other:
+                        position = add(index, other)
+                    else:
+                        position += 1
+
+    def scan(self, data: str) -> Dict[int, List[Tuple[str, Tuple]]]:
+        """
+        Return the matches as (value, span) of all custom regexes of each
+        observable, ordered by regex then position
+        """
+        regex_matches = [[] for _ in self._regexes]
+        if self.regex is not None:
+            self._scan_combined(data, regex_matches)
+        for index in self._standalone:
+            regex_matches[index] = [
+                (match.group(), match.span())
+                for match in self._regexes[index].finditer(data)
+            ]
+
+        results = {}
+        for observable_index, matches in zip(self._observables, regex_matches):
+            results.setdefault(observable_index, []).extend(matches)
+        return results
+
+    def is_whitelisted(self, observable: Observable, value: str) -> Optional[str]:
+        whitelist = self.whitelists.get(observable.name, None)
+        if not whitelist:
+            return None
+        return whitelist.match(str(value))
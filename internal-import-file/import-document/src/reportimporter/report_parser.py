@@ -1,12 +1,17 @@
+import codecs
 import logging
+import multiprocessing
 import os
-import io
-from typing import Dict, List, Pattern, IO, Tuple
+import re
+import resource
+from html.parser import HTMLParser
+from typing import Dict, List, IO, Tuple, Optional, Iterable, Iterator
 
 import ioc_finder
-from bs4 import BeautifulSoup
+from bs4.dammit import EncodingDetector
 from pdfminer.high_level import extract_pages
 from pdfminer.layout import LTTextContainer
+from pdfminer.pdfpage import PDFPage
 from pycti import OpenCTIConnectorHelper
 from reportimporter.constants import (
     OBSERVABLE_CLASS,
@@ -20,10 +25,60 @@ from reportimporter.constants import (
     MIME_HTML,
     OBSERVABLE_DETECTION_CUSTOM_REGEX,
     OBSERVABLE_DETECTION_LIBRARY,
+    TEXT_WINDOW_SIZE,
+    TEXT_WINDOW_OVERLAP,
+    PDF_PAGE_TIMEOUT,
 )
+from reportimporter.entity_matcher import EntityMatcher
 from reportimporter.models import Observable, Entity
+from reportimporter.observable_scanner import ObservableScanner
 from reportimporter.util import library_mapping
 
+WHITESPACE_REGEX = re.compile(r"\s")
+
+
+class PdfParsingError(Exception):
+    """A PDF could not be parsed, the import must fail"""
+
+
+# ReportParser of a PDF worker process, inherited from the parent when forking
+_pdf_worker_parser = None
+
+
+def _init_pdf_worker(parser: "ReportParser", memory_limit: int) -> None:
+    global _pdf_worker_parser
+    _pdf_worker_parser = parser
+
+    if memory_limit > 0:
+        limit = memory_limit * 1024 * 1024
+        resource.setrlimit(resource.RLIMIT_AS, (limit, limit))
+
+
+def _parse_pdf_worker(file_path: str, page_numbers: List[int]) -> Dict[str, Dict]:
+    parse_info = {}
+    with open(file_path, "rb") as file_data:
+        _pdf_worker_parser._parse_pdf_pages(file_data, parse_info, page_numbers)
+    return parse_info
+
+
+class HtmlTextExtractor(HTMLParser):
+    """
+    Incremental extraction of the text of a HTML document, like BeautifulSoup
+    get_text() but without building the whole document tree
+    """
+
+    def __init__(self) -> None:
+        super().__init__(convert_charrefs=True)
+        self.text = []
+
+    def handle_data(self, data: str) -> None:
+        self.text.append(data)
+
+    def pop_text(self) -> str:
+        text = "".join(self.text)
+        self.text = []
+        return text
+
 
 class ReportParser(object):
     """
@@ -35,11 +90,27 @@ class ReportParser(object):
         helper: OpenCTIConnectorHelper,
         entity_list: List[Entity],
         observable_list: List[Observable],
+        entity_matcher: Optional[EntityMatcher] = None,
+        pdf_workers: int = 1,
+        pdf_worker_pages: int = 10,
+        pdf_worker_memory_limit: int = 0,
     ):
 
         self.helper = helper
         self.entity_list = entity_list
         self.observable_list = observable_list
+        self.entity_matcher = (
+            entity_matcher if entity_matcher is not None else EntityMatcher(entity_list)
+        )
+        self.observable_scanner = ObservableScanner(observable_list)
+
+        # PDF pages are parsed by a pool of processes if more than 1 worker is set
+        self.pdf_workers = pdf_workers
+        self.pdf_worker_pages = pdf_worker_pages
+        self.pdf_worker_memory_limit = pdf_worker_memory_limit
+
+        self.text_window_size = TEXT_WINDOW_SIZE
+        self.text_window_overlap = TEXT_WINDOW_OVERLAP
 
         # Disable INFO logging by pdfminer
         logging.getLogger("pdfminer").setLevel(logging.WARNING)
@@ -53,13 +124,13 @@ class ReportParser(object):
 
         self.library_lookup = library_mapping()
 
-    def _is_whitelisted(self, regex_list: List[Pattern], ind_match: str):
-        for regex in regex_list:
-            self.helper.log_debug(f"Filter regex '{regex}' for value '{ind_match}'")
-            result = regex.search(ind_match)
-            if result:
-                self.helper.log_debug(f"Value {ind_match} is whitelisted with {regex}")
-                return True
+    def _is_whitelisted(self, observable: Observable, ind_match: str):
+        filter_value = self.observable_scanner.is_whitelisted(observable, ind_match)
+        if filter_value is not None:
+            self.helper.log_debug(
+                f"Value {ind_match} is whitelisted with '{filter_value}'"
+            )
+            return True
         return False
 
     def _post_parse_observables(
@@ -67,60 +138,201 @@ class ReportParser(object):
     ) -> Dict:
         self.helper.log_debug(f"Observable match: {ind_match}")
 
-        if self._is_whitelisted(observable.filter_regex, ind_match):
+        if self._is_whitelisted(observable, ind_match):
             return {}
 
         return self._format_match(
             OBSERVABLE_CLASS, observable.stix_target, ind_match, match_range
         )
 
-    def _parse(self, data: str) -> Dict[str, Dict]:
+    def _parse(self, data: str, boundary: Optional[int] = None) -> Dict[str, Dict]:
         list_matches = {}
 
         # Defang text
+        if boundary is not None:
+            boundary = len(ioc_finder.prepare_text(data[:boundary]))
         data = ioc_finder.prepare_text(data)
 
-        for observable in self.observable_list:
-            list_matches.update(self._extract_observable(observable, data))
+        # Single scan of the text for all custom regexes
+        regex_matches = self.observable_scanner.scan(data)
+        for index, observable in enumerate(self.observable_list):
+            list_matches.update(
+                self._extract_observable(observable, data, regex_matches.get(index, []))
+            )
+
+        list_matches = self._extract_entities(list_matches, data, boundary)
 
-        for entity in self.entity_list:
-            list_matches = self._extract_entity(entity, list_matches, data)
+        # Observables starting after the boundary are parsed with the next window
+        if boundary is not None:
+            list_matches = {
+                key: match
+                for key, match in list_matches.items()
+                if match[RESULT_FORMAT_TYPE] != OBSERVABLE_CLASS
+                or match[RESULT_FORMAT_RANGE][0] < boundary
+            }
 
         self.helper.log_debug(f"Text: '{data}' -> extracts {list_matches}")
         return list_matches
 
+    def _parse_pdf_pages(
+        self,
+        file_data: IO,
+        parse_info: Dict[str, Dict],
+        page_numbers: Optional[Iterable[int]] = None,
+    ) -> None:
+        for page_layout in extract_pages(file_data, page_numbers=page_numbers):
+            for element in page_layout:
+                if isinstance(element, LTTextContainer):
+                    text = element.get_text()
+                    # Parsing with newlines has been deprecated
+                    no_newline_text = text.replace("\n", "")
+                    parse_info.update(self._parse(no_newline_text))
+
+            # TODO also extract information from images/figures using OCR
+            # https://pdfminersix.readthedocs.io/en/latest/topic/converting_pdf_to_text.html#topic-pdf-to-text-layout
+
+    def _parse_pdf_parallel(self, file_data: IO, parse_info: Dict[str, Dict]) -> None:
+        page_count = sum(1 for _ in PDFPage.get_pages(file_data))
+        file_data.seek(0)
+        if page_count <= self.pdf_worker_pages:
+            self._parse_pdf_pages(file_data, parse_info)
+            return
+
+        page_ranges = [
+            list(range(start, min(start + self.pdf_worker_pages, page_count)))
+            for start in range(0, page_count, self.pdf_worker_pages)
+        ]
+        self.helper.log_info(
+            f"Parsing {page_count} pages with {self.pdf_workers} workers"
+        )
+
+        # Workers are forked so that they share the parser without pickling it
+        context = multiprocessing.get_context("fork")
+        with context.Pool(
+            self.pdf_workers,
+            _init_pdf_worker,
+            (self, self.pdf_worker_memory_limit),
+        ) as pool:
+            results = [
+                pool.apply_async(_parse_pdf_worker, (file_data.name, page_numbers))
+                for page_numbers in page_ranges
+            ]
+
+            # Merge in page order, so that the result matches the serial parsing
+            for page_numbers, result in zip(page_ranges, results):
+                try:
+                    # A worker killed by the system loses its pages, they are
+                    # parsed here once its time is up
+                    parse_info.update(
+                        result.get(self.pdf_worker_pages * PDF_PAGE_TIMEOUT)
+                    )
+                except Exception as e:
+                    pages = f"{page_numbers[0] + 1}-{page_numbers[-1] + 1}"
+                    self.helper.log_warning(
+                        f"Pdf worker failed on pages {pages}, parsing them serially: {e}"
+                    )
+                    # The worker may have hit its memory limit, not the parent
+                    range_info = {}
+                    try:
+                        file_data.seek(0)
+                        self._parse_pdf_pages(file_data, range_info, page_numbers)
+                    except Exception as serial_error:
+                        raise PdfParsingError(
+                            f"Pdf Parsing Error on pages {pages}: {serial_error}"
+                        ) from serial_error
+                    parse_info.update(range_info)
+
     def _parse_pdf(self, file_data: IO) -> Dict[str, Dict]:
         parse_info = {}
         try:
-            for page_layout in extract_pages(file_data):
-                for element in page_layout:
-                    if isinstance(element, LTTextContainer):
-                        text = element.get_text()
-                        # Parsing with newlines has been deprecated
-                        no_newline_text = text.replace("\n", "")
-                        parse_info.update(self._parse(no_newline_text))
-
-                # TODO also extract information from images/figures using OCR
-                # https://pdfminersix.readthedocs.io/en/latest/topic/converting_pdf_to_text.html#topic-pdf-to-text-layout
-
+            if self.pdf_workers > 1:
+                self._parse_pdf_parallel(file_data, parse_info)
+            else:
+                self._parse_pdf_pages(file_data, parse_info)
+        except PdfParsingError:
+            raise
         except Exception as e:
-            logging.exception(f"Pdf Parsing Error: {e}")
+            # Both modes fail the import rather than returning partial results
+            raise PdfParsingError(f"Pdf Parsing Error: {e}") from e
 
         return parse_info
 
-    def _parse_text(self, file_data: IO) -> Dict[str, Dict]:
+    def _next_window_start(self, window: str) -> int:
+        # The next window starts on a whitespace after the step, so that it
+        # never begins in the middle of a token of the current window
+        step = self.text_window_size - self.text_window_overlap
+        whitespace = WHITESPACE_REGEX.search(window, step)
+        if whitespace is None:
+            return step
+        return whitespace.start()
+
+    def _parse_windows(self, chunks: Iterable[str]) -> Dict[str, Dict]:
         parse_info = {}
-        for text in file_data.readlines():
-            parse_info.update(self._parse(text.decode("utf-8")))
+
+        buffer = ""
+        for chunk in chunks:
+            # Newlines are replaced so that matches can span several lines
+            buffer += chunk.replace("\r", " ").replace("\n", " ")
+            while len(buffer) >= self.text_window_size:
+                window = buffer[: self.text_window_size]
+                start = self._next_window_start(window)
+                parse_info.update(self._parse(window, start))
+                buffer = buffer[start:]
+
+        if buffer.strip():
+            parse_info.update(self._parse(buffer))
+
         return parse_info
 
+    def _read_chunks(self, file_data: IO, encoding: str = "utf-8") -> Iterator[str]:
+        try:
+            decoder = codecs.getincrementaldecoder(encoding)(errors="replace")
+        except LookupError:
+            self.helper.log_info(f"Unknown encoding {encoding}, falling back to utf-8")
+            decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+
+        for data in iter(lambda: file_data.read(self.text_window_size), b""):
+            yield decoder.decode(data)
+        yield decoder.decode(b"", final=True)
+
+    def _parse_text(self, file_data: IO) -> Dict[str, Dict]:
+        return self._parse_windows(self._read_chunks(file_data))
+
+    def _detect_encoding(self, head: bytes) -> str:
+        # Byte order mark or declared encoding first, then utf-8 before the
+        # chardet guess, which is unreliable on mostly ascii markup. The head
+        # may end within a character, so it is decoded incrementally.
+        candidates = [
+            EncodingDetector.strip_byte_order_mark(head)[1],
+            EncodingDetector.find_declared_encoding(head, is_html=True),
+            "utf-8",
+        ]
+        candidates.extend(EncodingDetector(head, is_html=True).encodings)
+        for encoding in candidates:
+            if encoding is None:
+                continue
+            try:
+                codecs.getincrementaldecoder(encoding)().decode(head)
+            except (LookupError, UnicodeDecodeError):
+                continue
+            return encoding
+        return "utf-8"
+
     def _parse_html(self, file_data: IO) -> Dict[str, Dict]:
-        parse_info = {}
-        soup = BeautifulSoup(file_data, "html.parser")
-        buf = io.StringIO(soup.get_text())
-        for text in buf.readlines():
-            parse_info.update(self._parse(text))
-        return parse_info
+        head = file_data.read(self.text_window_size)
+        file_data.seek(0)
+        encoding = self._detect_encoding(head)
+        self.helper.log_debug(f"Html encoding: {encoding}")
+
+        def html_text() -> Iterator[str]:
+            extractor = HtmlTextExtractor()
+            for chunk in self._read_chunks(file_data, encoding):
+                extractor.feed(chunk)
+                yield extractor.pop_text()
+            extractor.close()
+            yield extractor.pop_text()
+
+        return self._parse_windows(html_text())
 
     def run_parser(self, file_path: str, file_type: str) -> List[Dict]:
         parsing_results = []
@@ -137,6 +349,8 @@ class ReportParser(object):
         try:
             with open(file_path, "rb") as file_data:
                 parsing_results = file_parser(file_data)
+        except PdfParsingError:
+            raise
         except Exception as e:
             logging.exception(f"Parsing Error: {e}")
 
@@ -169,18 +383,27 @@ class ReportParser(object):
 
         return ""
 
-    def _extract_observable(self, observable: Observable, data: str) -> Dict:
+    def _extract_observable(
+        self,
+        observable: Observable,
+        data: str,
+        regex_matches: Optional[List[Tuple[str, Tuple]]] = None,
+    ) -> Dict:
         list_matches = {}
         if observable.detection_option == OBSERVABLE_DETECTION_CUSTOM_REGEX:
-            for regex in observable.regex:
-                for match in regex.finditer(data):
-                    match_value = match.group()
-
-                    ind_match = self._post_parse_observables(
-                        match_value, observable, match.span()
-                    )
-                    if ind_match:
-                        list_matches[match.group()] = ind_match
+            if regex_matches is None:
+                regex_matches = [
+                    (match.group(), match.span())
+                    for regex in observable.regex
+                    for match in regex.finditer(data)
+                ]
+
+            for match_value, match_range in regex_matches:
+                ind_match = self._post_parse_observables(
+                    match_value, observable, match_range
+                )
+                if ind_match:
+                    list_matches[match_value] = ind_match
 
         elif observable.detection_option == OBSERVABLE_DETECTION_LIBRARY:
             lookup_function = self.library_lookup.get(observable.stix_target, None)
@@ -217,22 +440,30 @@ class ReportParser(object):
 
         return list_matches
 
-    def _extract_entity(self, entity: Entity, list_matches: Dict, data: str) -> Dict:
-        regex_list = entity.regex
+    def _extract_entities(
+        self, list_matches: Dict, data: str, boundary: Optional[int] = None
+    ) -> Dict:
+        # Single scan of the text for all entities
+        for entity, hits in self.entity_matcher.match(data):
+            match_dict = {}
+            match_key = ""
+            for match, match_range in hits:
+                if boundary is not None and match_range[0] >= boundary:
+                    continue
+                match_key = match
+                match_dict.setdefault(match_key, []).append(match_range)
+
+            list_matches = self._process_entity_matches(
+                entity, list_matches, match_dict, match_key
+            )
 
+        return list_matches
+
+    def _process_entity_matches(
+        self, entity: Entity, list_matches: Dict, match_dict: Dict, match_key: str
+    ) -> Dict:
         observable_keys = []
         end_index = set()
-        match_dict = {}
-        match_key = ""
-
-        # Run all regexes for entity X
-        for regex in regex_list:
-            for match in regex.finditer(data):
-                match_key = match.group()
-                if match_key in match_dict:
-                    match_dict[match_key].append(match.span())
-                else:
-                    match_dict[match_key] = [match.span()]
 
         # No maches for this entity
         if len(match_dict) == 0:
@@ -252,7 +483,7 @@ class ReportParser(object):
                     )
                 else:
                     self.helper.log_debug(
-                        f"Entity match: '{match}' of regex: '{regex_list}'"
+                        f"Entity match: '{match}' of values: '{entity.patterns}'"
                     )
                     end_index.add(match_index)
                     if match in list_matches.keys():
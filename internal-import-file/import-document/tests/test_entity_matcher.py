@@ -0,0 +1,110 @@
+import re
+
+from reportimporter.constants import (
+    ENTITY_CLASS,
+    OBSERVABLE_CLASS,
+    RESULT_FORMAT_CATEGORY,
+    RESULT_FORMAT_MATCH,
+    RESULT_FORMAT_RANGE,
+    RESULT_FORMAT_TYPE,
+)
+from reportimporter.entity_matcher import EntityMatcher
+from reportimporter.models import Entity
+from reportimporter.report_parser import ReportParser
+
+
+class FakeHelper:
+    def log_debug(self, msg):
+        pass
+
+    def log_info(self, msg):
+        pass
+
+
+def entity(stix_id, patterns, omit_match_in=()):
+    return Entity(
+        name="intrusion_set",
+        stix_class="intrusion_set",
+        stix_id=stix_id,
+        values=patterns,
+        patterns=patterns,
+        omit_match_in=list(omit_match_in),
+    )
+
+
+def match_one_by_one(entity_list, data):
+    results = []
+    for item in entity_list:
+        hits = [
+            (match.group(), match.span())
+            for value in item.patterns
+            for match in re.finditer(f"\\b{re.escape(value)}\\b", data, re.IGNORECASE)
+        ]
+        if hits:
+            results.append((item, hits))
+    return results
+
+
+def assert_same_matches(entity_list, data):
+    assert EntityMatcher(entity_list).match(data) == match_one_by_one(entity_list, data)
+
+
+def test_word_boundaries():
+    entity_list = [
+        entity("intrusion-set--1", ["APT1", "Sofacy"]),
+        entity("intrusion-set--2", ["C++ Group", ".NET"]),
+    ]
+
+    assert_same_matches(
+        entity_list,
+        "APT1, APT12 and xAPT1 differ. Sofacy_x is not Sofacy. "
+        "C++ Group uses .NET and a.NETb, C++ Groups too.",
+    )
+    assert EntityMatcher(entity_list).match("APT12 and Sofacys") == []
+
+
+def test_case_insensitive():
+    entity_list = [entity("intrusion-set--1", ["Fancy Bear", "İstanbul"])]
+
+    assert_same_matches(
+        entity_list, "FANCY BEAR, fancy bear and Fancy bEAR from İSTANBUL."
+    )
+
+
+def test_overlapping_aliases():
+    entity_list = [
+        entity("intrusion-set--1", ["Lazarus", "Lazarus Group"]),
+        entity("intrusion-set--2", ["Group", "Lazarus Group"]),
+        entity("intrusion-set--3", ["aa", "aaa"]),
+    ]
+
+    assert_same_matches(
+        entity_list, "The Lazarus Group, also Lazarus, is a group. aaaa aaa aa."
+    )
+
+
+def test_omit_match_in():
+    entity_list = [
+        entity("intrusion-set--1", ["Turla"], omit_match_in=["Domain-Name.value"]),
+        entity("intrusion-set--2", ["evil"]),
+    ]
+    parser = ReportParser(FakeHelper(), entity_list, [])
+    data = "turla.evil.com was used by Turla"
+    domain = {
+        RESULT_FORMAT_TYPE: OBSERVABLE_CLASS,
+        RESULT_FORMAT_CATEGORY: "Domain-Name.value",
+        RESULT_FORMAT_MATCH: "turla.evil.com",
+        RESULT_FORMAT_RANGE: (0, 14),
+    }
+
+    # Only the match inside of the domain is omitted
+    list_matches = parser._extract_entities({"turla.evil.com": dict(domain)}, data)
+    assert list_matches["Turla"][RESULT_FORMAT_TYPE] == ENTITY_CLASS
+    assert list_matches["evil"][RESULT_FORMAT_TYPE] == ENTITY_CLASS
+
+    list_matches = parser._extract_entities(
+        {"turla.evil.com": dict(domain)}, data[: data.index(" was")]
+    )
+    assert "turla" not in list_matches
+    assert "Turla" not in list_matches
+    assert list_matches["evil"][RESULT_FORMAT_TYPE] == ENTITY_CLASS
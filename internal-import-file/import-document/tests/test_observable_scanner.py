@@ -0,0 +1,99 @@
+import re
+
+from reportimporter.models import Observable
+from reportimporter.observable_scanner import ObservableScanner
+
+TEXT = (
+    "Dropped abababc and aabbcc from 10.20.30.40:8080, see ticket 12-34 and "
+    "INC-5678-5678 (abcd, bcde). The keys foo=foo and foo=bar were set twice: "
+    "xx-YY-xx, 2022-01-01 and 2022-01-01T10:00."
+)
+
+
+def custom_observable(name, patterns, filter_values=()):
+    observable = Observable(
+        name=name,
+        detection_option="custom_regex",
+        stix_target="Text.value",
+        regex_patterns="\n".join(patterns),
+    )
+    observable.filter_values = list(filter_values)
+    return observable
+
+
+def scan_one_by_one(observables, data):
+    results = {}
+    for index, observable in enumerate(observables):
+        results[index] = [
+            (match.group(), match.span())
+            for regex in observable.regex
+            for match in regex.finditer(data)
+        ]
+    return results
+
+
+def assert_same_matches(observables, data=TEXT):
+    scanner = ObservableScanner(observables)
+    assert scanner.scan(data) == scan_one_by_one(observables, data)
+
+
+def test_numbered_groups():
+    assert_same_matches(
+        [
+            custom_observable("repeated", [r"(ab)+c", r"(\d+)\.(\d+)"]),
+            custom_observable("port", [r":(\d{2,5})"]),
+            custom_observable("named", [r"(?P<year>\d{4})-(\d{2})-\d{2}"]),
+        ]
+    )
+
+
+def test_backreferences():
+    # A backreference must not refer to the group of a previous regex
+    assert_same_matches(
+        [
+            custom_observable("plain", [r"(ab)c", r"bcd"]),
+            custom_observable("doubled", [r"(\w)\1"]),
+            custom_observable("same key", [r"(?P<key>\w+)=(?P=key)"]),
+            custom_observable("ticket", [r"INC-(\d+)-\1", r"\d+-\d+"]),
+            custom_observable("conditional", [r"(<)?xx(?(1)>|-)"]),
+        ]
+    )
+
+
+def test_overlapping_patterns():
+    assert_same_matches(
+        [
+            custom_observable("abc", [r"abc", r"bcd", r"abcd"]),
+            custom_observable("cde", [r"cde?"]),
+            custom_observable("digits", [r"\d{2}", r"\d+\.\d+", r"\d{4}-\d{2}-\d{2}"]),
+            custom_observable("datetime", [r"\d{4}-\d{2}-\d{2}T\d{2}:\d{2}"]),
+            custom_observable("case", [r"xx-yy", r"YY-XX"]),
+        ]
+    )
+
+
+def test_whitelisted_values():
+    filter_values = [
+        "bcde",
+        "(ab)cd",
+        "10\\.20",
+        r"\d{4}-01-01",
+        r"(\w)\1",
+        "INC-5678",
+    ]
+    observable = custom_observable("any", [r"\S+"], filter_values)
+    scanner = ObservableScanner([observable])
+
+    for value, _ in scanner.scan(TEXT)[0]:
+        expected = any(
+            re.search(f"\\b{filter_value}\\b", value, re.IGNORECASE)
+            for filter_value in filter_values
+        )
+        assert (scanner.is_whitelisted(observable, value) is not None) == expected
+
+
+def test_no_whitelist():
+    observable = custom_observable("any", [r"\S+"])
+    scanner = ObservableScanner([observable])
+
+    assert scanner.is_whitelisted(observable, "abcd") is None
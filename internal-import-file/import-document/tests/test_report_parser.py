@@ -0,0 +1,70 @@
+import io
+
+from reportimporter.constants import RESULT_FORMAT_MATCH
+from reportimporter.models import Observable
+from reportimporter.report_parser import ReportParser
+
+SHA256 = "0123456789abcdef0123456789abcdef0123456789abcdef0123456789abcdef"
+DOMAIN = "malware.evil-domain.com"
+
+
+class FakeHelper:
+    def log_debug(self, msg):
+        pass
+
+    def log_info(self, msg):
+        pass
+
+    def log_warning(self, msg):
+        pass
+
+    def log_error(self, msg):
+        pass
+
+
+def parser(window_size, window_overlap):
+    observables = [
+        Observable(
+            name="SHA1",
+            detection_option="library",
+            stix_target="File.hashes.SHA-1",
+        ),
+        Observable(
+            name="SHA256",
+            detection_option="library",
+            stix_target="File.hashes.SHA-256",
+        ),
+        Observable(
+            name="Domain",
+            detection_option="library",
+            stix_target="Domain-Name.value",
+        ),
+    ]
+    report_parser = ReportParser(FakeHelper(), [], observables)
+    report_parser.text_window_size = window_size
+    report_parser.text_window_overlap = window_overlap
+    return report_parser
+
+
+def parse_text(report_parser, text):
+    results = report_parser._parse_text(io.BytesIO(text.encode("utf-8")))
+    return sorted(match[RESULT_FORMAT_MATCH] for match in results.values())
+
+
+def test_ioc_straddling_the_window_step():
+    report_parser = parser(128, 96)
+    step = report_parser.text_window_size - report_parser.text_window_overlap
+
+    # Both observables start before the step and end after it
+    text = "x" * (step - 10) + " " + SHA256 + " "
+    text += "y" * (step - 10) + " " + DOMAIN + " "
+    text += "z" * 300
+
+    assert parse_text(report_parser, text) == sorted([SHA256, DOMAIN])
+
+
+def test_ioc_in_every_window():
+    report_parser = parser(128, 96)
+    iocs = [f"host{index}.evil-domain.com" for index in range(20)]
+
+    assert parse_text(report_parser, " ".join(iocs)) == sorted(iocs)
@@ -3,12 +3,22 @@
 ################################
 import datetime
 import os
+import time
 import yaml
 import json
 import sys
 
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from queue import Empty, Queue
+from threading import Thread
 from pycti import OpenCTIConnectorHelper, get_config_variable, StixMetaTypes
+from pycti.connector.opencti_connector_helper import ListenStream
 from dateutil import parser
+from segments import DEFAULT_SEGMENT_MAX_SIZE, SegmentWriter
+
+MAX_BACKOFF = 60
+DOWNLOAD_ATTEMPTS = 5
 
 
 def round_time(dt, round_to=60):
@@ -17,6 +27,202 @@ def round_time(dt, round_to=60):
     return dt + datetime.timedelta(0, rounding - seconds, -dt.microsecond)
 
 
+class BackupWriter(Thread):
+    """
+    Writer of the backup segments, fed by the live stream callback
+
+    Events are queued in stream order with the download of their attachments,
+    which runs in a thread pool and is retried with a backoff. This thread
+    writes the records in the same order once their attachments are downloaded,
+    or with the error of the last attempt, and writes them to the disk
+    every `fsync_interval` seconds. The live stream state received after an
+    event is only handed to the helper once its record is on the disk. After
+    a write error, the writers are reopened and the records since the last
+    sync are written again, with a backoff.
+    """
+
+    def __init__(
+        self,
+        helper,
+        backup_path,
+        download_workers,
+        queue_size,
+        fsync_interval,
+        segment_max_size,
+        max_open_directories=64,
+    ):
+        super(BackupWriter, self).__init__()
+        self.daemon = True
+        self.helper = helper
+        self.path = backup_path + "/opencti_data"
+        self.fsync_interval = float(fsync_interval)
+        self.segment_max_size = int(segment_max_size)
+        self.max_open_directories = max_open_directories
+
+        self.downloads = ThreadPoolExecutor(max_workers=int(download_workers))
+        # Bounded so that the live stream waits for the writes
+        self.queue = Queue(maxsize=int(queue_size))
+        # Directory name -> writer, least recently used first
+        self.writers = OrderedDict()
+        # Last stream state received and last one written after its records
+        self._state = None
+        self._written_state = None
+        self._last_sync = time.monotonic()
+        # Items processed since the last sync, written again after an error
+        self._unsynced = []
+
+    def write(self, date_range, entity_id, bundle, enrich):
+        download = self.downloads.submit(
+            self._download, entity_id, enrich, bundle["objects"][0]
+        )
+        self.queue.put(("write", date_range, entity_id, bundle, download))
+
+    def _download(self, entity_id, enrich, entity):
+        """Add the files to the entity, returns the error of the last attempt"""
+        backoff = 1
+        for attempt in range(1, DOWNLOAD_ATTEMPTS + 1):
+            try:
+                enrich(entity)
+                return None
+            except Exception as e:
+                if attempt == DOWNLOAD_ATTEMPTS:
+                    # The record is written without the files, with the error
+                    entity.pop("x_opencti_files", None)
+                    self.helper.log_error(
+                        "Unable to download the files of " + entity_id + ": " + str(e)
+                    )
+                    return str(e)
+                self.helper.log_warning(
+                    "Unable to download the files of "
+                    + entity_id
+                    + ", retrying in "
+                    + str(backoff)
+                    + "s: "
+                    + str(e)
+                )
+                time.sleep(backoff)
+                backoff = min(backoff * 2, MAX_BACKOFF)
+
+    def delete(self, date_range, entity_id):
+        self.queue.put(("delete", date_range, entity_id, None, None))
+
+    def get_state(self):
+        if self._state is not None:
+            return dict(self._state)
+        return self.helper.get_state()
+
+    def set_state(self, state):
+        self._state = dict(state)
+        self.queue.put(("state", None, None, dict(state), None))
+
+    def _get_writer(self, date_range):
+        writer = self.writers.get(date_range)
+        if writer is not None:
+            self.writers.move_to_end(date_range)
+            return writer
+        if len(self.writers) >= self.max_open_directories:
+            _, evicted = self.writers.popitem(last=False)
+            evicted.close()
+        writer = SegmentWriter(self.path + "/" + date_range, self.segment_max_size)
+        self.writers[date_range] = writer
+        return writer
+
+    def _process(self, item):
+        action, date_range, entity_id, data, download = item
+        if action == "state":
+            self._written_state = data
+        elif action == "write":
+            self._get_writer(date_range).write(
+                entity_id, data, files_error=download.result()
+            )
+            self._remove_file(date_range, entity_id)
+        elif action == "delete":
+            self._get_writer(date_range).delete(entity_id)
+            self._remove_file(date_range, entity_id)
+
+    def _remove_file(self, date_range, entity_id):
+        # File of the entity written before the upgrade to the segments, the
+        # record appended to the segment replaces it
+        try:
+            os.unlink(self.path + "/" + date_range + "/" + entity_id + ".json")
+        except FileNotFoundError:
+            pass
+
+    def sync(self):
+        for writer in self.writers.values():
+            writer.sync()
+        self._unsynced = []
+        self._last_sync = time.monotonic()
+        if self._written_state is not None:
+            self.helper.set_state(self._written_state)
+            self._written_state = None
+
+    def _close_writers(self):
+        # Reopened writers cut the records left incomplete by the error
+        for writer in self.writers.values():
+            try:
+                writer.close()
+            except OSError:
+                pass
+        self.writers = OrderedDict()
+
+    def _step(self):
+        timeout = self._last_sync + self.fsync_interval - time.monotonic()
+        try:
+            item = self.queue.get(timeout=max(timeout, 0))
+            self._unsynced.append(item)
+            self._process(item)
+        except Empty:
+            pass
+        if time.monotonic() - self._last_sync >= self.fsync_interval:
+            self.sync()
+
+    def run(self):
+        backoff = 1
+        replay = False
+        while True:
+            try:
+                if replay:
+                    # The stream state only moves past these items once synced
+                    for item in self._unsynced:
+                        self._process(item)
+                    replay = False
+                self._step()
+                backoff = 1
+            except Exception as e:
+                self.helper.log_error(
+                    "Unable to write the backup, retrying in "
+                    + str(backoff)
+                    + "s: "
+                    + str(e)
+                )
+                self._close_writers()
+                time.sleep(backoff)
+                backoff = min(backoff * 2, MAX_BACKOFF)
+                replay = True
+
+
+class CheckpointHelper:
+    """
+    Helper of the live stream listener whose position follows the disk: the
+    state saved after an event is queued behind its record, and the
+    BackupWriter commits it after the fsync of the segments.
+    """
+
+    def __init__(self, helper, writer):
+        self.helper = helper
+        self.writer = writer
+
+    def __getattr__(self, name):
+        return getattr(self.helper, name)
+
+    def get_state(self):
+        return self.writer.get_state()
+
+    def set_state(self, state):
+        self.writer.set_state(state)
+
+
 class BackupFilesConnector:
     def __init__(self, conf_data):
         config_file_path = os.path.dirname(os.path.abspath(__file__)) + "/config.yml"
@@ -33,6 +239,30 @@ class BackupFilesConnector:
         self.backup_path = get_config_variable(
             "BACKUP_PATH", ["backup", "path"], config
         )
+        self.writer = BackupWriter(
+            self.helper,
+            self.backup_path,
+            get_config_variable(
+                "BACKUP_DOWNLOAD_WORKERS",
+                ["backup", "download_workers"],
+                config,
+                True,
+                4,
+            ),
+            get_config_variable(
+                "BACKUP_QUEUE_SIZE", ["backup", "queue_size"], config, True, 1000
+            ),
+            get_config_variable(
+                "BACKUP_FSYNC_INTERVAL", ["backup", "fsync_interval"], config, True, 1
+            ),
+            get_config_variable(
+                "BACKUP_SEGMENT_MAX_SIZE",
+                ["backup", "segment_max_size"],
+                config,
+                True,
+                DEFAULT_SEGMENT_MAX_SIZE,
+            ),
+        )
 
     def _enrich_with_files(self, current):
         entity = current
@@ -65,45 +295,24 @@ class BackupFilesConnector:
                 )
         return entity
 
-    def write_files(self, date_range, entity_id, bundle):
-        path = self.backup_path + "/opencti_data"
-        if not os.path.exists(path + "/" + date_range):
-            os.mkdir(path + "/" + date_range)
-        path = path + "/" + date_range
-        with open(path + "/" + entity_id + ".json", "w") as file:
-            json.dump(bundle, file, indent=4)
-
-    def delete_file(self, date_range, entity_id):
-        path = self.backup_path + "/opencti_data/" + date_range
-        if not os.path.exists(path):
-            return
-        if os.path.isfile(path + "/" + entity_id + ".json"):
-            os.unlink(path + "/" + entity_id + ".json")
-
     def _process_message(self, msg):
         if msg.event == "create" or msg.event == "update" or msg.event == "delete":
             data = json.loads(msg.data)
             created_at = parser.parse(data["data"]["created_at"])
             date_range = round_time(created_at).strftime("%Y%m%dT%H%M%SZ")
-            if msg.event == "create":
+            if msg.event == "create" or msg.event == "update":
                 bundle = {
                     "type": "bundle",
                     "x_opencti_event_version": data["version"],
                     "objects": [data["data"]],
                 }
-                data["data"] = self._enrich_with_files(data["data"])
-                self.write_files(date_range, data["data"]["id"], bundle)
-            elif msg.event == "update":
-                bundle = {
-                    "type": "bundle",
-                    "x_opencti_event_version": data["version"],
-                    "objects": [data["data"]],
-                }
-                data["data"] = self._enrich_with_files(data["data"])
-                self.write_files(date_range, data["data"]["id"], bundle)
+                # The files are added to the entity by the download pool
+                self.writer.write(
+                    date_range, data["data"]["id"], bundle, self._enrich_with_files
+                )
             elif msg.event == "delete":
-                self.delete_file(date_range, data["data"]["id"])
-            self.helper.log_info(
+                self.writer.delete(date_range, data["data"]["id"])
+            self.helper.log_debug(
                 "Backup processed event "
                 + msg.id
                 + " in "
@@ -118,7 +327,16 @@ class BackupFilesConnector:
             raise ValueError("Backup path does not exist")
         if not os.path.exists(self.backup_path + "/opencti_data"):
             os.mkdir(self.backup_path + "/opencti_data")
-        self.helper.listen_stream(self._process_message)
+        self.writer.start()
+        ListenStream(
+            CheckpointHelper(self.helper, self.writer),
+            self._process_message,
+            None,
+            None,
+            None,
+            None,
+            None,
+        ).start()
 
 
 if __name__ == "__main__":
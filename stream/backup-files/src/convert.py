@@ -0,0 +1,60 @@
+################################
+# OpenCTI Backup Converter     #
+################################
+#
+# Converts a backup written with one JSON file per entity to the segments:
+#
+#   python3 convert.py <backup path>
+#
+# The files of a directory are only removed once its segment is written to
+# the disk, so an interrupted conversion can be run again. The files of the
+# entities already written to the segments, by the connector or by a previous
+# conversion, are outdated and only removed.
+import json
+import os
+import sys
+
+from segments import SegmentWriter, read_index
+
+
+def convert_directory(directory):
+    names = sorted(
+        entry.name
+        for entry in os.scandir(directory)
+        if entry.is_file() and entry.name.endswith(".json")
+    )
+    if len(names) == 0:
+        return 0
+    indexed = read_index(directory, keep_deleted=True)
+    converted = [name for name in names if name[: -len(".json")] not in indexed]
+    if len(converted) > 0:
+        writer = SegmentWriter(directory)
+        for name in converted:
+            with open(os.path.join(directory, name)) as file:
+                bundle = json.load(file)
+            writer.write(name[: -len(".json")], bundle)
+        writer.close()
+    for name in names:
+        os.unlink(os.path.join(directory, name))
+    return len(converted)
+
+
+def convert(backup_path):
+    path = os.path.join(backup_path, "opencti_data")
+    if not os.path.exists(path):
+        raise ValueError("Backup path does not exist")
+    total = 0
+    for entry in sorted(os.scandir(path), key=lambda d: d.name):
+        if entry.is_dir():
+            count = convert_directory(entry.path)
+            total += count
+            if count > 0:
+                print("Converted " + str(count) + " files of " + entry.name)
+    print("Converted " + str(total) + " files")
+
+
+if __name__ == "__main__":
+    if len(sys.argv) != 2:
+        print("Usage: python3 convert.py <backup path>")
+        sys.exit(1)
+    convert(sys.argv[1])
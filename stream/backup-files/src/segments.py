@@ -0,0 +1,231 @@
+################################
+# OpenCTI Backup Segments      #
+################################
+#
+# Each backup directory (one per rounded minute of creation) holds append-only
+# segments of gzip compressed JSON lines, one gzip member per record so that a
+# record can be read from its offset, and an index of the records.
+#
+#   opencti_data/20220101T000000Z/segment-000001.jsonl.gz
+#   opencti_data/20220101T000000Z/index.tsv
+#
+# A record is either {"id": ..., "bundle": {...}} for the last version of an
+# entity, or {"id": ..., "deleted": true} once the entity is deleted. The record
+# of an entity whose files could not be downloaded also holds a "files_error"
+# with the error, so that they can be fetched again. Each line
+# of the index gives the segment and the offset of a record of an entity, the
+# last line of an entity is its current record (offset -1 once deleted).
+import gzip
+import json
+import os
+import zlib
+
+SEGMENT_PREFIX = "segment-"
+SEGMENT_SUFFIX = ".jsonl.gz"
+INDEX_NAME = "index.tsv"
+DEFAULT_SEGMENT_MAX_SIZE = 64 * 1024 * 1024
+READ_CHUNK_SIZE = 64 * 1024
+
+
+def segment_name(number):
+    return SEGMENT_PREFIX + str(number).zfill(6) + SEGMENT_SUFFIX
+
+
+def list_segments(directory):
+    return sorted(
+        name
+        for name in os.listdir(directory)
+        if name.startswith(SEGMENT_PREFIX) and name.endswith(SEGMENT_SUFFIX)
+    )
+
+
+def encode_record(record):
+    return gzip.compress((json.dumps(record) + "\n").encode("utf-8"), mtime=0)
+
+
+def decode_member(file):
+    """Decompress the gzip member starting at the current position of a file"""
+    decompressor = zlib.decompressobj(wbits=31)
+    data = b""
+    while not decompressor.eof:
+        chunk = file.read(READ_CHUNK_SIZE)
+        if len(chunk) == 0:
+            # Member interrupted while writing
+            return None
+        try:
+            data += decompressor.decompress(chunk)
+        except zlib.error:
+            # Member corrupted by a crash while writing
+            return None
+    file.seek(-len(decompressor.unused_data), os.SEEK_CUR)
+    return data
+
+
+def read_record(path, offset):
+    with open(path, "rb") as file:
+        file.seek(offset)
+        data = decode_member(file)
+    return json.loads(data) if data is not None else None
+
+
+def iter_records(path):
+    """
+    Yield the offset and the content of the records of a segment, up to the
+    first incomplete or corrupted one
+    """
+    with open(path, "rb") as file:
+        while True:
+            offset = file.tell()
+            data = decode_member(file)
+            if data is None:
+                return
+            yield offset, json.loads(data)
+
+
+def read_index(directory, keep_deleted=False):
+    """
+    Return the current (segment, offset) of the entities of a directory, the
+    deleted entities are kept with an offset of -1 if `keep_deleted`
+    """
+    index = {}
+    path = os.path.join(directory, INDEX_NAME)
+    if not os.path.isfile(path):
+        return index
+    with open(path, encoding="utf-8") as file:
+        for line in file:
+            parts = line.rstrip("\n").split("\t")
+            if len(parts) != 3:
+                # Line interrupted while writing
+                continue
+            entity_id, segment, offset = parts
+            if int(offset) < 0 and not keep_deleted:
+                index.pop(entity_id, None)
+            else:
+                index[entity_id] = (segment, int(offset))
+    return index
+
+
+def read_directory(directory):
+    """Return the bundles of the entities of a directory, in write order"""
+    bundles = {}
+    for segment in list_segments(directory):
+        for _, record in iter_records(os.path.join(directory, segment)):
+            # Keep the order of the first write, with the last version
+            if record.get("deleted", False):
+                bundles.pop(record["id"], None)
+            else:
+                bundles[record["id"]] = record["bundle"]
+    return list(bundles.values())
+
+
+class SegmentWriter:
+    """Append-only writer of the segments and the index of a directory"""
+
+    def __init__(self, directory, segment_max_size=DEFAULT_SEGMENT_MAX_SIZE):
+        self.directory = directory
+        self.segment_max_size = segment_max_size
+        if not os.path.exists(directory):
+            os.mkdir(directory)
+
+        segments = list_segments(directory)
+        self.number = (
+            int(segments[-1][len(SEGMENT_PREFIX) : -len(SEGMENT_SUFFIX)])
+            if len(segments) > 0
+            else 1
+        )
+        self.segment = None
+        self._repair()
+        self.index = open(os.path.join(directory, INDEX_NAME), "a", encoding="utf-8")
+        self.dirty = False
+        self._open_segment()
+
+    def _repair(self):
+        """
+        Cut the record and the index lines left incomplete at the end of the last
+        segment by a crash between two syncs, so that records are appended after
+        the last complete one
+        """
+        name = segment_name(self.number)
+        path = os.path.join(self.directory, name)
+        if not os.path.isfile(path):
+            return
+        end = 0
+        with open(path, "rb") as file:
+            while decode_member(file) is not None:
+                end = file.tell()
+        truncated = end < os.path.getsize(path)
+        if truncated:
+            with open(path, "r+b") as file:
+                file.truncate(end)
+                os.fsync(file.fileno())
+
+        index_path = os.path.join(self.directory, INDEX_NAME)
+        if not os.path.isfile(index_path) or os.path.getsize(index_path) == 0:
+            return
+        with open(index_path, "rb") as index:
+            index.seek(-1, os.SEEK_END)
+            if not truncated and index.read(1) == b"\n":
+                return
+            index.seek(0)
+            lines = index.readlines()
+
+        def is_complete(line):
+            parts = line.decode("utf-8", "replace").rstrip("\n").split("\t")
+            if not line.endswith(b"\n") or len(parts) != 3:
+                return False
+            # Records cut from the segment above
+            return parts[1] != name or int(parts[2]) < end
+
+        with open(index_path + ".tmp", "wb") as index:
+            index.writelines(line for line in lines if is_complete(line))
+            index.flush()
+            os.fsync(index.fileno())
+        os.replace(index_path + ".tmp", index_path)
+
+    def _open_segment(self):
+        if self.segment is not None:
+            self.segment.flush()
+            os.fsync(self.segment.fileno())
+            self.segment.close()
+        self.segment = open(
+            os.path.join(self.directory, segment_name(self.number)), "ab"
+        )
+
+    def _append(self, entity_id, record):
+        if self.segment.tell() >= self.segment_max_size:
+            self.number += 1
+            self._open_segment()
+        offset = self.segment.tell()
+        if record is not None:
+            self.segment.write(encode_record(record))
+        else:
+            offset = -1
+            self.segment.write(encode_record({"id": entity_id, "deleted": True}))
+        self.index.write(
+            entity_id + "\t" + segment_name(self.number) + "\t" + str(offset) + "\n"
+        )
+        self.dirty = True
+
+    def write(self, entity_id, bundle, files_error=None):
+        record = {"id": entity_id, "bundle": bundle}
+        if files_error is not None:
+            record["files_error"] = files_error
+        self._append(entity_id, record)
+
+    def delete(self, entity_id):
+        self._append(entity_id, None)
+
+    def sync(self):
+        """Write the appended records to the disk"""
+        if not self.dirty:
+            return
+        self.segment.flush()
+        os.fsync(self.segment.fileno())
+        self.index.flush()
+        os.fsync(self.index.fileno())
+        self.dirty = False
+
+    def close(self):
+        self.sync()
+        self.segment.close()
+        self.index.close()
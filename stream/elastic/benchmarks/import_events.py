@@ -0,0 +1,212 @@
+"""
+Benchmark of the import of live stream indicator events in ecs mode
+
+Serves synthetic indicators from a local mock of the OpenCTI API with a
+simulated response time and compares the 'api' entity source, which reads
+every indicator, with the 'stream' one, which builds the documents from the
+stream payload and reads the missing fields in batches. Both must produce the
+same documents.
+
+Usage: PYTHONPATH=. python benchmarks/import_events.py [events] [response time]
+"""
+
+import json
+import random
+import sys
+import time
+from datetime import datetime, timezone
+from threading import Event
+
+from elasticsearch import Elasticsearch
+from pycti import OpenCTIApiClient
+
+from elastic.bulk_writer import BulkWriter
+from elastic.import_manager import IntelManager
+
+RESPONSE_TIME = 0.005
+
+
+def random_uuid(rng: random.Random) -> str:
+    return "00000000-0000-4000-8000-" + "".join(
+        rng.choice("0123456789abcdef") for _ in range(12)
+    )
+
+
+class BenchmarkApi:
+    process_multiple_fields = OpenCTIApiClient.process_multiple_fields
+    process_multiple = OpenCTIApiClient.process_multiple
+    process_multiple_ids = OpenCTIApiClient.process_multiple_ids
+
+    def __init__(self, entities: dict) -> None:
+        self.entities = entities
+        self.requests = 0
+        self.indicator = self
+
+    def read(self, id: str) -> dict:
+        self.requests += 1
+        time.sleep(RESPONSE_TIME)
+        return json.loads(json.dumps(self.entities[id]))
+
+    def query(self, query: str, variables: dict) -> dict:
+        self.requests += 1
+        time.sleep(RESPONSE_TIME)
+        data = {}
+        for name, _id in variables.items():
+            entity = self.entities[_id]
+            data[f"i{name[2:]}"] = {
+                "id": _id,
+                "createdBy": entity["createdBy"],
+                "objectMarking": {
+                    "edges": [{"node": mark} for mark in entity["objectMarking"]]
+                },
+                "killChainPhases": {
+                    "edges": [{"node": phase} for phase in entity["killChainPhases"]]
+                },
+            }
+        return json.loads(json.dumps({"data": data}))
+
+
+class BenchmarkHelper:
+    def __init__(self, api: BenchmarkApi) -> None:
+        self.api = api
+
+
+def build_elasticsearch(documents: list) -> Elasticsearch:
+    client = Elasticsearch()
+
+    def bulk(body, *args, **kwargs):
+        lines = body.splitlines()
+        items = []
+        for action, source in zip(lines[0::2], lines[1::2]):
+            _id = json.loads(action)["index"]["_id"]
+            documents.append((_id, json.loads(source)))
+            items.append({"index": {"_id": _id, "status": 201}})
+        return {"errors": False, "items": items}
+
+    client.bulk = bulk
+    return client
+
+
+def build_indicators(rng: random.Random, count: int) -> list:
+    markings = [
+        {
+            "id": f"marking-{tlp}",
+            "standard_id": f"marking-definition--{random_uuid(rng)}",
+            "definition_type": "TLP",
+            "definition": f"TLP:{tlp}",
+        }
+        for tlp in ["WHITE", "GREEN", "AMBER", "RED"]
+    ]
+    authors = [
+        {
+            "id": f"author-{number}",
+            "standard_id": f"identity--{random_uuid(rng)}",
+            "name": f"Author {number}",
+        }
+        for number in range(20)
+    ]
+    phases = [
+        {
+            "id": f"phase-{order}",
+            "kill_chain_name": "mitre-attack",
+            "phase_name": name,
+            "x_opencti_order": order,
+        }
+        for order, name in enumerate(["execution", "persistence", "discovery"])
+    ]
+
+    indicators = []
+    for number in range(count):
+        value = f"10.{number // 65536 % 256}.{number // 256 % 256}.{number % 256}"
+        entity = {
+            "id": f"indicator-{number}",
+            "standard_id": f"indicator--{random_uuid(rng)}",
+            "pattern": f"[ipv4-addr:value = '{value}']",
+            "pattern_type": "stix",
+            "valid_from": "2022-01-01T00:00:00.000Z",
+            "valid_until": "2023-01-01T00:00:00.000Z",
+            "x_opencti_detection": True,
+            "x_opencti_score": rng.randint(0, 100),
+            "confidence": rng.randint(0, 100),
+            "revoked": False,
+            "description": f"Indicator {number}",
+            "created_at": "2022-01-01T00:00:00.000Z",
+            "updated_at": "2022-01-01T00:00:00.000Z",
+            "externalReferences": [],
+            "objectMarking": [rng.choice(markings)],
+            "createdBy": rng.choice(authors),
+            "killChainPhases": rng.sample(phases, rng.randint(0, 2)),
+        }
+        payload = {
+            "id": entity["standard_id"],
+            "x_opencti_id": entity["id"],
+            "type": "indicator",
+            "pattern": entity["pattern"],
+            "pattern_type": entity["pattern_type"],
+            "valid_from": entity["valid_from"],
+            "valid_until": entity["valid_until"],
+            "x_opencti_detection": entity["x_opencti_detection"],
+            "x_opencti_score": entity["x_opencti_score"],
+            "confidence": entity["confidence"],
+            "revoked": entity["revoked"],
+            "description": entity["description"],
+            "created": entity["created_at"],
+            "modified": entity["updated_at"],
+            "object_marking_refs": [m["standard_id"] for m in entity["objectMarking"]],
+            "created_by_ref": entity["createdBy"]["standard_id"],
+            "kill_chain_phases": [
+                {"kill_chain_name": p["kill_chain_name"], "phase_name": p["phase_name"]}
+                for p in entity["killChainPhases"]
+            ],
+        }
+        indicators.append((entity, payload))
+    return indicators
+
+
+def run(entity_source: str, indicators: list) -> tuple:
+    IntelManager._setup_elasticsearch_index = lambda self: None
+
+    documents = []
+    api = BenchmarkApi({entity["id"]: entity for entity, _ in indicators})
+    writer = BulkWriter(build_elasticsearch(documents), Event())
+    config = {
+        "connector": {"entity_source": entity_source, "read_batch_size": 100},
+        "output": {"elasticsearch": {"index": "opencti"}},
+        "setup": {"template": {"pattern": "opencti-*"}},
+    }
+    manager = IntelManager(BenchmarkHelper(api), None, config, None, writer)
+
+    timestamp = datetime(2022, 1, 2, tzinfo=timezone.utc)
+    start = time.perf_counter()
+    for _, payload in indicators:
+        manager.import_cti_event(timestamp, dict(payload))
+    writer.flush()
+    duration = time.perf_counter() - start
+
+    for _, document in documents:
+        del document["event"]["created"]
+    return duration, api.requests, documents
+
+
+def main() -> None:
+    global RESPONSE_TIME
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+    if len(sys.argv) > 2:
+        RESPONSE_TIME = float(sys.argv[2])
+
+    indicators = build_indicators(random.Random(42), count)
+    results = {}
+    for entity_source in ["api", "stream"]:
+        duration, requests, documents = run(entity_source, indicators)
+        results[entity_source] = documents
+        print(
+            f"{entity_source:>6}: {count} events in {duration:.2f}s "
+            f"({count / duration:.0f} events/s, {requests} API requests)"
+        )
+
+    assert results["api"] == results["stream"], "Documents differ"
+    print("Documents are identical")
+
+
+if __name__ == "__main__":
+    main()
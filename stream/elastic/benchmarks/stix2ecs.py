@@ -0,0 +1,89 @@
+"""
+Micro-benchmark of the translation of STIX patterns to ECS indicators
+
+Times StixIndicator.parse_pattern and get_ecs_indicator for a pattern of each
+object type handled by stix2ecs, with the parser of single comparisons (and
+its template cache) and with the full ANTLR parser only. Both must give the
+same ECS indicator, or both raise NotImplementedError for the object types
+not translated yet.
+
+Usage: PYTHONPATH=. python benchmarks/stix2ecs.py [iterations]
+"""
+
+import sys
+import time
+
+from stix2patterns.pattern import Pattern
+
+from elastic import stix2ecs
+from elastic.stix2ecs import INDICATOR_TYPES, StixIndicator
+
+PATTERNS = {
+    "artifact": "[artifact:hashes.'SHA-256' = 'cead3f77f6cda6ec00f57d76c9a6879f']",
+    "autonomous-system": "[autonomous-system:number = 12345]",
+    "directory": "[directory:path = '/tmp']",
+    "domain-name": "[domain-name:value = 'www.5z8.info']",
+    "email-addr": "[email-addr:value = 'jdoe@example.com']",
+    "email-message": "[email-message:subject = 'Invoice']",
+    "mime-part-type": "[mime-part-type:content_type = 'text/html']",
+    "file": "[file:hashes.MD5 = 'e8d77d19e1c6f462f4a5bf6fbe673a3c']",
+    "ipv4-addr": "[ipv4-addr:value = '198.51.100.1']",
+    "ipv6-addr": "[ipv6-addr:value = '2001:0db8::/96']",
+    "mac-addr": "[mac-addr:value = 'd2:fb:49:24:37:18']",
+    "mutex": "[mutex:name = 'Global\\\\evil']",
+    "network-traffic": "[network-traffic:dst_ref.value = '203.0.113.33/32']",
+    "process": "[process:command_line MATCHES '-add GlobalSign.cer -c -s -r Root']",
+    "software": "[software:name = 'Word']",
+    "url": "[url:value = 'http://example.com/malware']",
+    "user-account": "[user-account:user_id = 'jdoe']",
+    "windows-registry-key": "[windows-registry-key:key = 'HKEY_LOCAL_MACHINE']",
+    "win-registry-key": "[win-registry-key:key = 'HKEY_LOCAL_MACHINE']",
+    "x509-certificate": "[x509-certificate:serial_number = '36:f7:d4:32']",
+    "x-opencti-hostname": "[x-opencti-hostname:value = 'jon-steak.duckdns.org']",
+}
+
+
+def full_parser(pattern: str) -> dict:
+    return Pattern(pattern).inspect().comparisons
+
+
+def translate(pattern: str):
+    try:
+        return [
+            item.get_ecs_indicator() for item in StixIndicator.parse_pattern(pattern)
+        ]
+    except NotImplementedError:
+        return NotImplementedError
+
+
+def measure(pattern: str, iterations: int) -> tuple:
+    start = time.perf_counter()
+    for _ in range(iterations):
+        result = translate(pattern)
+    return (time.perf_counter() - start) / iterations, result
+
+
+def main() -> None:
+    iterations = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+    assert set(PATTERNS) == set(INDICATOR_TYPES)
+
+    fast_path = stix2ecs.inspect_pattern
+    print(f"{'object type':>22} {'ANTLR':>10} {'fast path':>10} {'speedup':>8}")
+    for typename, pattern in PATTERNS.items():
+        stix2ecs.inspect_pattern = full_parser
+        antlr_time, antlr_result = measure(pattern, iterations)
+        stix2ecs.inspect_pattern = fast_path
+        fast_time, fast_result = measure(pattern, iterations)
+
+        assert antlr_result == fast_result, f"{typename}: results differ"
+        print(
+            f"{typename:>22} {antlr_time * 1e6:>8.1f}us {fast_time * 1e6:>8.1f}us "
+            f"{antlr_time / fast_time:>7.1f}x"
+            + (" (not translated)" if fast_result is NotImplementedError else "")
+        )
+
+    print(f"Template cache: {stix2ecs.parse_template.cache_info()}")
+
+
+if __name__ == "__main__":
+    main()
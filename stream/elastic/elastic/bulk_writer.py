@@ -0,0 +1,333 @@
+import time
+from collections import OrderedDict
+from logging import getLogger
+from threading import Event, RLock, Thread
+
+from elasticsearch import Elasticsearch, TransportError
+from elasticsearch.helpers import streaming_bulk
+from pycti import OpenCTIConnectorHelper
+
+from . import LOGGER_NAME
+
+logger = getLogger(LOGGER_NAME)
+
+DEFAULT_BULK_MAX_SIZE = 500
+DEFAULT_BULK_MAX_BYTES = 10 * 1024 * 1024
+DEFAULT_FLUSH_INTERVAL = 5.0
+DEFAULT_MAX_RETRIES = 3
+DEFAULT_ROUTING_CACHE_SIZE = 100000
+MAX_BACKOFF = 60
+
+
+class BulkWriter(Thread):
+    """
+    Buffered writer of the documents sent to Elasticsearch with the `_bulk` API
+
+    The buffer is flushed once `max_size` actions are waiting, and every
+    `flush_interval` seconds by this thread. A full buffer is flushed by the
+    thread adding the action, so a slow or unavailable cluster blocks the live
+    stream callback instead of growing the buffer.
+
+    The live stream state is routed through `get_state`/`set_state` (see
+    `CheckpointHelper`) and only handed to the OpenCTI helper once every action
+    received before it has been acknowledged by Elasticsearch.
+    """
+
+    def __init__(
+        self,
+        elasticsearch_client: Elasticsearch,
+        shutdown_event: Event,
+        helper: OpenCTIConnectorHelper = None,
+        max_size: int = DEFAULT_BULK_MAX_SIZE,
+        max_bytes: int = DEFAULT_BULK_MAX_BYTES,
+        flush_interval: float = DEFAULT_FLUSH_INTERVAL,
+        max_retries: int = DEFAULT_MAX_RETRIES,
+        routing_cache_size: int = DEFAULT_ROUTING_CACHE_SIZE,
+    ) -> None:
+        super(BulkWriter, self).__init__()
+        self.daemon = True
+        self.es_client: Elasticsearch = elasticsearch_client
+        self.shutdown_event: Event = shutdown_event
+        self.helper: OpenCTIConnectorHelper = helper
+        self.max_size: int = max(int(max_size), 1)
+        self.max_bytes: int = int(max_bytes)
+        self.flush_interval: float = float(flush_interval)
+        self.max_retries: int = int(max_retries)
+        self.routing_cache_size: int = int(routing_cache_size)
+
+        self.lock: RLock = RLock()
+        self._actions: list[dict] = []
+        self._sources: list = []
+        self._flushing: bool = False
+        # Document id -> last buffered action of the document
+        self._pending: dict[str, dict] = {}
+        # Document id -> concrete index holding it, most recently used last
+        self._routing: OrderedDict[str, str] = OrderedDict()
+        # Last stream state received and last one handed to the helper
+        self._state: dict = None
+        self._committed_state: dict = None
+        self._last_flush: float = time.monotonic()
+
+        self.indexed: int = 0
+        self.failed: int = 0
+
+    def index(self, index: str, id: str, document: dict) -> None:
+        """Buffer a document to be indexed, flushing the buffer if it is full"""
+        self.add({"_op_type": "index", "_index": index, "_id": id, "_source": document})
+
+    def update(self, index: str, id: str, script: dict) -> None:
+        """Buffer a scripted update of a document in its concrete index"""
+        self.add(
+            {
+                "_op_type": "update",
+                "_index": index,
+                "_id": id,
+                "script": script,
+                "retry_on_conflict": 3,
+            }
+        )
+
+    def add(self, action: dict) -> None:
+        with self.lock:
+            self._actions.append(action)
+            if action.get("_id", None) is not None:
+                self._pending[action["_id"]] = action
+
+            if len(self._actions) >= self.max_size and not self._flushing:
+                self._flush_until_acknowledged()
+
+    def add_deferred_source(self, source) -> None:
+        """
+        Register an object holding events whose documents are not built yet,
+        with `deferred_count()` and `import_deferred()` methods. Its events are
+        imported before each flush and hold the state back like buffered actions.
+        """
+        self._sources.append(source)
+
+    def _deferred_count(self) -> int:
+        return sum(source.deferred_count() for source in self._sources)
+
+    def get_pending(self, id: str) -> dict:
+        """Return the last buffered action of a document, if not yet sent"""
+        with self.lock:
+            return self._pending.get(id, None)
+
+    def discard(self, id: str) -> None:
+        """
+        Drop the buffered actions of a document, so that they cannot write it
+        back once it is deleted
+        """
+        with self.lock:
+            if self._pending.pop(id, None) is not None:
+                self._actions = [
+                    action for action in self._actions if action.get("_id") != id
+                ]
+
+    def get_routing(self, id: str) -> str:
+        """
+        Return the index of a document, as acknowledged by Elasticsearch for
+        the last write of the document, or as buffered
+        """
+        with self.lock:
+            if id in self._pending:
+                return self._pending[id]["_index"]
+
+            _index: str = self._routing.get(id, None)
+            if _index is not None:
+                self._routing.move_to_end(id)
+            return _index
+
+    def set_routing(self, id: str, index: str) -> None:
+        if self.routing_cache_size <= 0:
+            return
+
+        with self.lock:
+            self._routing[id] = index
+            self._routing.move_to_end(id)
+            if len(self._routing) > self.routing_cache_size:
+                self._routing.popitem(last=False)
+
+    def discard_routing(self, id: str) -> None:
+        with self.lock:
+            self._routing.pop(id, None)
+
+    def get_state(self) -> dict:
+        with self.lock:
+            if self._state is not None:
+                return dict(self._state)
+
+        if self.helper is not None:
+            return self.helper.get_state()
+        return None
+
+    def set_state(self, state: dict) -> None:
+        with self.lock:
+            self._state = dict(state)
+            if len(self._actions) == 0 and self._deferred_count() == 0:
+                # Nothing is waiting, the state is acknowledged already
+                self._commit_state()
+
+    def flush(self) -> bool:
+        """
+        Send the buffered actions, returns False if the request failed or some
+        actions have to be retried. In that case these actions stay buffered
+        and the state is not committed.
+        """
+        with self.lock:
+            self._last_flush = time.monotonic()
+
+            self._flushing = True
+            try:
+                for source in self._sources:
+                    if source.deferred_count() > 0:
+                        source.import_deferred()
+            except Exception as err:
+                logger.error(f"Unable to import the deferred events: {err}")
+                return False
+            finally:
+                self._flushing = False
+
+            if len(self._actions) > 0:
+                retries = self._send(self._actions)
+                if retries is None:
+                    return False
+                self._actions = [
+                    action
+                    for action in self._actions
+                    if (action.get("_id"), action.get("_op_type", "index")) in retries
+                ]
+                self._pending = {
+                    action["_id"]: action
+                    for action in self._actions
+                    if action.get("_id") is not None
+                }
+                if len(self._actions) > 0:
+                    return False
+
+            self._commit_state()
+            return True
+
+    def _flush_until_acknowledged(self) -> None:
+        backoff = 1
+        while not self.flush():
+            logger.warning(
+                f"Retrying bulk request of {len(self._actions)} actions in {backoff}s"
+            )
+            if self.shutdown_event.wait(backoff):
+                return
+            backoff = min(backoff * 2, MAX_BACKOFF)
+
+    def _send(self, actions: list[dict]) -> set:
+        """
+        Send actions in bulk requests, returns the (document id, operation) of
+        the actions to retry, or None if a request failed
+        """
+        logger.debug(f"Sending bulk request of {len(actions)} actions")
+        errors = 0
+        retries = set()
+        try:
+            for ok, item in streaming_bulk(
+                self.es_client,
+                actions,
+                chunk_size=self.max_size,
+                max_chunk_bytes=self.max_bytes,
+                max_retries=self.max_retries,
+                raise_on_error=False,
+            ):
+                _op, _result = item.popitem()
+                if ok:
+                    # The response gives the concrete index behind an alias
+                    self.set_routing(_result["_id"], _result["_index"])
+                    continue
+
+                # Items still throttled (429) after the retries of the bulk
+                # helper, or failing on the cluster side (5xx), are retried
+                _status = _result.get("status", 500)
+                if _status == 429 or _status >= 500:
+                    retries.add((_result.get("_id"), _op))
+                    continue
+
+                # Items rejected by Elasticsearch (e.g. mapping errors) are
+                # dropped, they would fail the same way on every retry
+                self.discard_routing(_result.get("_id"))
+                logger.error(
+                    f"Unable to {_op} document {_result.get('_id')} in {_result.get('_index')}: {_result.get('error')}"
+                )
+                errors += 1
+        except TransportError as err:
+            logger.error(f"Bulk request of {len(actions)} actions failed: {err}")
+            return None
+
+        self.indexed += len(actions) - errors - len(retries)
+        self.failed += errors
+        if len(retries) > 0:
+            logger.warning(
+                f"{len(retries)} actions of the bulk request will be retried"
+            )
+        return retries
+
+    def _commit_state(self) -> None:
+        if self._state is None or self._state == self._committed_state:
+            return
+
+        if self.helper is not None:
+            self.helper.set_state(self._state)
+        self._committed_state = self._state
+
+    def run(self) -> None:
+        logger.info("Bulk writer thread started")
+
+        backoff = 0
+        while not self.shutdown_event.is_set():
+            _wait = (
+                self._last_flush + max(self.flush_interval, backoff) - time.monotonic()
+            )
+            if _wait > 0:
+                self.shutdown_event.wait(_wait)
+                continue
+
+            try:
+                flushed = self.flush()
+            except Exception as err:
+                # The actions stay buffered for the next flush
+                logger.error(f"Unable to flush the bulk writer: {err}")
+                flushed = False
+
+            if flushed:
+                backoff = 0
+            else:
+                backoff = min(max(backoff * 2, 1), MAX_BACKOFF)
+                logger.warning(
+                    f"Retrying bulk request of {len(self._actions)} actions in {backoff}s"
+                )
+
+        if not self.flush():
+            logger.error(
+                f"Unable to send the last {len(self._actions)} actions, they will be replayed from the stream"
+            )
+
+        logger.info(
+            f"Bulk writer thread stopped ({self.indexed} documents written, {self.failed} rejected)"
+        )
+
+
+class CheckpointHelper(object):
+    """
+    OpenCTIConnectorHelper of the live stream listener, with the stream state
+    kept by the BulkWriter: a state saved after a callback is only committed
+    once Elasticsearch acknowledged the `_bulk` actions buffered before it,
+    deferred events included.
+    """
+
+    def __init__(self, helper: OpenCTIConnectorHelper, bulk_writer: BulkWriter):
+        self.helper: OpenCTIConnectorHelper = helper
+        self.bulk_writer: BulkWriter = bulk_writer
+
+    def __getattr__(self, name: str):
+        return getattr(self.helper, name)
+
+    def get_state(self) -> dict:
+        return self.bulk_writer.get_state()
+
+    def set_state(self, state: dict) -> None:
+        self.bulk_writer.set_state(state)
@@ -16,6 +16,8 @@ defaults: dict = {
         "entity_description": "Elastic detection engine results via connector",
         "entity_name": "Elastic CTI Cluster",
         "live_stream_id": "ChangeMe",
+        "entity_source": "api",
+        "read_batch_size": 100,
     },
     "elastic": {
         "signals": {
@@ -23,6 +25,8 @@ defaults: dict = {
             "lookback_interval": "5m",
             "signal_index": ".siem-signals-*",
             "query": '{"query":{"bool":{"must":{"match":{"signal.rule.type":"threat_match"}}}}}',
+            "page_size": 1000,
+            "indicator_cache_size": 10000,
         },
         "sightings_tlp": None,
     },
@@ -35,6 +39,11 @@ defaults: dict = {
             "password": None,
             "api_key": None,
             "index": "opencti-{now/d}",
+            "bulk_max_size": 500,
+            "bulk_max_bytes": 10485760,
+            "flush_interval": "5s",
+            "max_retries": 3,
+            "routing_cache_size": 100000,
         }
     },
     "setup": {
@@ -76,6 +76,8 @@ def __process_config(argv={}, config={}) -> dict:
             "log_level": os.environ.get("CONNECTOR_LOG_LEVEL", None),
             "confidence_level": os.environ.get("CONNECTOR_CONFIDENCE_LEVEL", None),
             "mode": os.environ.get("CONNECTOR_MODE", None),
+            "entity_source": os.environ.get("CONNECTOR_ENTITY_SOURCE", None),
+            "read_batch_size": os.environ.get("CONNECTOR_READ_BATCH_SIZE", None),
         },
         "cloud": {
             "auth": os.environ.get("CLOUD_AUTH", None),
@@ -88,6 +90,8 @@ def __process_config(argv={}, config={}) -> dict:
                 "username": os.environ.get("ELASTICSEARCH_USERNAME", None),
                 "password": os.environ.get("ELASTICSEARCH_PASSWORD", None),
                 "ssl_verify": os.environ.get("ELASTICSEARCH_SSL_VERIFY", None),
+                "bulk_max_size": os.environ.get("ELASTICSEARCH_BULK_MAX_SIZE", None),
+                "flush_interval": os.environ.get("ELASTICSEARCH_FLUSH_INTERVAL", None),
             }
         },
         "elastic": {
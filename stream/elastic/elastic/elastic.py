@@ -7,11 +7,14 @@ from logging import getLogger
 
 from elasticsearch import Elasticsearch
 from pycti import OpenCTIConnectorHelper
+from pycti.connector.opencti_connector_helper import ListenStream
 from scalpl import Cut
 
 from . import LOGGER_NAME
+from .bulk_writer import BulkWriter, CheckpointHelper
 from .import_manager import IntelManager, StixManager
 from .sightings_manager import SignalsManager
+from .utils import parse_duration
 
 logger = getLogger(LOGGER_NAME)
 
@@ -31,10 +34,12 @@ class ElasticConnector:
 
         self.config = Cut(config)
 
-        # Start streaming from 1 second ago
-        self.helper.set_state(
-            {"connectorLastEventId": str(int(round(time.time() * 1000)) - 1000)}
-        )
+        # Resume from the last acknowledged event, otherwise start streaming
+        # from 1 second ago
+        if self.helper.get_state() is None:
+            self.helper.set_state(
+                {"connectorLastEventId": str(int(round(time.time() * 1000)) - 1000)}
+            )
 
         # Get the external URL as configured in OpenCTI Settings page
         query = """
@@ -49,10 +54,11 @@ class ElasticConnector:
         self.config["opencti.platform_url"] = _settings.get("platform_url", None)
 
         self._connect_elasticsearch()
+        self._setup_bulk_writer()
 
         if self.config["connector.mode"] == "ecs":
             self.import_manager = IntelManager(
-                self.helper, self.elasticsearch, self.config, datadir
+                self.helper, self.elasticsearch, self.config, datadir, self.bulk_writer
             )
 
             self.sightings_manager = SignalsManager(
@@ -63,7 +69,7 @@ class ElasticConnector:
             )
         elif self.config["connector.mode"] == "stix":
             self.import_manager = StixManager(
-                self.helper, self.elasticsearch, self.config, datadir
+                self.helper, self.elasticsearch, self.config, datadir, self.bulk_writer
             )
 
             self.sightings_manager = None
@@ -120,6 +126,29 @@ class ElasticConnector:
 
         return
 
+    def _setup_bulk_writer(self) -> None:
+        _flush_interval: str = str(
+            self.config.get("output.elasticsearch.flush_interval", "5s")
+        )
+        _dur = parse_duration(_flush_interval)
+
+        self.bulk_writer = BulkWriter(
+            elasticsearch_client=self.elasticsearch,
+            shutdown_event=self.shutdown_event,
+            helper=self.helper,
+            max_size=self.config.get("output.elasticsearch.bulk_max_size", 500),
+            max_bytes=self.config.get(
+                "output.elasticsearch.bulk_max_bytes", 10 * 1024 * 1024
+            ),
+            flush_interval=_dur.total_seconds() if _dur else 5,
+            max_retries=self.config.get("output.elasticsearch.max_retries", 3),
+            routing_cache_size=self.config.get(
+                "output.elasticsearch.routing_cache_size", 100000
+            ),
+        )
+
+        return
+
     def handle_create(self, timestamp: datetime, data: dict) -> None:
         logger.debug("[CREATE] Processing indicator {" + data["id"] + "}")
 
@@ -168,8 +197,21 @@ class ElasticConnector:
         if self.config["connector.mode"] == "ecs":
             self.sightings_manager.start()
 
-        # Look out, this doesn't block
-        self.helper.listen_stream(self._process_message)
+        self.bulk_writer.start()
+
+        # Look out, this doesn't block. The stream state goes through the bulk
+        # writer, so the last event id only advances with acknowledged documents
+        self.stream = ListenStream(
+            CheckpointHelper(self.helper, self.bulk_writer),
+            self._process_message,
+            None,
+            None,
+            None,
+            None,
+            None,
+        )
+        self.stream.daemon = True
+        self.stream.start()
 
         try:
             # Just wait here until someone presses ctrl+c
@@ -178,6 +220,13 @@ class ElasticConnector:
             self.shutdown_event.set()
 
         logger.info("Shutting down")
+        self.stream.stop()
+
+        # Send the buffered documents and push the last acknowledged state
+        self.bulk_writer.join(timeout=30)
+        if self.bulk_writer.is_alive():
+            logger.warn("Bulk writer didn't shutdown by request")
+        self.helper.force_ping()
 
         if self.config["connector.mode"] == "ecs":
             self.sightings_manager.join(timeout=3)
@@ -9,6 +9,7 @@ from pycti import OpenCTIConnectorHelper
 from scalpl import Cut
 
 from . import DM_DEFAULT_FMT, LOGGER_NAME, RE_DATEMATH
+from .bulk_writer import BulkWriter
 from .utils import remove_nones
 
 logger = getLogger(LOGGER_NAME)
@@ -30,6 +31,30 @@ entity_field_mapping = {
     "description": "threatintel.indicator.description",
 }
 
+# Sets the `params.fields` given as dotted paths, in order: removes the ones
+# with a null value and only adds the `default` ones if missing. Objects such
+# as `threatintel.indicator` are replaced, where a partial `doc` would merge them.
+UPDATE_FIELDS_SCRIPT = """
+for (def field : params.fields) {
+  def path = field.path.splitOnToken('.');
+  def node = ctx._source;
+  for (int i = 0; i < path.length - 1; i++) {
+    if (!(node.get(path[i]) instanceof Map)) {
+      node.put(path[i], new HashMap());
+    }
+    node = node.get(path[i]);
+  }
+  def name = path[path.length - 1];
+  if (field.default) {
+    node.putIfAbsent(name, field.value);
+  } else if (field.value == null) {
+    node.remove(name);
+  } else {
+    node.put(name, field.value);
+  }
+}
+"""
+
 
 class StixManager(object):
     def __init__(
@@ -38,9 +63,11 @@ class StixManager(object):
         elasticsearch_client: Elasticsearch,
         config: dict[str, str],
         datadir: str,
+        bulk_writer: BulkWriter,
     ):
         self.helper: OpenCTIConnectorHelper = helper
         self.es_client: Elasticsearch = elasticsearch_client
+        self.bulk_writer: BulkWriter = bulk_writer
         self.config: Cut = Cut(config)
         self.datadir: str = datadir
         self.idx: str = self.config.get("output.elasticsearch.index")
@@ -73,13 +100,9 @@ class StixManager(object):
                     _val = dm(m.get("modulo"), now=timestamp).format(_fmt)
                     _write_idx = self.pattern.sub(_val, _write_idx)
 
-            # Submit to Elastic index
+            # Queue for the next bulk request to Elastic
             logger.debug(f"Indexing doc to {_write_idx}:\n {_document}")
-            self.es_client.index(
-                index=_write_idx,
-                id=data["x_opencti_id"],
-                body=_document,
-            )
+            self.bulk_writer.index(_write_idx, data["x_opencti_id"], _document)
 
         except RequestError as err:
             logger.error("Unexpected error:", err, data)
@@ -90,6 +113,9 @@ class StixManager(object):
 
     def delete_cti_event(self, data: dict) -> None:
         _result: dict = {}
+        # Don't let a buffered write bring the document back
+        self.bulk_writer.discard(data["x_opencti_id"])
+
         try:
             _result = self.es_client.delete(
                 index=self.idx_pattern, id=data["x_opencti_id"], doc_type="_doc"
@@ -97,6 +123,7 @@ class StixManager(object):
         except NotFoundError:
             logger.warn(f"Document id {data['x_opencti_id']} not found in index")
 
+        self.bulk_writer.discard_routing(data["x_opencti_id"])
         if _result.get("result", None) == "deleted":
             logger.debug(f"Document id {data['x_opencti_id']} deleted")
 
@@ -110,9 +137,11 @@ class IntelManager(object):
         elasticsearch_client: Elasticsearch,
         config: dict[str, str],
         datadir: str,
+        bulk_writer: BulkWriter,
     ):
         self.helper: OpenCTIConnectorHelper = helper
         self.es_client: Elasticsearch = elasticsearch_client
+        self.bulk_writer: BulkWriter = bulk_writer
         self.config: Cut = Cut(config)
         self.datadir: str = datadir
 
@@ -125,6 +154,23 @@ class IntelManager(object):
 
         self.pattern = re.compile(RE_DATEMATH)
 
+        # 'api' reads every indicator from OpenCTI, 'stream' builds the documents
+        # from the stream payload and only reads the fields it lacks
+        self.entity_source: str = self.config.get("connector.entity_source", "api")
+        self.read_batch_size: int = int(
+            self.config.get("connector.read_batch_size", 100)
+        )
+        # Events waiting for a batched read of their missing fields
+        self._deferred: list[tuple] = []
+        self._deferred_ids: set[str] = set()
+        # Standard id -> marking definition / author, and (kill chain, phase)
+        # -> phase order, learned from the batched reads
+        self._markings: dict[str, dict] = {}
+        self._authors: dict[str, dict] = {}
+        self._phase_orders: dict[tuple, int] = {}
+
+        self.bulk_writer.add_deferred_source(self)
+
         self._setup_elasticsearch_index()
 
     def _setup_elasticsearch_index(self) -> None:
@@ -240,113 +286,175 @@ class IntelManager(object):
     def import_cti_event(
         self, timestamp: datetime, data: dict, is_update: bool = False
     ) -> dict:
-        logger.debug(f"Querying indicator: { data['x_opencti_id']}")
-        entity = self.helper.api.indicator.read(id=data["x_opencti_id"])
-
-        logger.debug(entity)
-
-        _result: dict = {}
-        _document: Cut = {}
-
         if data["type"] != "indicator":
             logger.error(
                 f"Data type unsupported: {data['type']}. Only 'indicators are currently supported."
             )
             return None
 
-        if is_update is True:
-            update_time: str = (
-                datetime.now(tz=timezone.utc).isoformat().replace("+00:00", "Z")
+        with self.bulk_writer.lock:
+            if data["x_opencti_id"] in self._deferred_ids:
+                # Keep the events of a document in order
+                self.import_deferred()
+
+            if self.entity_source != "stream":
+                logger.debug(f"Querying indicator: { data['x_opencti_id']}")
+                entity = self.helper.api.indicator.read(id=data["x_opencti_id"])
+                return self._import_entity(timestamp, data, entity, is_update)
+
+            entity, missing = self._entity_from_payload(data)
+            if len(missing) == 0:
+                return self._import_entity(timestamp, data, entity, is_update)
+
+            logger.debug(
+                f"Deferring indicator {data['x_opencti_id']}, missing {missing}"
             )
-            try:
-                # Attempt to retreive existing document
-                logger.debug(f"Retrieving document id: {data['x_opencti_id']}")
-                _result = self.es_client.get(
-                    index=self.idx_pattern, id=data["x_opencti_id"], doc_type="_doc"
-                )
+            self._deferred.append((timestamp, data, entity, missing, is_update))
+            self._deferred_ids.add(data["x_opencti_id"])
+            if len(self._deferred) >= self.read_batch_size:
+                self.import_deferred()
 
-            except NotFoundError:
-                logger.warn(
-                    f"Document not found to update at /{self.idx}/_doc/{data['x_opencti_id']}"
-                )
-                logger.warn("Skipping")
-                return {}
+            return {}
 
-            except RequestError as err:
-                logger.error(
-                    f"Unexpected error retreiving document at /{self.idx}/_doc/{data['x_opencti_id']}:",
-                    err.__dict__,
-                )
+    def deferred_count(self) -> int:
+        return len(self._deferred)
+
+    def import_deferred(self) -> None:
+        """
+        Read the fields missing from the deferred events, with one GraphQL
+        query for the whole batch, and import them in order
+        """
+        with self.bulk_writer.lock:
+            if len(self._deferred) == 0:
+                return
+
+            entities: list[dict] = self._read_missing_fields(self._deferred)
+
+            deferred = self._deferred
+            self._deferred = []
+            self._deferred_ids = set()
+            for (timestamp, data, _, _, is_update), entity in zip(deferred, entities):
+                if entity is None:
+                    logger.warning(f"Indicator {data['x_opencti_id']} not found")
+                    continue
+                self._import_entity(timestamp, data, entity, is_update)
+
+    def _entity_from_payload(self, data: dict) -> tuple[dict, set[str]]:
+        """
+        Build the indicator as returned by the API from the STIX stream payload,
+        with the set of fields which need to be read from OpenCTI
+        """
+        missing: set[str] = set()
+        entity: dict = {
+            "id": data["x_opencti_id"],
+            "standard_id": data.get("id", None),
+            "pattern": data.get("pattern", None),
+            "pattern_type": data.get("pattern_type", None),
+            "valid_from": data.get("valid_from", None),
+            "valid_until": data.get("valid_until", None),
+            "x_opencti_detection": data.get("x_opencti_detection", None),
+            "x_opencti_score": data.get("x_opencti_score", None),
+            "x_mitre_platforms": data.get("x_mitre_platforms", None),
+            "confidence": data.get("confidence", None),
+            "revoked": data.get("revoked", None),
+            "description": data.get("description", None),
+            "created_at": data.get("x_opencti_created_at", data.get("created", None)),
+            "updated_at": data.get("x_opencti_updated_at", data.get("modified", None)),
+            "externalReferences": data.get("external_references", []),
+        }
 
-            if _result["found"] is True:
-                _document = Cut(_result["_source"])
-                _write_idx = _result["_index"]
-
-            if data.get("x_data_update", None):
-                if data["x_data_update"].get("replace", None):
-                    if entity["pattern_type"] == "stix":
-                        # Pull in any indicator updates
-                        _indicator: dict = self._create_ecs_indicator_stix(entity)
-                        if _indicator == {}:
-                            return {}
-                        _document["threatintel.indicator"] = _indicator
-                        if entity.get("killChainPhases", None):
-                            phases = []
-                            for phase in sorted(
-                                entity["killChainPhases"],
-                                key=lambda i: (
-                                    i["kill_chain_name"],
-                                    i["x_opencti_order"],
-                                ),
-                            ):
-                                phases.append(
-                                    {
-                                        "killchain_name": phase["kill_chain_name"],
-                                        "phase_name": phase["phase_name"],
-                                        "opencti_phase_order": phase["x_opencti_order"],
-                                    }
-                                )
-
-                            _document.setdefault(
-                                "threatintel.opencti.killchain_phases", phases
-                            )
-                    else:
-                        logger.warning(
-                            f"Unsupported indicator pattern type: {entity['pattern_type']}. Skipping."
-                        )
-                        return _document
-
-                    for k, v in data["x_data_update"].get("replace", {}).items():
-                        logger.debug(
-                            f"Updating field {k} -> {entity_field_mapping.get(k)} to {v}"
-                        )
-                        try:
-                            _field = entity_field_mapping.get(k)
-                            _document.setdefault(_field, v)
-                            _document[_field] = v
-                        except KeyError as err:
-                            logger.error(f"Unable to find field mapping for {k}", err)
-
-                    _document["threatintel.opencti.updated_at"] = update_time
-
-                    #  This scrubs the Cut object and returns a dict
-                    _document = remove_nones(_document)
-
-                    try:
-                        # Don't render timestamped index since this is an update
-                        # Submit to Elastic index
-                        logger.debug(f"Updating doc to {_write_idx}:\n {_document}")
-                        self.es_client.index(
-                            index=_write_idx,
-                            id=data["x_opencti_id"],
-                            body=_document,
-                        )
-                    except RequestError as err:
-                        logger.error("Unexpected error:", err, _document)
-                    except Exception as err:
-                        logger.error("Something else happened", err, _document)
-
-                    return _document
+        _refs: list[str] = data.get("object_marking_refs", [])
+        if all(ref in self._markings for ref in _refs):
+            entity["objectMarking"] = [self._markings[ref] for ref in _refs]
+        else:
+            missing.add("objectMarking")
+
+        if data.get("created_by_ref", None) is not None:
+            if data["created_by_ref"] in self._authors:
+                entity["createdBy"] = self._authors[data["created_by_ref"]]
+            else:
+                missing.add("createdBy")
+
+        phases: list[dict] = []
+        for phase in data.get("kill_chain_phases", []):
+            _key = (phase["kill_chain_name"], phase["phase_name"])
+            _order = phase.get("x_opencti_order", self._phase_orders.get(_key, None))
+            if _order is None:
+                missing.add("killChainPhases")
+                break
+            phases.append({**phase, "x_opencti_order": _order})
+        else:
+            entity["killChainPhases"] = phases
+
+        return entity, missing
+
+    def _read_missing_fields(self, deferred: list[tuple]) -> list[dict]:
+        fields: dict[str, str] = {
+            "objectMarking": "objectMarking { edges { node { id standard_id definition_type definition } } }",
+            "createdBy": "createdBy { ... on Identity { id standard_id name } }",
+            "killChainPhases": "killChainPhases { edges { node { id kill_chain_name phase_name x_opencti_order } } }",
+        }
+        _missing: set[str] = set().union(*[item[3] for item in deferred])
+        _selection: str = " ".join(fields[field] for field in sorted(_missing))
+
+        # One aliased `indicator` field per id, so any number of ids fit a query
+        ids: list[str] = list(
+            dict.fromkeys(item[1]["x_opencti_id"] for item in deferred)
+        )
+        query: str = (
+            "query IndicatorsMissingFields("
+            + ", ".join(f"$id{i}: String!" for i in range(len(ids)))
+            + ") {"
+            + " ".join(
+                f"i{i}: indicator(id: $id{i}) {{ id {_selection} }}"
+                for i in range(len(ids))
+            )
+            + "}"
+        )
+        logger.debug(f"Reading {_missing} of {len(ids)} indicators")
+        result: dict = self.helper.api.query(
+            query, {f"id{i}": _id for i, _id in enumerate(ids)}
+        )["data"]
+
+        nodes: dict[str, dict] = {}
+        for i, _id in enumerate(ids):
+            nodes[_id] = self.helper.api.process_multiple_fields(result.get(f"i{i}"))
+
+        entities: list[dict] = []
+        for _, data, entity, missing, _ in deferred:
+            _node: dict = nodes[data["x_opencti_id"]]
+            if _node is None:
+                # Deleted since the event was sent
+                entities.append(None)
+                continue
+
+            for field in missing:
+                entity[field] = _node.get(field, None)
+            entities.append(entity)
+
+            for mark in _node.get("objectMarking", None) or []:
+                self._markings[mark["standard_id"]] = mark
+            if _node.get("createdBy", None):
+                self._authors[_node["createdBy"]["standard_id"]] = _node["createdBy"]
+            for phase in _node.get("killChainPhases", None) or []:
+                _key = (phase["kill_chain_name"], phase["phase_name"])
+                self._phase_orders[_key] = phase["x_opencti_order"]
+
+        return entities
+
+    def _import_entity(
+        self, timestamp: datetime, data: dict, entity: dict, is_update: bool
+    ) -> dict:
+        logger.debug(entity)
+
+        _write_idx: str = None
+
+        if is_update is True:
+            if data.get("x_data_update", {}).get("replace", None):
+                return self._update_document(data, entity)
+
+            # Rewrite the whole document where it lives, not in the write index
+            _write_idx = self._get_document_index(data["x_opencti_id"])
 
         creation_time: str = (
             datetime.now(tz=timezone.utc).isoformat().replace("+00:00", "Z")
@@ -431,7 +539,8 @@ class IntelManager(object):
 
         try:
             # Render date-specific index, if we're doing logstash style indices
-            _write_idx = self.write_idx
+            if _write_idx is None:
+                _write_idx = self.write_idx
             m = self.pattern.search(_write_idx)
             if m is not None:
                 m = m.groupdict()
@@ -441,13 +550,9 @@ class IntelManager(object):
                     _val = dm(m.get("modulo"), now=timestamp).format(_fmt)
                     _write_idx = self.pattern.sub(_val, _write_idx)
 
-            # Submit to Elastic index
+            # Queue for the next bulk request to Elastic
             logger.debug(f"Indexing doc to {_write_idx}:\n {_document}")
-            self.es_client.index(
-                index=_write_idx,
-                id=data["x_opencti_id"],
-                body=_document,
-            )
+            self.bulk_writer.index(_write_idx, data["x_opencti_id"], _document)
         except RequestError as err:
             logger.error("Unexpected error:", err, _document)
         except Exception as err:
@@ -455,6 +560,121 @@ class IntelManager(object):
 
         return _document
 
+    def _get_document_index(self, id: str) -> str:
+        """
+        Return the concrete index of a document, from the routing cache of the
+        bulk writer or by searching the index pattern
+        """
+        _index: str = self.bulk_writer.get_routing(id)
+        if _index is not None:
+            return _index
+
+        try:
+            logger.debug(f"Searching index of document id: {id}")
+            _result: dict = self.es_client.search(
+                index=self.idx_pattern,
+                body={"query": {"ids": {"values": [id]}}, "_source": False, "size": 1},
+            )
+        except RequestError as err:
+            logger.error(
+                f"Unexpected error searching document at /{self.idx_pattern}/_doc/{id}:",
+                err.__dict__,
+            )
+            return None
+
+        _hits: list = _result.get("hits", {}).get("hits", [])
+        if len(_hits) == 0:
+            return None
+
+        self.bulk_writer.set_routing(id, _hits[0]["_index"])
+        return _hits[0]["_index"]
+
+    def _update_document(self, data: dict, entity: dict) -> dict:
+        """
+        Queue an update of the fields replaced by an update event, in the
+        backing index of the document
+        """
+        update_time: str = (
+            datetime.now(tz=timezone.utc).isoformat().replace("+00:00", "Z")
+        )
+
+        _write_idx: str = self._get_document_index(data["x_opencti_id"])
+        if _write_idx is None:
+            logger.warn(
+                f"Document not found to update at /{self.idx}/_doc/{data['x_opencti_id']}"
+            )
+            logger.warn("Skipping")
+            return {}
+
+        if entity["pattern_type"] != "stix":
+            logger.warning(
+                f"Unsupported indicator pattern type: {entity['pattern_type']}. Skipping."
+            )
+            return {}
+
+        # Pull in any indicator updates
+        _indicator: dict = self._create_ecs_indicator_stix(entity)
+        if _indicator == {}:
+            return {}
+
+        _fields: list[dict] = [
+            {"path": "threatintel.indicator", "value": _indicator, "default": False}
+        ]
+        if entity.get("killChainPhases", None):
+            phases = []
+            for phase in sorted(
+                entity["killChainPhases"],
+                key=lambda i: (i["kill_chain_name"], i["x_opencti_order"]),
+            ):
+                phases.append(
+                    {
+                        "killchain_name": phase["kill_chain_name"],
+                        "phase_name": phase["phase_name"],
+                        "opencti_phase_order": phase["x_opencti_order"],
+                    }
+                )
+
+            _fields.append(
+                {
+                    "path": "threatintel.opencti.killchain_phases",
+                    "value": phases,
+                    "default": True,
+                }
+            )
+
+        for k, v in data["x_data_update"].get("replace", {}).items():
+            _field = entity_field_mapping.get(k, None)
+            logger.debug(f"Updating field {k} -> {_field} to {v}")
+            if _field is None:
+                logger.error(f"Unable to find field mapping for {k}")
+                continue
+
+            for _path in _field if isinstance(_field, list) else [_field]:
+                # Empty values are removed from the document, like on creation
+                _value = remove_nones({"value": v}).get("value", None)
+                _fields.append({"path": _path, "value": _value, "default": False})
+
+        _fields.append(
+            {
+                "path": "threatintel.opencti.updated_at",
+                "value": update_time,
+                "default": False,
+            }
+        )
+
+        logger.debug(f"Updating doc in {_write_idx}:\n {_fields}")
+        self.bulk_writer.update(
+            _write_idx,
+            data["x_opencti_id"],
+            {
+                "source": UPDATE_FIELDS_SCRIPT,
+                "lang": "painless",
+                "params": {"fields": _fields},
+            },
+        )
+
+        return {"fields": _fields}
+
     def delete_cti_event(self, data: dict) -> None:
 
         logger.debug(f"Deleting {data}")
@@ -466,6 +686,12 @@ class IntelManager(object):
             )
             return None
 
+        if data["x_opencti_id"] in self._deferred_ids:
+            self.import_deferred()
+
+        # Don't let a buffered write bring the document back
+        self.bulk_writer.discard(data["x_opencti_id"])
+
         try:
             _result = self.es_client.delete(
                 index=self.idx_pattern, id=data["x_opencti_id"], doc_type="_doc"
@@ -473,6 +699,7 @@ class IntelManager(object):
         except NotFoundError:
             logger.warn(f"Document id {data['x_opencti_id']} not found in index")
 
+        self.bulk_writer.discard_routing(data["x_opencti_id"])
         if _result.get("result", None) == "deleted":
             logger.debug(f"Document id {data['x_opencti_id']} deleted")
 
@@ -1,12 +1,14 @@
 import json
-from datetime import timedelta
+from collections import OrderedDict
+from datetime import datetime, timedelta, timezone
 from logging import getLogger
 from threading import Event, Thread
 
-from elasticsearch import Elasticsearch, NotFoundError
+from elasticsearch import Elasticsearch, TransportError
 from elasticsearch_dsl import Search
 from pycti import OpenCTIConnectorHelper
 from scalpl import Cut
+from stix2 import Bundle, Sighting
 
 from . import LOGGER_NAME
 from .utils import parse_duration
@@ -26,6 +28,11 @@ DEFAULT_QUERY = """
 """
 
 DEFAULT_LOOKBACK = "5m"
+DEFAULT_PAGE_SIZE = 1000
+DEFAULT_INDICATOR_CACHE_SIZE = 10000
+PIT_KEEP_ALIVE = "1m"
+# Number of indicators resolved by a single GraphQL query
+READ_BATCH_SIZE = 100
 
 
 class SignalsManager(Thread):
@@ -43,6 +50,7 @@ class SignalsManager(Thread):
 
         self.helper: OpenCTIConnectorHelper = opencti_client
         self.author_id = None
+        self.author_standard_id = None
 
         # Default to 5 minutes
         self.interval = 300
@@ -60,6 +68,18 @@ class SignalsManager(Thread):
         _lookback: str = self.config.get(
             "elastic.signals.lookback_interval", DEFAULT_LOOKBACK
         )
+        self.page_size: int = int(
+            self.config.get("elastic.signals.page_size", DEFAULT_PAGE_SIZE)
+        )
+        self.indicator_cache_size: int = int(
+            self.config.get(
+                "elastic.signals.indicator_cache_size", DEFAULT_INDICATOR_CACHE_SIZE
+            )
+        )
+        # OpenCTI internal id -> standard id, and matched atomic -> internal id
+        # of the indicators, most recently used last
+        self._standard_ids: OrderedDict[str, str] = OrderedDict()
+        self._atomic_ids: OrderedDict[str, str] = OrderedDict()
 
         assert self.es_client.ping()
         self.signals_search: dict = (
@@ -88,139 +108,294 @@ class SignalsManager(Thread):
         )
         if not elastic_entity:
             logger.info(f"Creating {_entity_name} STIX identity")
-            self.author_id = self.helper.api.identity.create(
+            elastic_entity = self.helper.api.identity.create(
                 type="System",
                 name=_entity_name,
                 description=_entity_desc,
-            )["id"]
-            return self.author_id
+            )
         else:
             logger.info(f"Caching {_entity_name} id")
-            self.author_id = elastic_entity["id"]
-            return self.author_id
-
-    def run(self) -> None:
-
-        logger.info("Signals manager thread starting")
 
-        """Main loop"""
-        while not self.shutdown_event.is_set():
-
-            logger.debug("Searching for new signals")
-
-            # Look for new Threat Match Signals from Elastic SIEM
-            results = self.es_client.search(
-                index=self.search_idx, body=self.signals_search
-            )
-            ids_dict = {}
-
-            # Parse the results
-            for hit in results["hits"]["hits"]:
-                # This depends on ECS mappings >= 1.11
-                for indicator in hit["_source"]["threat"]["enrichments"]:
-                    # Get original threatintel document
-                    try:
-                        _doc = self.es_client.get(
-                            index=indicator["matched"]["index"],
-                            id=indicator["matched"]["id"],
-                        )
-                    except NotFoundError as err:
-                        logger.error(
-                            f"ThreatIntel document for {indicator['matched']['atomic'][0]} was not found",
-                            err,
-                        )
+        self.author_id = elastic_entity["id"]
+        self.author_standard_id = elastic_entity["standard_id"]
+        return self.author_id
+
+    def _cache_get(self, cache: OrderedDict, key: str) -> str:
+        value = cache.get(key, None)
+        if value is not None:
+            cache.move_to_end(key)
+        return value
+
+    def _cache_set(self, cache: OrderedDict, key: str, value: str) -> None:
+        if self.indicator_cache_size <= 0:
+            return
+
+        cache[key] = value
+        cache.move_to_end(key)
+        if len(cache) > self.indicator_cache_size:
+            cache.popitem(last=False)
+
+    def _search_matches(self):
+        """
+        Yield the pages of the threatintel documents matched by the signals,
+        aggregated by Elasticsearch with the number of signals and the first and
+        last time they were seen. The pages are read from a point in time so that
+        signals written while paginating don't shift them.
+        """
+        _pit: dict = self.es_client.open_point_in_time(
+            index=self.search_idx, keep_alive=PIT_KEEP_ALIVE
+        )
+        _pit_id: str = _pit["id"]
+
+        _composite: dict = {
+            "size": self.page_size,
+            # This depends on ECS mappings >= 1.11
+            "sources": [
+                {"index": {"terms": {"field": "threat.enrichments.matched.index"}}},
+                {"id": {"terms": {"field": "threat.enrichments.matched.id"}}},
+            ],
+        }
+        _body: dict = {
+            "size": 0,
+            "query": self.signals_search["query"],
+            "aggs": {
+                "matches": {
+                    "composite": _composite,
+                    "aggs": {
+                        "first_seen": {"min": {"field": "signal.original_time"}},
+                        "last_seen": {"max": {"field": "signal.original_time"}},
+                        # Only used for documents without an OpenCTI reference
+                        "signal": {
+                            "top_hits": {
+                                "size": 1,
+                                "_source": ["threat.enrichments.matched"],
+                            }
+                        },
+                    },
+                }
+            },
+        }
+
+        try:
+            while True:
+                _body["pit"] = {"id": _pit_id, "keep_alive": PIT_KEEP_ALIVE}
+                results = self.es_client.search(body=_body)
+                _pit_id = results.get("pit_id", _pit_id)
+
+                _matches: dict = results["aggregations"]["matches"]
+                if len(_matches["buckets"]) == 0:
+                    break
+                yield _matches["buckets"]
+
+                if "after_key" not in _matches:
+                    break
+                _composite["after"] = _matches["after_key"]
+        finally:
+            try:
+                self.es_client.close_point_in_time(body={"id": _pit_id})
+            except TransportError as err:
+                logger.warn(f"Unable to close point in time: {err}")
+
+    def _get_matched_atomic(self, bucket: dict) -> str:
+        for hit in bucket["signal"]["hits"]["hits"]:
+            for enrichment in hit["_source"]["threat"]["enrichments"]:
+                _matched = enrichment["matched"]
+                if (_matched["index"], _matched["id"]) == (
+                    bucket["key"]["index"],
+                    bucket["key"]["id"],
+                ):
+                    return _matched["atomic"]
+        return None
+
+    def _get_indicator_id(self, atomic: str) -> str:
+        _opencti_id = self._cache_get(self._atomic_ids, atomic)
+        if _opencti_id is not None:
+            return _opencti_id
+
+        # This probably isn't perfect, but should get us close-ish
+        _filters = [
+            {
+                "key": "pattern_type",
+                "operator": "match",
+                "values": ["STIX"],
+            },
+            {
+                "key": "pattern",
+                "operator": "match",
+                "values": [atomic],
+            },
+        ]
+
+        _cti_indicator = self.helper.api.indicator.read(filters=_filters)
+        if not _cti_indicator:
+            logger.warn(f"Unable to find matching indicator in OpenCTI for: {atomic}")
+            return None
+
+        self._cache_set(self._atomic_ids, atomic, _cti_indicator["id"])
+        self._cache_set(
+            self._standard_ids, _cti_indicator["id"], _cti_indicator["standard_id"]
+        )
+        return _cti_indicator["id"]
+
+    def _aggregate_sightings(self) -> dict:
+        """Return the signals of the lookback interval by OpenCTI indicator id"""
+        ids_dict: dict = {}
+
+        for buckets in self._search_matches():
+            # Get the original threatintel documents
+            _docs: list = self.es_client.mget(
+                body={
+                    "docs": [
+                        {
+                            "_index": bucket["key"]["index"],
+                            "_id": bucket["key"]["id"],
+                            "_source": ["threatintel.opencti.internal_id"],
+                        }
+                        for bucket in buckets
+                    ]
+                }
+            )["docs"]
+
+            for bucket, _doc in zip(buckets, _docs):
+                if _doc.get("found", False) is not True:
+                    # Signals matching documents of several indices also give
+                    # buckets for the pairs of index and id of different documents
+                    logger.debug(
+                        f"ThreatIntel document {bucket['key']['id']} was not found in {bucket['key']['index']}"
+                    )
+                    continue
+
+                _opencti_id = (
+                    _doc.get("_source", {})
+                    .get("threatintel", {})
+                    .get("opencti", {})
+                    .get("internal_id", None)
+                )
+                if _opencti_id is None:
+                    logger.info(
+                        "Signal for threatintel document doesn't have opencti reference. Searching for matched indicator"
+                    )
+                    _atomic = self._get_matched_atomic(bucket)
+                    if _atomic is None:
                         continue
-
-                    if _doc["found"] is not True:
+                    _opencti_id = self._get_indicator_id(_atomic)
+                    if _opencti_id is None:
                         continue
 
-                    if (
-                        "threatintel" in _doc["_source"]
-                        and "opencti" in _doc["_source"]["threatintel"]
-                    ):
-                        _opencti_id = _doc["_source"]["threatintel"]["opencti"][
-                            "internal_id"
-                        ]
-                    else:
-                        logger.info(
-                            "Signal for threatintel document doesn't have opencti reference. Searching for matched indicator"
-                        )
-                        # This probably isn't perfect, but should get us close-ish
-                        _filters = [
-                            {
-                                "key": "pattern_type",
-                                "operator": "match",
-                                "values": ["STIX"],
-                            },
-                            {
-                                "key": "pattern",
-                                "operator": "match",
-                                "values": [indicator["matched"]["atomic"]],
-                            },
-                        ]
-
-                        _cti_indicator = self.helper.api.indicator.read(
-                            filters=_filters
-                        )
-                        if _cti_indicator:
-                            _opencti_id = _cti_indicator["id"]
-                        else:
-                            logger.warn(
-                                f"Unable to find matching indicator in OpenCTI for: {indicator['matched']['atomic']}"
-                            )
-                            continue
-
-                    _timestamp = hit["_source"]["signal"]["original_time"]
-                    if _opencti_id not in ids_dict:
-                        ids_dict[_opencti_id] = {
-                            "first_seen": _timestamp,
-                            "last_seen": _timestamp,
-                            "count": 1,
-                        }
-                    else:
-                        ids_dict[_opencti_id]["count"] += 1
+                _first_seen = bucket["first_seen"].get("value_as_string", None)
+                _last_seen = bucket["last_seen"].get("value_as_string", None)
+                if _opencti_id not in ids_dict:
+                    ids_dict[_opencti_id] = {
+                        "first_seen": _first_seen,
+                        "last_seen": _last_seen,
+                        "count": bucket["doc_count"],
+                    }
+                else:
+                    ids_dict[_opencti_id]["count"] += bucket["doc_count"]
+                    ids_dict[_opencti_id]["first_seen"] = min(
+                        ids_dict[_opencti_id]["first_seen"], _first_seen
+                    )
+                    ids_dict[_opencti_id]["last_seen"] = max(
+                        ids_dict[_opencti_id]["last_seen"], _last_seen
+                    )
+
+        return ids_dict
+
+    def _resolve_standard_ids(self, ids: list) -> dict:
+        """
+        Return the standard ids of the indicators still in OpenCTI, reading
+        those not cached with one aliased GraphQL query per batch
+        """
+        standard_ids: dict = {}
+        _missing: list = []
+        for _id in ids:
+            _standard_id = self._cache_get(self._standard_ids, _id)
+            if _standard_id is not None:
+                standard_ids[_id] = _standard_id
+            else:
+                _missing.append(_id)
+
+        for i in range(0, len(_missing), READ_BATCH_SIZE):
+            _batch: list = _missing[i : i + READ_BATCH_SIZE]
+            _variables: str = ", ".join(f"$id{n}: String!" for n in range(len(_batch)))
+            _fields: str = "\n".join(
+                f"i{n}: indicator(id: $id{n}) {{ id standard_id }}"
+                for n in range(len(_batch))
+            )
+            result = self.helper.api.query(
+                f"query SightedIndicators({_variables}) {{\n{_fields}\n}}",
+                {f"id{n}": _id for n, _id in enumerate(_batch)},
+            )
+            for n, _id in enumerate(_batch):
+                indicator = result["data"][f"i{n}"]
+                if indicator is None:
+                    logger.warn(f"Indicator {_id} was not found in OpenCTI")
+                    continue
+                standard_ids[_id] = indicator["standard_id"]
+                self._cache_set(self._standard_ids, _id, indicator["standard_id"])
+
+        return standard_ids
+
+    def _send_sightings(self, ids_dict: dict) -> int:
+        """Send the sightings of the cycle in a single STIX bundle"""
+        standard_ids: dict = self._resolve_standard_ids(list(ids_dict))
+        if len(standard_ids) == 0:
+            return 0
+
+        self._get_elastic_entity()
+        confidence = int(self.config.get("connector.confidence_level", "80"))
+
+        sightings: list = []
+        for k, v in ids_dict.items():
+            if k not in standard_ids:
+                continue
+
+            logger.debug(
+                f"Creating sighting from {standard_ids[k]} -> {self.author_standard_id}"
+            )
+            sightings.append(
+                Sighting(
+                    sighting_of_ref=standard_ids[k],
+                    where_sighted_refs=[self.author_standard_id],
+                    description="Threat Match sighting from Elastic SIEM",
+                    first_seen=v["first_seen"],
+                    last_seen=v["last_seen"],
+                    count=v["count"],
+                    confidence=confidence,
+                    created_by_ref=self.author_standard_id,
+                )
+            )
 
-                        if _timestamp < ids_dict[_opencti_id]["first_seen"]:
-                            ids_dict[_opencti_id]["first_seen"] = _timestamp
-                        elif _timestamp > ids_dict[_opencti_id]["last_seen"]:
-                            ids_dict[_opencti_id]["last_seen"] = _timestamp
+        _now: str = datetime.now(timezone.utc).isoformat(timespec="seconds")
+        work_id: str = self.helper.api.work.initiate_work(
+            self.helper.connect_id, f"Elastic sightings @ {_now}"
+        )
+        self.helper.send_stix2_bundle(
+            Bundle(objects=sightings).serialize(), work_id=work_id, update=False
+        )
+        self.helper.api.work.to_processed(
+            work_id, f"{len(sightings)} sightings sent from Elastic"
+        )
+        return len(sightings)
 
-            # Loop through signal hits and create new sightings
-            for k, v in ids_dict.items():
+    def run(self) -> None:
 
-                # Check if indicator exists
-                indicator = self.helper.api.indicator.read(id=k)
-                if indicator:
+        logger.info("Signals manager thread starting")
 
-                    logger.info("Found matching indicator in OpenCTI")
-                    stix_id = indicator["standard_id"]
+        """Main loop"""
+        while not self.shutdown_event.is_set():
 
-                    entity_id = self._get_elastic_entity()
-                    confidence = int(
-                        self.config.get("connector.confidence_level", "80")
-                    )
+            logger.debug("Searching for new signals")
 
-                    logger.debug(f"Creating sighting from {stix_id} -> {entity_id}")
-
-                    # Create new Sighting
-                    self.helper.api.stix_sighting_relationship.create(
-                        fromId=stix_id,
-                        toId=entity_id,
-                        stix_id=None,
-                        description="Threat Match sighting from Elastic SIEM",
-                        first_seen=v["first_seen"],
-                        last_seen=v["last_seen"],
-                        count=v["count"],
-                        x_opencti_negative=False,
-                        created=None,
-                        modified=None,
-                        confidence=confidence,
-                        created_by=entity_id,
-                        object_marking=None,
-                        object_label=None,
-                        external_references=None,
-                        update=False,
-                    )
+            try:
+                # Look for new Threat Match Signals from Elastic SIEM
+                ids_dict = self._aggregate_sightings()
+                if len(ids_dict) > 0:
+                    logger.info(f"Found {len(ids_dict)} matching indicators")
+                    _count = self._send_sightings(ids_dict)
+                    logger.info(f"Sent {_count} sightings to OpenCTI")
+            except TransportError as err:
+                logger.error(f"Unable to search for new signals: {err}")
 
             # Wait allows us to return earlier during a shutdown
             logger.debug(f"Sleeping for {self.interval} seconds")
@@ -1,8 +1,104 @@
 import collections.abc
-from typing import Dict, List, Tuple
+import re
+from functools import lru_cache
+from typing import Dict, List, Optional, Tuple
 
+from stix2patterns.inspector import INDEX_STAR
 from stix2patterns.pattern import Pattern
 
+# Whitespace skipped by the STIX pattern grammar, limited to the ASCII ones
+_WS = r"[ \t\r\n]*"
+_IDENTIFIER = r"[a-zA-Z_][a-zA-Z0-9_]*"
+_STRING = r"'[^'\\]*'"
+
+# Single comparison, split in a template and the literal value compared. Strings
+# with escapes, floats, booleans, timestamps, etc. are left to the full parser.
+RE_SIMPLE_PATTERN = re.compile(
+    rf"^(?P<template>.*?)(?P<value>{_STRING}|[+-]?(?:0|[1-9][0-9]*)){_WS}\]{_WS}\Z",
+    re.DOTALL,
+)
+RE_TEMPLATE = re.compile(
+    rf"^{_WS}\[{_WS}(?P<type>[a-zA-Z_][a-zA-Z0-9_-]*){_WS}:{_WS}"
+    rf"(?P<path>(?:{_IDENTIFIER}|{_STRING})"
+    rf"(?:{_WS}\.{_WS}(?:{_IDENTIFIER}|{_STRING})|{_WS}\[{_WS}\*{_WS}\])*)"
+    rf"{_WS}(?P<op>=|!=|<=|>=|<|>|(?<![a-zA-Z0-9_])(?:MATCHES|LIKE)){_WS}\Z"
+)
+RE_PATH_COMPONENT = re.compile(
+    rf"(?P<identifier>{_IDENTIFIER})|(?P<string>{_STRING})|\[{_WS}\*{_WS}\]"
+)
+
+# Keywords of the grammar, which are not identifiers. Any case is left to the full
+# parser to stay on the safe side.
+PATTERN_KEYWORDS = {
+    "and",
+    "or",
+    "not",
+    "followedby",
+    "like",
+    "matches",
+    "issuperset",
+    "issubset",
+    "exists",
+    "last",
+    "in",
+    "start",
+    "stop",
+    "seconds",
+    "true",
+    "false",
+    "within",
+    "repeats",
+    "times",
+}
+
+
+@lru_cache(maxsize=1024)
+def parse_template(template: str) -> Optional[Tuple[str, Tuple, str]]:
+    """
+    Parse the template of a single comparison pattern (e.g. `[ipv4-addr:value =`)
+    into its object type, object path and operator, None if it isn't one
+    """
+    m = RE_TEMPLATE.match(template)
+    if m is None:
+        return None
+
+    typename = m.group("type")
+    if typename.lower() in PATTERN_KEYWORDS:
+        return None
+
+    path = []
+    for component in RE_PATH_COMPONENT.finditer(m.group("path")):
+        if component.group("identifier") is not None:
+            if component.group("identifier").lower() in PATTERN_KEYWORDS:
+                return None
+            path.append(component.group("identifier"))
+        elif component.group("string") is not None:
+            path.append(component.group("string")[1:-1])
+        else:
+            path.append(INDEX_STAR)
+
+    return typename, tuple(path), m.group("op")
+
+
+def inspect_pattern(pattern: str) -> Dict[str, List[Tuple[List, str, str]]]:
+    """
+    Return the comparisons of a pattern per object type, as given by
+    `stix2patterns`. Single comparisons are parsed by hand, with their template
+    cached, other patterns by the full ANTLR parser.
+    """
+    m = RE_SIMPLE_PATTERN.match(pattern)
+    if m is not None:
+        parsed = parse_template(m.group("template"))
+        value = m.group("value")
+        # LIKE and MATCHES only take strings
+        if parsed is not None and (
+            parsed[2] not in ("LIKE", "MATCHES") or value[0] == "'"
+        ):
+            typename, path, op = parsed
+            return {typename: [(list(path), op, value)]}
+
+    return Pattern(pattern).inspect().comparisons
+
 
 class StixIndicator(object):
     def __init__(self, typename: str = None) -> None:
@@ -10,36 +106,14 @@ class StixIndicator(object):
 
     @staticmethod
     def parse_pattern(pattern: str) -> None:
-        p = Pattern(pattern)
-        data = p.inspect().comparisons
+        data = inspect_pattern(pattern)
 
         objs = []
         for item in data.keys():
-            switch = {
-                "artifact": ArtifactIndicator,
-                "autonomous-system": AutonomousSystemIndicator,
-                "directory": DirectoryIndicator,
-                "domain-name": DomainNameIndicator,
-                "email-addr": EmailAddrIndicator,
-                "email-message": EmailMessageIndicator,
-                "mime-part-type": EmailMimePartTypeIndicator,
-                "file": FileIndicator,
-                "ipv4-addr": IPv4AddrIndicator,
-                "ipv6-addr": IPv6AddrIndicator,
-                "mac-addr": MacAddrIndicator,
-                "mutex": MutexIndicator,
-                "network-traffic": NetworkTrafficIndicator,
-                "process": ProcessIndicator,
-                "software": SoftwareIndicator,
-                "url": UrlIndicator,
-                "user-account": UserAccountIndicator,
-                "windows-registry-key": WindowsRegistryKeyIndicator,
-                "win-registry-key": WindowsRegistryKeyIndicator,
-                "x509-certificate": X509CertificateIndicator,
-                "x-opencti-hostname": XOpenCTIHostnameIndicator,
-            }
             objs.append(
-                switch.get(item, UnknownIndicator)(typename=item)._parse(data[item])
+                INDICATOR_TYPES.get(item, UnknownIndicator)(typename=item)._parse(
+                    data[item]
+                )
             )
 
         return objs
@@ -55,7 +129,7 @@ class StixIndicator(object):
 def recursive_update(d, u):
     for k, v in u.items():
         if isinstance(v, collections.abc.Mapping):
-            d[k] = recursive_update(d.get(k, {}), v)
+            recursive_update(d.setdefault(k, {}), v)
         elif k in d:
             if not isinstance(d[k], list):
                 d[k] = [d.get(k)]
@@ -540,3 +614,28 @@ class XOpenCTI_TextIndicator(StixIndicator):
 class XOpenCTI_UserAgentIndicator(StixIndicator):
     def __init__(self, **kwargs) -> None:
         super().__init__(**kwargs)
+
+
+INDICATOR_TYPES: Dict[str, type] = {
+    "artifact": ArtifactIndicator,
+    "autonomous-system": AutonomousSystemIndicator,
+    "directory": DirectoryIndicator,
+    "domain-name": DomainNameIndicator,
+    "email-addr": EmailAddrIndicator,
+    "email-message": EmailMessageIndicator,
+    "mime-part-type": EmailMimePartTypeIndicator,
+    "file": FileIndicator,
+    "ipv4-addr": IPv4AddrIndicator,
+    "ipv6-addr": IPv6AddrIndicator,
+    "mac-addr": MacAddrIndicator,
+    "mutex": MutexIndicator,
+    "network-traffic": NetworkTrafficIndicator,
+    "process": ProcessIndicator,
+    "software": SoftwareIndicator,
+    "url": UrlIndicator,
+    "user-account": UserAccountIndicator,
+    "windows-registry-key": WindowsRegistryKeyIndicator,
+    "win-registry-key": WindowsRegistryKeyIndicator,
+    "x509-certificate": X509CertificateIndicator,
+    "x-opencti-hostname": XOpenCTIHostnameIndicator,
+}
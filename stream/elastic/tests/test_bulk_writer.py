@@ -0,0 +1,178 @@
+import json
+from threading import Event
+
+from elasticsearch import ConnectionError, Elasticsearch
+
+from elastic.bulk_writer import BulkWriter, CheckpointHelper
+
+
+class FakeHelper:
+    def __init__(self, state: dict = None):
+        self.state = state
+
+    def get_state(self):
+        return self.state
+
+    def set_state(self, state):
+        self.state = state
+
+
+def bulk_client(
+    requests: list, fail: bool = False, errors: set = set(), unavailable: set = set()
+):
+    client = Elasticsearch()
+
+    def bulk(body, *args, **kwargs):
+        if fail:
+            raise ConnectionError("N/A", "Connection refused", None)
+
+        lines = [json.loads(line) for line in body.splitlines()]
+        # Update actions are followed by their script, index ones by the document
+        actions = lines[0::2]
+        requests.append([list(action.values())[0]["_id"] for action in actions])
+
+        items = []
+        for action in actions:
+            _op, _meta = list(action.items())[0]
+            # Documents written through the alias land in its write index
+            _index = {"opencti": "opencti-000001"}.get(_meta["_index"], _meta["_index"])
+            _result = {"_id": _meta["_id"], "_index": _index}
+            if _meta["_id"] in errors:
+                _result.update({"status": 400, "error": "mapper_parsing"})
+            elif _meta["_id"] in unavailable:
+                _result.update({"status": 503, "error": "unavailable_shards"})
+            else:
+                _result["status"] = 201
+            items.append({_op: _result})
+
+        return {"errors": len(errors) > 0, "items": items}
+
+    client.bulk = bulk
+    return client
+
+
+def test_flush_on_size():
+    requests = []
+    helper = FakeHelper()
+    writer = BulkWriter(bulk_client(requests), Event(), helper, max_size=2)
+    stream = CheckpointHelper(helper, writer)
+
+    writer.index("opencti", "a", {"value": 1})
+    stream.set_state({"connectorLastEventId": "1-0"})
+    assert requests == []
+    assert helper.state is None
+
+    writer.index("opencti", "b", {"value": 2})
+    assert requests == [["a", "b"]]
+    # Documents of event 1 are acknowledged with the request
+    assert helper.state == {"connectorLastEventId": "1-0"}
+
+    stream.set_state({"connectorLastEventId": "2-0"})
+    assert helper.state == {"connectorLastEventId": "2-0"}
+
+
+def test_checkpoint_waits_for_acknowledgement():
+    requests = []
+    helper = FakeHelper({"connectorLastEventId": "0-0"})
+    writer = BulkWriter(bulk_client(requests, fail=True), Event(), helper)
+    stream = CheckpointHelper(helper, writer)
+
+    writer.index("opencti", "a", {"value": 1})
+    stream.set_state({"connectorLastEventId": "1-0"})
+    assert stream.get_state() == {"connectorLastEventId": "1-0"}
+
+    assert writer.flush() is False
+    assert writer.get_pending("a") is not None
+    assert helper.state == {"connectorLastEventId": "0-0"}
+
+    writer.es_client = bulk_client(requests)
+    assert writer.flush() is True
+    assert requests == [["a"]]
+    assert writer.get_pending("a") is None
+    assert helper.state == {"connectorLastEventId": "1-0"}
+
+
+def test_rejected_items_are_dropped():
+    requests = []
+    helper = FakeHelper()
+    writer = BulkWriter(bulk_client(requests, errors={"b"}), Event(), helper)
+
+    for _id in ["a", "b", "c"]:
+        writer.index("opencti", _id, {"value": _id})
+    CheckpointHelper(helper, writer).set_state({"connectorLastEventId": "3-0"})
+
+    assert writer.flush() is True
+    assert requests == [["a", "b", "c"]]
+    assert (writer.indexed, writer.failed) == (2, 1)
+    assert helper.state == {"connectorLastEventId": "3-0"}
+
+
+def test_unavailable_items_are_retried():
+    requests = []
+    helper = FakeHelper({"connectorLastEventId": "0-0"})
+    writer = BulkWriter(bulk_client(requests, unavailable={"b"}), Event(), helper)
+
+    for _id in ["a", "b", "c"]:
+        writer.index("opencti", _id, {"value": _id})
+    CheckpointHelper(helper, writer).set_state({"connectorLastEventId": "3-0"})
+
+    assert writer.flush() is False
+    assert writer.get_pending("a") is None
+    assert writer.get_pending("b") is not None
+    assert helper.state == {"connectorLastEventId": "0-0"}
+
+    writer.es_client = bulk_client(requests)
+    assert writer.flush() is True
+    assert requests == [["a", "b", "c"], ["b"]]
+    assert (writer.indexed, writer.failed) == (3, 0)
+    assert helper.state == {"connectorLastEventId": "3-0"}
+
+
+def test_discarded_documents_are_not_written():
+    requests = []
+    helper = FakeHelper()
+    writer = BulkWriter(bulk_client(requests, fail=True), Event(), helper)
+
+    writer.index("opencti", "a", {"value": 1})
+    writer.index("opencti", "b", {"value": 2})
+    writer.update("opencti", "a", {"source": "", "params": {}})
+    assert writer.flush() is False
+
+    # The document is deleted while the cluster is unavailable
+    writer.discard("a")
+    assert writer.get_pending("a") is None
+
+    writer.es_client = bulk_client(requests)
+    assert writer.flush() is True
+    assert requests == [["b"]]
+
+
+def test_routing_of_acknowledged_documents():
+    requests = []
+    writer = BulkWriter(bulk_client(requests, errors={"b"}), Event(), max_size=10)
+
+    writer.index("opencti", "a", {"value": 1})
+    writer.index("opencti", "b", {"value": 2})
+    assert writer.get_routing("a") == "opencti"
+
+    assert writer.flush() is True
+    assert writer.get_routing("a") == "opencti-000001"
+    assert writer.get_routing("b") is None
+
+    writer.update("opencti-000001", "a", {"source": "", "params": {}})
+    assert writer.flush() is True
+    assert requests == [["a", "b"], ["a"]]
+    assert writer.get_routing("a") == "opencti-000001"
+
+
+def test_routing_cache_is_bounded():
+    writer = BulkWriter(None, Event(), routing_cache_size=2)
+
+    writer.set_routing("a", "opencti-000001")
+    writer.set_routing("b", "opencti-000001")
+    writer.get_routing("a")
+    writer.set_routing("c", "opencti-000002")
+
+    assert writer.get_routing("a") == "opencti-000001"
+    assert writer.get_routing("b") is None
+    assert writer.get_routing("c") == "opencti-000002"
@@ -0,0 +1,235 @@
+from datetime import datetime, timezone
+from threading import Event
+
+import pytest
+from pycti import OpenCTIApiClient
+
+from elastic.bulk_writer import BulkWriter
+from elastic.import_manager import IntelManager
+
+MARKING = {
+    "id": "m-1",
+    "standard_id": "marking-definition--613f2e26-407d-48c7-9eca-b8e91df99dc9",
+    "definition_type": "TLP",
+    "definition": "TLP:WHITE",
+}
+AUTHOR = {
+    "id": "a-1",
+    "standard_id": "identity--7b82b010-b1c0-4dae-981f-7756374a17df",
+    "name": "ACME",
+}
+PHASE = {
+    "id": "k-1",
+    "kill_chain_name": "mitre-attack",
+    "phase_name": "execution",
+    "x_opencti_order": 4,
+}
+
+
+def build_indicator(number: int) -> tuple[dict, dict]:
+    """Return an indicator as read from the API and its stream payload"""
+    value = f"198.51.100.{number}"
+    entity = {
+        "id": f"i-{number}",
+        "standard_id": f"indicator--00000000-0000-4000-8000-{number:012d}",
+        "pattern": f"[ipv4-addr:value = '{value}']",
+        "pattern_type": "stix",
+        "valid_from": "2022-01-01T00:00:00.000Z",
+        "valid_until": "2023-01-01T00:00:00.000Z",
+        "x_opencti_detection": True,
+        "x_opencti_score": 50,
+        "confidence": 75,
+        "revoked": False,
+        "description": "Scanner",
+        "created_at": "2022-01-01T00:00:00.000Z",
+        "updated_at": "2022-01-01T00:00:00.000Z",
+        "externalReferences": [],
+        "objectMarking": [MARKING],
+        "createdBy": AUTHOR,
+        "killChainPhases": [PHASE],
+    }
+    payload = {
+        "id": entity["standard_id"],
+        "x_opencti_id": entity["id"],
+        "type": "indicator",
+        "pattern": entity["pattern"],
+        "pattern_type": "stix",
+        "valid_from": entity["valid_from"],
+        "valid_until": entity["valid_until"],
+        "x_opencti_detection": True,
+        "x_opencti_score": 50,
+        "confidence": 75,
+        "revoked": False,
+        "description": "Scanner",
+        "created": entity["created_at"],
+        "modified": entity["updated_at"],
+        "object_marking_refs": [MARKING["standard_id"]],
+        "created_by_ref": AUTHOR["standard_id"],
+        "kill_chain_phases": [
+            {"kill_chain_name": "mitre-attack", "phase_name": "execution"}
+        ],
+    }
+    return entity, payload
+
+
+class FakeApi:
+    process_multiple_fields = OpenCTIApiClient.process_multiple_fields
+    process_multiple = OpenCTIApiClient.process_multiple
+    process_multiple_ids = OpenCTIApiClient.process_multiple_ids
+
+    def __init__(self, entities: dict):
+        self.entities = entities
+        self.reads = 0
+        self.queries = []
+        self.indicator = self
+
+    def read(self, id):
+        self.reads += 1
+        return self.entities.get(id)
+
+    def query(self, query, variables):
+        self.queries.append(list(variables.values()))
+        data = {}
+        for name, _id in variables.items():
+            entity = self.entities.get(_id)
+            if entity is None:
+                data[f"i{name[2:]}"] = None
+                continue
+            data[f"i{name[2:]}"] = {
+                "id": _id,
+                "objectMarking": {
+                    "edges": [{"node": mark} for mark in entity["objectMarking"]]
+                },
+                "createdBy": entity["createdBy"],
+                "killChainPhases": {
+                    "edges": [{"node": phase} for phase in entity["killChainPhases"]]
+                },
+            }
+        return {"data": data}
+
+
+class FakeHelper:
+    def __init__(self, api):
+        self.api = api
+
+
+def build_manager(monkeypatch, entity_source: str, entities: dict) -> IntelManager:
+    monkeypatch.setattr(IntelManager, "_setup_elasticsearch_index", lambda self: None)
+    writer = BulkWriter(None, Event(), max_size=1000)
+    config = {
+        "connector": {"entity_source": entity_source, "read_batch_size": 10},
+        "output": {"elasticsearch": {"index": "opencti"}},
+        "setup": {"template": {"pattern": "opencti-*"}},
+    }
+    return IntelManager(FakeHelper(FakeApi(entities)), None, config, None, writer)
+
+
+def buffered_documents(manager: IntelManager) -> list[dict]:
+    documents = []
+    for action in manager.bulk_writer._actions:
+        document = dict(action["_source"])
+        document["event"] = {
+            k: v for k, v in document["event"].items() if k != "created"
+        }
+        documents.append((action["_index"], action["_id"], document))
+    return documents
+
+
+@pytest.mark.parametrize("count", [1, 10, 25])
+def test_stream_documents_match_api(monkeypatch, count):
+    timestamp = datetime(2022, 1, 2, tzinfo=timezone.utc)
+    indicators = [build_indicator(number) for number in range(count)]
+    entities = {entity["id"]: entity for entity, _ in indicators}
+
+    api_manager = build_manager(monkeypatch, "api", entities)
+    stream_manager = build_manager(monkeypatch, "stream", entities)
+    for _, payload in indicators:
+        api_manager.import_cti_event(timestamp, dict(payload))
+        stream_manager.import_cti_event(timestamp, dict(payload))
+    stream_manager.import_deferred()
+
+    assert buffered_documents(stream_manager) == buffered_documents(api_manager)
+    assert api_manager.helper.api.reads == count
+    assert stream_manager.helper.api.reads == 0
+    # Only the first batch lacks the marking, author and kill chain phase
+    assert stream_manager.helper.api.queries == [
+        [f"i-{number}" for number in range(min(count, 10))]
+    ]
+
+
+def test_deferred_events_stay_in_order(monkeypatch):
+    timestamp = datetime(2022, 1, 2, tzinfo=timezone.utc)
+    entity, payload = build_indicator(1)
+    manager = build_manager(monkeypatch, "stream", {entity["id"]: entity})
+
+    manager.import_cti_event(timestamp, dict(payload))
+    assert manager.deferred_count() == 1
+    assert manager.bulk_writer._actions == []
+
+    # A second event of the same indicator imports the deferred one first
+    manager.import_cti_event(timestamp, dict(payload, x_opencti_score=80))
+    scores = [
+        action["_source"]["event"]["risk_score"]
+        for action in manager.bulk_writer._actions
+    ]
+    assert scores == [50, 80]
+
+
+class FakeElasticsearch:
+    def __init__(self, index: str = None):
+        self.index = index
+        self.searches = 0
+
+    def search(self, index, body):
+        self.searches += 1
+        if self.index is None:
+            return {"hits": {"hits": []}}
+        return {
+            "hits": {
+                "hits": [
+                    {"_id": body["query"]["ids"]["values"][0], "_index": self.index}
+                ]
+            }
+        }
+
+
+def test_update_is_sent_to_backing_index(monkeypatch):
+    timestamp = datetime(2022, 1, 2, tzinfo=timezone.utc)
+    entity, payload = build_indicator(1)
+    manager = build_manager(monkeypatch, "api", {entity["id"]: entity})
+    manager.es_client = FakeElasticsearch("opencti-2022.01.01-000001")
+
+    update = dict(payload, x_data_update={"replace": {"description": ""}})
+    manager.import_cti_event(timestamp, update, is_update=True)
+    manager.bulk_writer.set_routing(entity["id"], "opencti-2022.01.01-000002")
+    manager.bulk_writer._pending = {}
+    manager.import_cti_event(timestamp, update, is_update=True)
+
+    actions = manager.bulk_writer._actions
+    assert [action["_op_type"] for action in actions] == ["update", "update"]
+    # Only the first update searches the index holding the document
+    assert manager.es_client.searches == 1
+    assert actions[0]["_index"] == "opencti-2022.01.01-000001"
+    assert actions[1]["_index"] == "opencti-2022.01.01-000002"
+
+    fields = actions[0]["script"]["params"]["fields"]
+    assert [(field["path"], field["default"]) for field in fields] == [
+        ("threatintel.indicator", False),
+        ("threatintel.opencti.killchain_phases", True),
+        ("threatintel.indicator.description", False),
+        ("threatintel.opencti.updated_at", False),
+    ]
+    assert fields[0]["value"]["ip"] == ["198.51.100.1"]
+    # The emptied description is removed after the indicator is replaced
+    assert fields[2]["value"] is None
+
+
+def test_update_of_missing_document_is_skipped(monkeypatch):
+    timestamp = datetime(2022, 1, 2, tzinfo=timezone.utc)
+    entity, payload = build_indicator(1)
+    manager = build_manager(monkeypatch, "api", {entity["id"]: entity})
+    manager.es_client = FakeElasticsearch()
+
+    update = dict(payload, x_data_update={"replace": {"x_opencti_score": 90}})
+    assert manager.import_cti_event(timestamp, update, is_update=True) == {}
+    assert manager.bulk_writer._actions == []
@@ -0,0 +1,234 @@
+import json
+from threading import Event
+
+from elastic.sightings_manager import SignalsManager
+
+AUTHOR = {
+    "id": "a-1",
+    "standard_id": "identity--7b82b010-b1c0-4dae-981f-7756374a17df",
+}
+
+
+def standard_id(number: int) -> str:
+    return f"indicator--00000000-0000-4000-8000-{number:012d}"
+
+
+def build_signal(time: str, *matches: tuple) -> dict:
+    return {
+        "signal": {"original_time": time},
+        "threat": {
+            "enrichments": [
+                {"matched": {"index": index, "id": _id, "atomic": atomic}}
+                for index, _id, atomic in matches
+            ]
+        },
+    }
+
+
+class FakeElasticsearch:
+    def __init__(self, signals: list, documents: dict):
+        self.signals = signals
+        self.documents = documents
+        self.searches = []
+        self.mgets = 0
+        self.open_pits = set()
+
+    def ping(self):
+        return True
+
+    def open_point_in_time(self, index, keep_alive):
+        self.open_pits.add("pit-1")
+        return {"id": "pit-1"}
+
+    def close_point_in_time(self, body):
+        self.open_pits.remove(body["id"])
+
+    def search(self, body):
+        assert body["pit"]["id"] in self.open_pits
+        self.searches.append(json.loads(json.dumps(body)))
+        composite = body["aggs"]["matches"]["composite"]
+
+        buckets = {}
+        for signal in self.signals:
+            for enrichment in signal["threat"]["enrichments"]:
+                key = (enrichment["matched"]["index"], enrichment["matched"]["id"])
+                bucket = buckets.setdefault(key, {"times": [], "hits": []})
+                bucket["times"].append(signal["signal"]["original_time"])
+                bucket["hits"].append({"_source": signal})
+
+        after = composite.get("after", None)
+        keys = sorted(
+            key
+            for key in buckets
+            if after is None or key > (after["index"], after["id"])
+        )[: composite["size"]]
+        page = [
+            {
+                "key": {"index": key[0], "id": key[1]},
+                "doc_count": len(buckets[key]["times"]),
+                "first_seen": {"value_as_string": min(buckets[key]["times"])},
+                "last_seen": {"value_as_string": max(buckets[key]["times"])},
+                "signal": {"hits": {"hits": buckets[key]["hits"][:1]}},
+            }
+            for key in keys
+        ]
+        matches = {"buckets": page}
+        if len(page) > 0:
+            matches["after_key"] = page[-1]["key"]
+        return {"pit_id": "pit-1", "aggregations": {"matches": matches}}
+
+    def mget(self, body):
+        self.mgets += 1
+        docs = []
+        for doc in body["docs"]:
+            source = self.documents.get((doc["_index"], doc["_id"]), None)
+            if source is None:
+                docs.append({"_id": doc["_id"], "found": False})
+            else:
+                docs.append({"_id": doc["_id"], "found": True, "_source": source})
+        return {"docs": docs}
+
+
+class FakeApi:
+    def __init__(self, indicators: dict):
+        self.indicators = indicators
+        self.queries = []
+        self.reads = 0
+        self.indicator = self
+        self.stix_domain_object = self
+        self.work = self
+
+    def get_by_stix_id_or_name(self, name):
+        return AUTHOR
+
+    def read(self, filters):
+        self.reads += 1
+        value = filters[1]["values"][0]
+        for _id, (_standard_id, pattern) in self.indicators.items():
+            if pattern == value:
+                return {"id": _id, "standard_id": _standard_id}
+        return None
+
+    def query(self, query, variables):
+        self.queries.append(list(variables.values()))
+        data = {}
+        for name, _id in variables.items():
+            if _id in self.indicators:
+                data[f"i{name[2:]}"] = {
+                    "id": _id,
+                    "standard_id": self.indicators[_id][0],
+                }
+            else:
+                data[f"i{name[2:]}"] = None
+        return {"data": data}
+
+    def initiate_work(self, connector_id, friendly_name):
+        return "work-1"
+
+    def to_processed(self, work_id, message):
+        pass
+
+
+class FakeHelper:
+    connect_id = "connector-1"
+
+    def __init__(self, api):
+        self.api = api
+        self.bundles = []
+
+    def send_stix2_bundle(self, bundle, **kwargs):
+        assert kwargs["work_id"] == "work-1"
+        self.bundles.append(json.loads(bundle))
+
+
+def build_manager(signals: list, documents: dict, indicators: dict) -> SignalsManager:
+    config = {
+        "connector": {"confidence_level": 80},
+        "elastic": {"signals": {"page_size": 2}},
+    }
+    return SignalsManager(
+        config,
+        Event(),
+        FakeHelper(FakeApi(indicators)),
+        FakeElasticsearch(signals, documents),
+    )
+
+
+def opencti_document(_id: str) -> dict:
+    return {"threatintel": {"opencti": {"internal_id": _id}}}
+
+
+def test_sightings_are_aggregated_in_one_bundle():
+    signals = [
+        build_signal("2022-01-01T00:00:02.000Z", ("opencti-1", "i-1", "10.0.0.1")),
+        build_signal("2022-01-01T00:00:01.000Z", ("opencti-1", "i-1", "10.0.0.1")),
+        # The same indicator in a rolled over index
+        build_signal("2022-01-01T00:00:03.000Z", ("opencti-2", "i-1", "10.0.0.1")),
+        build_signal(
+            "2022-01-01T00:00:04.000Z",
+            ("opencti-2", "i-2", "10.0.0.2"),
+            ("other", "x-1", "10.0.0.3"),
+        ),
+        # A deleted indicator
+        build_signal("2022-01-01T00:00:05.000Z", ("opencti-2", "i-4", "10.0.0.4")),
+    ]
+    documents = {
+        ("opencti-1", "i-1"): opencti_document("i-1"),
+        ("opencti-2", "i-1"): opencti_document("i-1"),
+        ("opencti-2", "i-2"): opencti_document("i-2"),
+        ("opencti-2", "i-4"): opencti_document("i-4"),
+        # Document from another source, found from the matched atomic
+        ("other", "x-1"): {"threatintel": {"indicator": {"ip": "10.0.0.3"}}},
+    }
+    indicators = {
+        "i-1": (standard_id(1), "10.0.0.1"),
+        "i-2": (standard_id(2), "10.0.0.2"),
+        "i-3": (standard_id(3), "10.0.0.3"),
+    }
+    manager = build_manager(signals, documents, indicators)
+
+    ids_dict = manager._aggregate_sightings()
+    assert ids_dict["i-1"] == {
+        "first_seen": "2022-01-01T00:00:01.000Z",
+        "last_seen": "2022-01-01T00:00:03.000Z",
+        "count": 3,
+    }
+    assert ids_dict["i-3"]["count"] == 1
+    # Five matched documents in pages of two, each read with a single mget
+    assert len(manager.es_client.searches) == 4
+    assert manager.es_client.mgets == 3
+    assert manager.es_client.open_pits == set()
+
+    assert manager._send_sightings(ids_dict) == 3
+    assert manager.helper.api.queries == [["i-1", "i-2", "i-4"]]
+    [bundle] = manager.helper.bundles
+    sightings = {
+        sighting["sighting_of_ref"]: sighting for sighting in bundle["objects"]
+    }
+    assert set(sightings) == {standard_id(1), standard_id(2), standard_id(3)}
+    assert sightings[standard_id(1)]["count"] == 3
+    assert sightings[standard_id(1)]["where_sighted_refs"] == [AUTHOR["standard_id"]]
+    assert sightings[standard_id(1)]["created_by_ref"] == AUTHOR["standard_id"]
+
+
+def test_indicator_ids_are_cached():
+    signals = [
+        build_signal("2022-01-01T00:00:01.000Z", ("opencti-1", "i-1", "10.0.0.1")),
+        build_signal("2022-01-01T00:00:02.000Z", ("other", "x-1", "10.0.0.3")),
+    ]
+    documents = {
+        ("opencti-1", "i-1"): opencti_document("i-1"),
+        ("other", "x-1"): {},
+    }
+    indicators = {
+        "i-1": (standard_id(1), "10.0.0.1"),
+        "i-3": (standard_id(3), "10.0.0.3"),
+    }
+    manager = build_manager(signals, documents, indicators)
+
+    for _ in range(2):
+        manager._send_sightings(manager._aggregate_sightings())
+
+    assert manager.helper.api.queries == [["i-1"]]
+    assert manager.helper.api.reads == 1
+    assert len(manager.helper.bundles) == 2
@@ -116,3 +116,58 @@ def test_stix2ecs(pattern, expected) -> None:
     result = item.get_ecs_indicator()
 
     assert result == expected
+
+
+simple_patterns = [
+    "[ipv4-addr:value = '198.51.100.1']",
+    "[ipv6-addr:value = '2001:0db8::/96']",
+    "[domain-name:value = 'www.5z8.info']",
+    "[file:hashes.'SHA-256' = 'f6dcd4a5590d8922332ed342c59fe67318153ddd']",
+    "[file:hashes.MD5 = 'e8d77d19e1c6f462f4a5bf6fbe673a3c']",
+    "[autonomous-system:number = 12345]",
+    "[domain-name:resolves_to_refs[*].value = '198.51.100.1/32']",
+    "[process:command_line MATCHES'-add GlobalSign.cer -c -s -r localMachine Root']",
+    "  [ url : value != 'http://example.com/?a=b' ] ",
+]
+
+complex_patterns = [
+    "[ipv4-addr:value = '198.51.100.1' OR ipv4-addr:value = '198.51.100.2']",
+    "[ipv4-addr:value = '198.51.100.1'] AND [ipv4-addr:value = '198.51.100.2']",
+    "[file:name = 'C:\\\\Windows\\\\evil.exe']",
+    "[file:size > 1.5]",
+    "[ipv4-addr:value NOT = '198.51.100.1']",
+    "[ipv4-addr:value IN ('198.51.100.1', '198.51.100.2')]",
+]
+
+
+@pytest.mark.parametrize("pattern", simple_patterns + complex_patterns)
+def test_inspect_pattern(pattern) -> None:
+    from stix2patterns.pattern import Pattern
+
+    from elastic.stix2ecs import RE_SIMPLE_PATTERN, inspect_pattern, parse_template
+
+    assert inspect_pattern(pattern) == Pattern(pattern).inspect().comparisons
+
+    # Only single comparisons take the fast path
+    m = RE_SIMPLE_PATTERN.match(pattern)
+    is_simple = m is not None and parse_template(m.group("template")) is not None
+    assert is_simple == (pattern in simple_patterns)
+
+
+@pytest.mark.parametrize(
+    "pattern",
+    [
+        "[ipv4-addr:value = 'a' AND]",
+        "[ipv4-addr:valueMATCHES 'a']",
+        "[ipv4-addr:value MATCHES 12]",
+        "[ipv4-addr:AND = 'a']",
+        "[ipv4-addr:value = 05]",
+    ],
+)
+def test_inspect_invalid_pattern(pattern) -> None:
+    from stix2patterns.exceptions import ParseException
+
+    from elastic.stix2ecs import inspect_pattern
+
+    with pytest.raises(ParseException):
+        inspect_pattern(pattern)
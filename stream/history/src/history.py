@@ -1,10 +1,220 @@
 import datetime
 import os
+import time
 import yaml
 import json
 
-from elasticsearch import Elasticsearch
-from pycti import OpenCTIConnectorHelper
+from threading import RLock, Thread
+from elasticsearch import Elasticsearch, TransportError
+from elasticsearch.helpers import streaming_bulk
+from pycti import OpenCTIConnectorHelper, get_config_variable
+
+MAX_BACKOFF = 60
+
+
+class HistoryWriter(Thread):
+    """
+    Buffered writer of the history documents sent to Elasticsearch with the
+    `_bulk` API
+
+    The buffer is flushed once `max_size` documents are waiting, and every
+    `flush_interval` seconds by this thread. Documents rejected with a 429 are
+    retried by the bulk helper, the requests failing with a 5xx or a connection
+    error are retried with an exponential backoff. A full buffer is flushed by
+    the live stream callback, which waits for Elasticsearch instead of growing
+    the buffer.
+
+    Buffered documents are also appended to a spool file, rewritten after each
+    flush with the documents not acknowledged yet and reloaded on startup, so
+    that they survive a restart once the live stream moved past their events.
+    """
+
+    def __init__(
+        self,
+        helper,
+        elasticsearch,
+        index,
+        spool_path,
+        max_size,
+        flush_interval,
+        metrics_interval,
+    ):
+        super(HistoryWriter, self).__init__()
+        self.daemon = True
+        self.helper = helper
+        self.elasticsearch = elasticsearch
+        self.index = index
+        self.max_size = max(int(max_size), 1)
+        self.flush_interval = float(flush_interval)
+        self.metrics_interval = float(metrics_interval)
+
+        self.lock = RLock()
+        # (bulk action, time the document was buffered)
+        self._actions = []
+        self._flushing = False
+
+        self.indexed = 0
+        self.failed = 0
+        self._latency_count = 0
+        self._latency_sum = 0.0
+        self._latency_max = 0.0
+
+        self.spool_path = spool_path
+        self._load_spool(spool_path)
+        self._spool = open(spool_path, "a", encoding="utf-8")
+
+    def _load_spool(self, spool_path):
+        if not os.path.isfile(spool_path):
+            return
+        now = time.monotonic()
+        with open(spool_path, encoding="utf-8") as spool:
+            for line in spool:
+                try:
+                    action = json.loads(line)
+                except ValueError:
+                    # Last line of a spool file interrupted while writing
+                    continue
+                self._actions.append((action, now))
+        if len(self._actions) > 0:
+            self.helper.log_info(
+                "Loaded " + str(len(self._actions)) + " documents from the spool file"
+            )
+
+    def add(self, id, document):
+        action = {"_index": self.index, "_id": id, "_source": document}
+        with self.lock:
+            self._actions.append((action, time.monotonic()))
+            self._spool.write(json.dumps(action) + "\n")
+            self._spool.flush()
+
+            if len(self._actions) >= self.max_size and not self._flushing:
+                backoff = 1
+                while not self.flush():
+                    self.helper.log_warning(
+                        "Retrying bulk request of "
+                        + str(len(self._actions))
+                        + " documents in "
+                        + str(backoff)
+                        + "s"
+                    )
+                    time.sleep(backoff)
+                    backoff = min(backoff * 2, MAX_BACKOFF)
+
+    def flush(self):
+        """
+        Send the buffered documents, returns False if some of them have to be
+        retried, in which case they stay buffered and spooled
+        """
+        with self.lock:
+            if len(self._actions) == 0:
+                return True
+
+            self._flushing = True
+            received = {action["_id"]: t for action, t in self._actions}
+            retries = []
+            try:
+                for ok, item in streaming_bulk(
+                    self.elasticsearch,
+                    [action for action, _ in self._actions],
+                    chunk_size=self.max_size,
+                    max_retries=3,
+                    raise_on_error=False,
+                ):
+                    _op, _result = item.popitem()
+                    if ok:
+                        self._record_latency(received[_result["_id"]])
+                        self.indexed += 1
+                    elif (
+                        _result.get("status", 500) == 429
+                        or _result.get("status", 500) >= 500
+                    ):
+                        retries.append(_result["_id"])
+                    else:
+                        # Rejected documents would fail the same way again
+                        self.helper.log_error(
+                            "Unable to index history document "
+                            + str(_result.get("_id"))
+                            + ": "
+                            + str(_result.get("error"))
+                        )
+                        self.failed += 1
+            except TransportError as err:
+                self.helper.log_error("Bulk request failed: " + str(err))
+                return False
+            finally:
+                self._flushing = False
+
+            retries = set(retries)
+            self._actions = [
+                (action, t) for action, t in self._actions if action["_id"] in retries
+            ]
+            self._rewrite_spool()
+            return len(self._actions) == 0
+
+    def _rewrite_spool(self):
+        # The remaining documents replace the spool file at once, so that a crash
+        # while rewriting it leaves either the old or the new spool file
+        tmp_path = self.spool_path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as spool:
+            for action, _ in self._actions:
+                spool.write(json.dumps(action) + "\n")
+            spool.flush()
+            os.fsync(spool.fileno())
+        self._spool.close()
+        os.replace(tmp_path, self.spool_path)
+        self._spool = open(self.spool_path, "a", encoding="utf-8")
+
+    def _record_latency(self, received):
+        latency = time.monotonic() - received
+        self._latency_count += 1
+        self._latency_sum += latency
+        self._latency_max = max(self._latency_max, latency)
+
+    def metrics(self):
+        """Return the writer metrics, the latencies since the last call"""
+        with self.lock:
+            metrics = {
+                "queue_depth": len(self._actions),
+                "indexed": self.indexed,
+                "failed": self.failed,
+                "indexing_latency_avg_ms": round(
+                    1000 * self._latency_sum / self._latency_count, 1
+                )
+                if self._latency_count > 0
+                else None,
+                "indexing_latency_max_ms": round(1000 * self._latency_max, 1),
+            }
+            self._latency_count = 0
+            self._latency_sum = 0.0
+            self._latency_max = 0.0
+            return metrics
+
+    def run(self):
+        backoff = 0
+        last_metrics = time.monotonic()
+        while True:
+            time.sleep(max(self.flush_interval, backoff))
+            try:
+                flushed = self.flush()
+            except Exception as err:
+                # The documents stay buffered and spooled for the next flush
+                self.helper.log_error("Unable to flush the history writer: " + str(err))
+                flushed = False
+            if flushed:
+                backoff = 0
+            else:
+                backoff = min(max(backoff * 2, 1), MAX_BACKOFF)
+                self.helper.log_warning(
+                    "Retrying bulk request of "
+                    + str(len(self._actions))
+                    + " documents in "
+                    + str(backoff)
+                    + "s"
+                )
+
+            if time.monotonic() - last_metrics >= self.metrics_interval:
+                last_metrics = time.monotonic()
+                self.helper.log_info("Metrics: " + json.dumps(self.metrics()))
 
 
 class HistoryConnector:
@@ -48,6 +258,36 @@ class HistoryConnector:
             )
         self.elasticsearch_index = self.logger_config["elasticsearch_index"]
 
+        self.writer = HistoryWriter(
+            self.helper,
+            self.elasticsearch,
+            self.elasticsearch_index,
+            get_config_variable(
+                "HISTORY_SPOOL_PATH",
+                ["history", "spool_path"],
+                config,
+                False,
+                os.path.dirname(os.path.abspath(__file__)) + "/history.spool",
+            ),
+            get_config_variable(
+                "HISTORY_BULK_MAX_SIZE", ["history", "bulk_max_size"], config, True, 500
+            ),
+            get_config_variable(
+                "HISTORY_FLUSH_INTERVAL",
+                ["history", "flush_interval"],
+                config,
+                True,
+                1,
+            ),
+            get_config_variable(
+                "HISTORY_METRICS_INTERVAL",
+                ["history", "metrics_interval"],
+                config,
+                True,
+                60,
+            ),
+        )
+
     def _process_message(self, msg):
         try:
             event_json = json.loads(msg.data)
@@ -86,14 +326,15 @@ class HistoryConnector:
                     else None,
                 },
             }
-            self.elasticsearch.index(
-                index=self.elasticsearch_index, id=msg.id, body=history_data
-            )
         except Exception as err:
-            print("Unexpected error:", err, msg)
-            pass
+            self.helper.log_error(
+                "Unable to build the history of event " + msg.id + ": " + str(err)
+            )
+            return
+        self.writer.add(msg.id, history_data)
 
     def start(self):
+        self.writer.start()
         self.helper.listen_stream(self._process_message)
 
 
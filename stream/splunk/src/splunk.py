@@ -3,11 +3,148 @@
 ################################
 
 import os
+import time
 import yaml
 import json
 import requests
 
+from collections import OrderedDict
+from threading import RLock, Thread
+from requests.adapters import HTTPAdapter
 from pycti import OpenCTIConnectorHelper, get_config_variable
+from pycti.connector.opencti_connector_helper import ListenStream
+
+MAX_BACKOFF = 60
+# Default max_documents_per_batch_save of the Splunk KV Store
+MAX_BATCH_SIZE = 1000
+# Number of keys of a single delete query
+DELETE_BATCH_SIZE = 100
+
+
+class KVStoreWriter(Thread):
+    """
+    Buffered writer of the KV Store records
+
+    Creations and updates are sent with `batch_save` once `batch_size` records
+    are waiting, and every `flush_interval` seconds by this thread. Only the last
+    operation of each `_key` is kept in the batch, deletions included, so the
+    final content of the KV Store is the same as when applying the events in
+    order. The live stream state only advances once the operations of the
+    events received before it have been acknowledged by Splunk.
+    """
+
+    def __init__(self, connector, batch_size, flush_interval):
+        super(KVStoreWriter, self).__init__()
+        self.daemon = True
+        self.connector = connector
+        self.helper = connector.helper
+        self.batch_size = min(max(int(batch_size), 1), MAX_BATCH_SIZE)
+        self.flush_interval = float(flush_interval)
+
+        self.lock = RLock()
+        # Record key -> last record to save, or None to delete it
+        self._batch = OrderedDict()
+        # Last stream state received and last one handed to the helper
+        self._state = None
+        self._committed_state = None
+        self._last_flush = time.monotonic()
+
+    def save(self, record):
+        self._add(record["_key"], record)
+
+    def delete(self, key):
+        self._add(key, None)
+
+    def _add(self, key, record):
+        with self.lock:
+            self._batch[key] = record
+            if len(self._batch) >= self.batch_size:
+                self._flush_until_acknowledged()
+
+    def get_state(self):
+        with self.lock:
+            if self._state is not None:
+                return dict(self._state)
+        return self.helper.get_state()
+
+    def set_state(self, state):
+        with self.lock:
+            self._state = dict(state)
+            if len(self._batch) == 0:
+                self._commit_state()
+
+    def flush(self):
+        """Send the buffered operations, returns False if a request failed"""
+        with self.lock:
+            self._last_flush = time.monotonic()
+            if len(self._batch) > 0:
+                records = [r for r in self._batch.values() if r is not None]
+                deleted_keys = [k for k, r in self._batch.items() if r is None]
+
+                if len(records) > 0 and not self.connector._batch_save(records):
+                    return False
+                for i in range(0, len(deleted_keys), DELETE_BATCH_SIZE):
+                    if not self.connector._delete_keys(
+                        deleted_keys[i : i + DELETE_BATCH_SIZE]
+                    ):
+                        return False
+                self._batch = OrderedDict()
+
+            self._commit_state()
+            return True
+
+    def _flush_until_acknowledged(self):
+        backoff = 1
+        while not self.flush():
+            self.helper.log_warning(
+                "Retrying to send "
+                + str(len(self._batch))
+                + " records in "
+                + str(backoff)
+                + "s"
+            )
+            time.sleep(backoff)
+            backoff = min(backoff * 2, MAX_BACKOFF)
+
+    def _commit_state(self):
+        if self._state is None or self._state == self._committed_state:
+            return
+        self.helper.set_state(self._state)
+        self._committed_state = self._state
+
+    def run(self):
+        while True:
+            wait = self._last_flush + self.flush_interval - time.monotonic()
+            if wait > 0:
+                time.sleep(wait)
+                continue
+            try:
+                self.flush()
+            except Exception as e:
+                # The batch stays buffered for the next flush
+                self.helper.log_error("Unable to flush the records: " + str(e))
+
+
+class CheckpointHelper:
+    """
+    Helper given to the live stream listener, which saves its position after
+    each message while the records of the message may still be buffered. The
+    KVStoreWriter holds that position until Splunk acknowledged the batch_save
+    and the deletions of the previous messages.
+    """
+
+    def __init__(self, helper, writer):
+        self.helper = helper
+        self.writer = writer
+
+    def __getattr__(self, name):
+        return getattr(self.helper, name)
+
+    def get_state(self):
+        return self.writer.get_state()
+
+    def set_state(self, state):
+        self.writer.set_state(state)
 
 
 class SplunkConnector:
@@ -38,6 +175,18 @@ class SplunkConnector:
         self.splunk_kv_store_name = get_config_variable(
             "SPLUNK_KV_STORE_NAME", ["splunk", "kv_store_name"], config
         )
+        self.splunk_batch_size = get_config_variable(
+            "SPLUNK_BATCH_SIZE", ["splunk", "batch_size"], config, True, 500
+        )
+        if self.splunk_batch_size > MAX_BATCH_SIZE:
+            self.helper.log_warning(
+                "Batch size limited to the "
+                + str(MAX_BATCH_SIZE)
+                + " records of a Splunk batch_save"
+            )
+        self.splunk_flush_interval = get_config_variable(
+            "SPLUNK_FLUSH_INTERVAL", ["splunk", "flush_interval"], config, True, 5
+        )
 
         if (
             self.helper.connect_live_stream_id is None
@@ -45,11 +194,33 @@ class SplunkConnector:
         ):
             raise ValueError("Missing Live Stream ID")
 
+        # Keep the connections to Splunk open and authenticate once
+        self.session = requests.Session()
+        self.session.verify = self.splunk_ssl_verify
+        self.session.mount("https://", HTTPAdapter(pool_maxsize=4, max_retries=3))
+        self.session.mount("http://", HTTPAdapter(pool_maxsize=4, max_retries=3))
+        self._login()
+
         # Initialize the KV Store
         self._query("post", "/config", {"name": self.splunk_kv_store_name})
+        self.writer = KVStoreWriter(
+            self, self.splunk_batch_size, self.splunk_flush_interval
+        )
 
-    def _query(self, method, uri, payload=None, is_json=False):
-        self.helper.log_info("Query " + method + " on " + uri)
+    def _login(self):
+        r = self.session.post(
+            self.splunk_url + "/services/auth/login",
+            data={
+                "username": self.splunk_login,
+                "password": self.splunk_password,
+                "output_mode": "json",
+            },
+        )
+        r.raise_for_status()
+        self.session.headers["Authorization"] = "Splunk " + r.json()["sessionKey"]
+
+    def _request(self, method, uri, payload=None, is_json=False, params=None):
+        self.helper.log_debug("Query " + method + " on " + uri)
         url = (
             self.splunk_url
             + "/servicesNS/"
@@ -60,46 +231,96 @@ class SplunkConnector:
             + uri
         )
         if method == "get":
-            r = requests.get(
-                url,
-                auth=(self.splunk_login, self.splunk_password),
-                params=payload,
-                verify=self.splunk_ssl_verify,
-            )
+            kwargs = {"params": payload}
         elif method == "post":
             if is_json:
-                headers = {"content-type": "application/json"}
-                r = requests.post(
-                    url,
-                    auth=(self.splunk_login, self.splunk_password),
-                    headers=headers,
-                    json=payload,
-                    verify=self.splunk_ssl_verify,
-                )
+                kwargs = {"json": payload}
             else:
-                r = requests.post(
-                    url,
-                    auth=(self.splunk_login, self.splunk_password),
-                    data=payload,
-                    verify=self.splunk_ssl_verify,
-                )
+                kwargs = {"data": payload}
         elif method == "delete":
-            r = requests.delete(
-                url,
-                auth=(self.splunk_login, self.splunk_password),
-                verify=self.splunk_ssl_verify,
-            )
+            kwargs = {"params": params}
         else:
             raise ValueError("Unsupported method")
 
-        if r.status_code < 500:
-            print(r.text)
+        r = self.session.request(method, url, **kwargs)
+        if r.status_code == 401:
+            # The session key expired
+            self._login()
+            r = self.session.request(method, url, **kwargs)
+        return r
+
+    def _query(self, method, uri, payload=None, is_json=False, params=None):
+        r = self._request(method, uri, payload, is_json, params)
+        # Only a 2xx status acknowledges the request, None is returned otherwise
+        if r.ok:
             try:
                 return r.json()
             except:
                 return r.text
         else:
-            self.helper.log_info(r.text)
+            self.helper.log_info(str(r.status_code) + " " + r.text)
+
+    def _is_acknowledged(self, r, description):
+        """
+        Return True if the request succeeded, None if Splunk rejected it, which
+        would happen again, or False if it has to be retried
+        """
+        if r.ok:
+            return True
+        message = "Splunk " + description + ": " + str(r.status_code) + " " + r.text
+        if r.status_code == 429 or r.status_code >= 500:
+            self.helper.log_warning(message)
+            return False
+        self.helper.log_error(message)
+        return None
+
+    def _batch_save(self, records):
+        """Save the records, returns False if the batch has to be retried"""
+        self.helper.log_info("Saving " + str(len(records)) + " records")
+        try:
+            r = self._request(
+                "post",
+                "/data/" + self.splunk_kv_store_name + "/batch_save",
+                records,
+                True,
+            )
+        except requests.RequestException as e:
+            self.helper.log_error(str(e))
+            return False
+        acknowledged = self._is_acknowledged(
+            r, "batch_save of " + str(len(records)) + " records"
+        )
+        if acknowledged is not None:
+            return acknowledged
+        if len(records) == 1:
+            # Dropped, it would be rejected on every retry
+            self.helper.log_error("Dropping record " + str(records[0].get("_key")))
+            return True
+        # Save the valid records of the batch
+        middle = len(records) // 2
+        return self._batch_save(records[:middle]) and self._batch_save(records[middle:])
+
+    def _delete_keys(self, keys):
+        """Delete the records, returns False if the keys have to be retried"""
+        self.helper.log_info("Deleting " + str(len(keys)) + " records")
+        # An empty query would delete the whole collection
+        if len(keys) == 0:
+            return True
+        query = {"$or": [{"_key": key} for key in keys]}
+        try:
+            r = self._request(
+                "delete",
+                "/data/" + self.splunk_kv_store_name,
+                params={"query": json.dumps(query)},
+            )
+        except requests.RequestException as e:
+            self.helper.log_error(str(e))
+            return False
+        acknowledged = self._is_acknowledged(
+            r, "deletion of " + str(len(keys)) + " records"
+        )
+        # Rejected deletions are dropped, they would fail on every retry
+        return acknowledged is not False
 
     def _process_message(self, msg):
         try:
@@ -108,37 +329,37 @@ class SplunkConnector:
             raise ValueError("Cannot process the message: " + msg)
         # Handle creation
         if msg.event == "create":
-            self.helper.log_info(
+            self.helper.log_debug(
                 "[CREATE] Processing data {" + data["x_opencti_id"] + "}"
             )
             data["_key"] = data["x_opencti_id"]
-            return self._query("post", "/data/" + self.splunk_kv_store_name, data, True)
+            return self.writer.save(data)
         # Handle update
         if msg.event == "update":
-            self.helper.log_info(
+            self.helper.log_debug(
                 "[UPDATE] Processing data {" + data["x_opencti_id"] + "}"
             )
             data["_key"] = data["x_opencti_id"]
-            return self._query(
-                "post",
-                "/data/" + self.splunk_kv_store_name + "/" + data["x_opencti_id"],
-                data,
-                True,
-            )
+            return self.writer.save(data)
         # Handle delete
         elif msg.event == "delete":
-            self.helper.log_info(
+            self.helper.log_debug(
                 "[DELETE] Processing data {" + data["x_opencti_id"] + "}"
             )
-            return self._query(
-                "delete",
-                "/data/" + self.splunk_kv_store_name + "/" + data["x_opencti_id"],
-                data,
-            )
+            return self.writer.delete(data["x_opencti_id"])
         return None
 
     def start(self):
-        self.helper.listen_stream(self._process_message)
+        self.writer.start()
+        ListenStream(
+            CheckpointHelper(self.helper, self.writer),
+            self._process_message,
+            None,
+            None,
+            None,
+            None,
+            None,
+        ).start()
 
 
 if __name__ == "__main__":
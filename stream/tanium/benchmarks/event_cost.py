@@ -0,0 +1,143 @@
+"""
+Benchmark of the intel cache per stream event
+
+Fills the cache with maps of growing sizes, then measures the cost of the
+cache operations of a stream event (a lookup, then a creation or a deletion)
+with the cache stored in the connector state, as the connector did before, and
+with the in-memory cache. The connector state is a JSON string, like in the
+OpenCTI connector helper, so each access parses and serialises the whole map.
+
+Usage: PYTHONPATH=src python benchmarks/event_cost.py [sizes...]
+"""
+
+import json
+import os
+import sys
+import tempfile
+import time
+
+from intel_cache import IntelCache
+
+DEFAULT_SIZES = [1000, 10000, 100000, 300000]
+
+
+class StateHelper:
+    """Connector state handling of the OpenCTI connector helper"""
+
+    def __init__(self):
+        self.connector_state = None
+
+    def get_state(self):
+        if self.connector_state:
+            state = json.loads(self.connector_state)
+            if isinstance(state, dict) and state:
+                return state
+        return None
+
+    def set_state(self, state):
+        self.connector_state = json.dumps(state)
+
+    def log_info(self, msg):
+        pass
+
+    def log_debug(self, msg):
+        pass
+
+    def log_error(self, msg):
+        pass
+
+
+class StateIntelCache:
+    """Intel cache stored in the connector state"""
+
+    def __init__(self, helper):
+        self.helper = helper
+
+    def get(self, type, opencti_entity_id):
+        current_state = self.helper.get_state()
+        if current_state is not None and type in current_state:
+            return current_state[type].get(opencti_entity_id, None)
+        return None
+
+    def set(self, type, opencti_entity_id, tanium_intel_id):
+        current_state = self.helper.get_state() or {}
+        current_state.setdefault(type, {})[opencti_entity_id] = tanium_intel_id
+        self.helper.set_state(current_state)
+
+    def delete(self, type, opencti_entity_id):
+        current_state = self.helper.get_state()
+        if current_state is not None and opencti_entity_id in current_state.get(
+            type, {}
+        ):
+            del current_state[type][opencti_entity_id]
+            self.helper.set_state(current_state)
+
+
+def entity_id(number):
+    return "indicator--00000000-0000-4000-8000-" + str(number).zfill(12)
+
+
+def fill(size):
+    helper = StateHelper()
+    helper.set_state(
+        {
+            "connectorLastEventId": "1640995200000-0",
+            "intel": {entity_id(i): str(i) for i in range(size)},
+        }
+    )
+    return helper
+
+
+def run_events(cache, size, events):
+    """Time the lookups and writes of `events` stream events"""
+    start = time.perf_counter()
+    for i in range(events):
+        new_id = entity_id(size + i)
+        if cache.get("intel", new_id) is None:
+            cache.set("intel", new_id, str(size + i))
+        old_id = entity_id(i)
+        if cache.get("intel", old_id) is not None:
+            cache.delete("intel", old_id)
+    return (time.perf_counter() - start) / events
+
+
+def main(sizes):
+    print(
+        "%10s %18s %18s %14s %14s"
+        % ("ids", "state (ms/event)", "memory (us/event)", "load (ms)", "snapshot (ms)")
+    )
+    with tempfile.TemporaryDirectory() as tmp:
+        for size in sizes:
+            path = os.path.join(tmp, "intel_cache_" + str(size) + ".tsv")
+            # Few events on the state cache, each one takes time of the map size
+            state_cost = run_events(StateIntelCache(fill(size)), size, 20)
+
+            # First start, moving the map from the connector state
+            cache = IntelCache(fill(size), path, size, 3600)
+            memory_cost = run_events(cache, size, min(size, 20000))
+            start = time.perf_counter()
+            cache.snapshot()
+            snapshot_time = time.perf_counter() - start
+
+            # Next start, from the snapshot
+            start = time.perf_counter()
+            loaded = IntelCache(StateHelper(), path)
+            load_time = time.perf_counter() - start
+            assert loaded.get("intel", entity_id(size + 1)) == str(size + 1)
+            assert loaded.get("intel", entity_id(1)) is None
+            assert loaded.get_opencti_id("intel", size + 1) == entity_id(size + 1)
+
+            print(
+                "%10d %18.3f %18.3f %14.1f %14.1f"
+                % (
+                    size,
+                    state_cost * 1000,
+                    memory_cost * 1000000,
+                    load_time * 1000,
+                    snapshot_time * 1000,
+                )
+            )
+
+
+if __name__ == "__main__":
+    main([int(arg) for arg in sys.argv[1:]] or DEFAULT_SIZES)
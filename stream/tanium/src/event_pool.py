@@ -0,0 +1,125 @@
+##############
+# EVENT POOL #
+##############
+#
+# Bounded pool of workers processing the stream events. The events of an entity
+# always go to the same worker, so they are processed in order, while the
+# events of different entities are processed concurrently. The submission
+# blocks once the queue of the worker is full.
+#
+# The stream checkpoint of the processed events is only committed by the intel
+# cache, once their changes are in its snapshot (see IntelCache.flush).
+
+import threading
+
+from collections import deque
+from queue import Queue
+
+
+class EventPool:
+    def __init__(self, helper, workers=4, queue_size=100):
+        self.helper = helper
+        self.queues = [Queue(maxsize=max(int(queue_size), 1)) for _ in range(workers)]
+        self.threads = [
+            threading.Thread(target=self._work, args=(queue,), daemon=True)
+            for queue in self.queues
+        ]
+
+        self.lock = threading.Lock()
+        # Sequence of the last submitted event, and the ones not processed yet
+        self._sequence = 0
+        self._unfinished = set()
+        # States received from the live stream, with the last submitted event
+        self._states = deque()
+        self._last_state = None
+        # Last state received after events all processed, and last committed
+        self._processed_state = None
+        self._committed_state = None
+        # The stream and the sightings checkpoints share the connector state
+        self.state_lock = threading.Lock()
+
+    def start(self):
+        for thread in self.threads:
+            thread.start()
+
+    def submit(self, key, function, *args):
+        with self.lock:
+            self._sequence += 1
+            sequence = self._sequence
+            self._unfinished.add(sequence)
+        self.queues[hash(key) % len(self.queues)].put((sequence, function, args))
+
+    def _work(self, queue):
+        while True:
+            sequence, function, args = queue.get()
+            try:
+                function(*args)
+            except Exception as e:
+                self.helper.log_error(str(e))
+            with self.lock:
+                self._unfinished.discard(sequence)
+                self._commit_states()
+
+    def get_state(self):
+        with self.lock:
+            if self._last_state is not None:
+                return dict(self._last_state)
+        current_state = self.helper.get_state()
+        if current_state is not None:
+            # The state may only hold the sightings checkpoint
+            current_state.setdefault("connectorLastEventId", "-")
+        return current_state
+
+    def set_state(self, state):
+        with self.lock:
+            self._last_state = dict(state)
+            self._states.append((self._sequence, self._last_state))
+            self._commit_states()
+
+    def _commit_states(self):
+        """Keep the last state received after events all processed"""
+        processed = min(self._unfinished) - 1 if self._unfinished else self._sequence
+        while len(self._states) > 0 and self._states[0][0] <= processed:
+            self._processed_state = self._states.popleft()[1]
+
+    def processed_state(self):
+        """Return the last state received after events all processed"""
+        with self.lock:
+            return self._processed_state
+
+    def commit_state(self, state):
+        """Commit a state returned by `processed_state`"""
+        if state is None or state is self._committed_state:
+            return
+        # Only the stream checkpoint, the sightings one is set by their thread
+        self.update_state("connectorLastEventId", state["connectorLastEventId"])
+        self._committed_state = state
+
+    def update_state(self, key, value):
+        """Set one key of the connector state, keeping the other ones"""
+        with self.state_lock:
+            current_state = self.helper.get_state() or {}
+            current_state[key] = value
+            self.helper.set_state(current_state)
+
+
+class CheckpointHelper:
+    """
+    Helper of the live stream listener for events processed concurrently: the
+    position saved after an event is held by the EventPool until the event and
+    all the earlier ones are processed, then committed by the intel cache with
+    the snapshot of their changes.
+    """
+
+    def __init__(self, helper, pool):
+        self.helper = helper
+        self.pool = pool
+
+    def __getattr__(self, name):
+        return getattr(self.helper, name)
+
+    def get_state(self):
+        return self.pool.get_state()
+
+    def set_state(self, state):
+        self.pool.set_state(state)
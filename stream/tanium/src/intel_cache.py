@@ -1,40 +1,188 @@
 ###############
 # INTEL CACHE #
 ###############
+#
+# Map of the OpenCTI entities to their Tanium intel and reputation ids, kept in
+# memory with a reverse index and written behind to a snapshot file:
+#
+#   <type>\t<OpenCTI id>\t<Tanium id>
+#
+# The snapshot is written every `snapshot_changes` changes or, if anything
+# changed, every `snapshot_interval` seconds, to a temporary file replacing the
+# previous snapshot. The map was formerly stored in the connector state, it is
+# moved to the snapshot on the first start.
+#
+# The stream checkpoint of the events processed by the EventPool is committed
+# after each snapshot, so that it never goes past ids missing from the snapshot.
 
+import os
+import time
 
-class IntelCache:
-    def __init__(self, helper):
+from threading import Event, Lock, Thread
+
+CACHE_TYPES = ["intel", "reputation"]
+
+
+class IntelCache(Thread):
+    def __init__(
+        self,
+        helper,
+        path,
+        snapshot_changes=1000,
+        snapshot_interval=10,
+        event_pool=None,
+    ):
+        super(IntelCache, self).__init__()
+        self.daemon = True
         self.helper = helper
+        self.event_pool = event_pool
+        self.path = path
+        self.snapshot_changes = max(int(snapshot_changes), 1)
+        self.snapshot_interval = float(snapshot_interval)
 
-    def get(self, type, opencti_entity_id):
-        current_state = self.helper.get_state()
-        if current_state is not None:
-            if type in current_state:
-                if opencti_entity_id in current_state[type]:
-                    return current_state[type][opencti_entity_id]
-        return None
+        self.lock = Lock()
+        self.snapshot_lock = Lock()
+        self.wake_up = Event()
+        # Type -> OpenCTI id -> Tanium id, and the reverse index
+        self._ids = {type: {} for type in CACHE_TYPES}
+        self._reverse = {type: {} for type in CACHE_TYPES}
+        self._changes = 0
+        self._load()
 
-    def set(self, type, opencti_entity_id, tanium_intel_id):
+    def _load(self):
+        if os.path.isfile(self.path):
+            count = 0
+            with open(self.path, encoding="utf-8") as file:
+                for line in file:
+                    parts = line.rstrip("\n").split("\t")
+                    if len(parts) != 3:
+                        continue
+                    self._add(*parts)
+                    count += 1
+            self.helper.log_info(
+                "Loaded " + str(count) + " cached ids from " + self.path
+            )
+            return
+
+        # Move the ids stored in the connector state to the snapshot
         current_state = self.helper.get_state()
-        if current_state is not None:
-            if type in current_state:
-                current_state[type][opencti_entity_id] = tanium_intel_id
-            else:
-                current_state[type] = {}
-                current_state[type][opencti_entity_id] = tanium_intel_id
-        else:
-            current_state = {}
-            current_state[opencti_entity_id] = tanium_intel_id
+        if current_state is None:
+            return
+        legacy_types = [
+            type
+            for type in CACHE_TYPES
+            if isinstance(current_state.get(type, None), dict)
+        ]
+        if len(legacy_types) == 0:
+            return
+        for type in legacy_types:
+            for opencti_entity_id, tanium_id in current_state[type].items():
+                self._add(type, opencti_entity_id, str(tanium_id))
+        self.snapshot()
+        for type in legacy_types:
+            del current_state[type]
         self.helper.set_state(current_state)
+        self.helper.log_info(
+            "Moved "
+            + str(sum(len(ids) for ids in self._ids.values()))
+            + " cached ids from the connector state to "
+            + self.path
+        )
+
+    def _add(self, type, opencti_entity_id, tanium_id):
+        ids = self._ids.setdefault(type, {})
+        reverse = self._reverse.setdefault(type, {})
+        previous_id = ids.get(opencti_entity_id, None)
+        if previous_id is not None:
+            reverse.pop(previous_id, None)
+        ids[opencti_entity_id] = tanium_id
+        reverse[tanium_id] = opencti_entity_id
+
+    def _changed(self):
+        self._changes += 1
+        if self._changes >= self.snapshot_changes:
+            self.wake_up.set()
+
+    def get(self, type, opencti_entity_id):
+        with self.lock:
+            return self._ids.get(type, {}).get(opencti_entity_id, None)
+
+    def get_opencti_id(self, type, tanium_id):
+        """Return the OpenCTI id of a Tanium intel or reputation id"""
+        with self.lock:
+            return self._reverse.get(type, {}).get(str(tanium_id), None)
+
+    def set(self, type, opencti_entity_id, tanium_intel_id):
+        with self.lock:
+            self._add(type, opencti_entity_id, str(tanium_intel_id))
+            self._changed()
         return tanium_intel_id
 
     def delete(self, type, opencti_entity_id):
-        current_state = self.helper.get_state()
-        if current_state is None:
-            return
-        if current_state is not None:
-            if type in current_state and opencti_entity_id in current_state[type]:
-                del current_state[type][opencti_entity_id]
-                self.helper.set_state(current_state)
-        return
+        with self.lock:
+            tanium_id = self._ids.get(type, {}).pop(opencti_entity_id, None)
+            if tanium_id is None:
+                return
+            self._reverse[type].pop(tanium_id, None)
+            self._changed()
+
+    def snapshot(self):
+        """Write the cached ids to the snapshot file"""
+        with self.snapshot_lock:
+            self._write_snapshot()
+
+    def flush(self):
+        """
+        Write the snapshot if the cached ids changed, then commit the stream
+        checkpoint of the events whose changes it holds
+        """
+        with self.snapshot_lock:
+            # Read first, the changes of these events are counted already
+            state = (
+                self.event_pool.processed_state()
+                if self.event_pool is not None
+                else None
+            )
+            if self._changes > 0:
+                self._write_snapshot()
+            if self.event_pool is not None:
+                self.event_pool.commit_state(state)
+
+    def _write_snapshot(self):
+        with self.lock:
+            lines = [
+                type + "\t" + opencti_entity_id + "\t" + tanium_id + "\n"
+                for type, ids in self._ids.items()
+                for opencti_entity_id, tanium_id in ids.items()
+            ]
+            changes = self._changes
+        directory = os.path.dirname(self.path)
+        if directory != "" and not os.path.exists(directory):
+            os.makedirs(directory)
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as file:
+            file.writelines(lines)
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(tmp_path, self.path)
+        with self.lock:
+            self._changes -= changes
+        self.helper.log_debug(
+            "Wrote " + str(len(lines)) + " cached ids to " + self.path
+        )
+
+    def close(self):
+        self.flush()
+
+    def run(self):
+        while True:
+            self.wake_up.wait(self.snapshot_interval)
+            self.wake_up.clear()
+            try:
+                self.flush()
+            except Exception as e:
+                self.helper.log_error(
+                    "Cannot write the intel cache snapshot: " + str(e)
+                )
+                # Do not retry before the next interval
+                time.sleep(self.snapshot_interval)
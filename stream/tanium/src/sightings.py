@@ -5,14 +5,32 @@
 import threading
 import time
 
+from datetime import datetime, timezone
 from dateutil.parser import parse
+from pycti import OpenCTIStix2Utils
+from stix2 import Bundle, Sighting
+
+# Alerts read per query
+PAGE_SIZE = 500
+# Entities resolved per GraphQL query
+READ_BATCH_SIZE = 100
+# Sightings of observables are sent with this indicator and the observable in
+# x_opencti_sighting_of_ref, as STIX only allows sightings of domain objects
+FAKE_INDICATOR_ID = "indicator--c1034564-a9fb-429b-a1c1-c80116cc8e1e"
 
 
 class Sightings(threading.Thread):
-    def __init__(self, helper, tanium_api_handler):
+    def __init__(self, helper, tanium_api_handler, intel_cache, event_pool):
         threading.Thread.__init__(self)
         self.helper = helper
         self.tanium_api_handler = tanium_api_handler
+        self.intel_cache = intel_cache
+        self.event_pool = event_pool
+        # Intel documents not in the intel cache, found from their external
+        # reference: Tanium intel document id -> OpenCTI entity id
+        self.entity_ids = {}
+        # OpenCTI entity id -> (standard id, is an observable)
+        self.standard_ids = {}
 
         # Identity
         self.identity = self.helper.api.identity.create(
@@ -21,74 +39,180 @@ class Sightings(threading.Thread):
             description=self.helper.get_name(),
         )
 
-    def run(self):
-        self.helper.log_info("[SIGHTINGS] Starting alerts gatherer")
+    def _get_alerts(self, last_timestamp):
+        """Yield the alerts created from the last timestamp, oldest first"""
+        created_from = datetime.fromtimestamp(last_timestamp, timezone.utc)
+        offset = 0
         while True:
             alerts = self.tanium_api_handler._query(
-                "get", "/plugin/products/detect3/api/v1/alerts", {"sort": "-createdAt"}
+                "get",
+                "/plugin/products/detect3/api/v1/alerts",
+                {
+                    "sort": "createdAt",
+                    "createdAtFrom": created_from.strftime("%Y-%m-%dT%H:%M:%S.000Z"),
+                    "limit": PAGE_SIZE,
+                    "offset": offset,
+                },
             )
-            state = self.helper.get_state()
-            if state and "lastAlertTimestamp" in state:
-                last_timestamp = state["lastAlertTimestamp"]
-            else:
-                last_timestamp = 0
-            alerts = reversed(alerts)
+            if not isinstance(alerts, list):
+                return
             for alert in alerts:
-                alert_timestamp = parse(alert["createdAt"]).timestamp()
-                if int(alert_timestamp) > int(last_timestamp):
-                    # Mark as processed
-                    if state is not None:
-                        state["lastAlertTimestamp"] = int(
-                            round(parse(alert["createdAt"]).timestamp())
-                        )
-                        self.helper.set_state(state)
-                    else:
-                        self.helper.set_state(
-                            {
-                                "lastAlertTimestamp": int(
-                                    round(parse(alert["createdAt"]).timestamp())
-                                )
-                            }
-                        )
-                    # Check if the intel is in OpenCTI
-                    external_reference = self.helper.api.external_reference.read(
-                        filters=[
-                            {"key": "source_name", "values": ["Tanium"]},
-                            {
-                                "key": "external_id",
-                                "values": [str(alert["intelDocId"])],
-                            },
-                        ]
+                yield alert
+            if len(alerts) < PAGE_SIZE:
+                return
+            offset += len(alerts)
+
+    def _get_entity_id(self, intel_document_id):
+        """Return the OpenCTI id of the entity of an intel document"""
+        intel_document_id = str(intel_document_id)
+        entity_id = self.intel_cache.get_opencti_id("intel", intel_document_id)
+        if entity_id is not None:
+            return entity_id
+        if intel_document_id in self.entity_ids:
+            return self.entity_ids[intel_document_id]
+
+        # Intel document imported by another connector instance
+        external_reference = self.helper.api.external_reference.read(
+            filters=[
+                {"key": "source_name", "values": ["Tanium"]},
+                {"key": "external_id", "values": [intel_document_id]},
+            ]
+        )
+        if external_reference is None:
+            return None
+        entity = self.helper.api.stix_domain_object.read(
+            filters=[
+                {"key": "hasExternalReference", "values": [external_reference["id"]]}
+            ]
+        )
+        if entity is None:
+            entity = self.helper.api.stix_cyber_observable.read(
+                filters=[
+                    {
+                        "key": "hasExternalReference",
+                        "values": [external_reference["id"]],
+                    }
+                ]
+            )
+        if entity is None:
+            return None
+        self.entity_ids[intel_document_id] = entity["id"]
+        return entity["id"]
+
+    def _resolve_standard_ids(self, entity_ids):
+        """Read the standard ids of the entities not resolved yet"""
+        missing = [
+            entity_id for entity_id in entity_ids if entity_id not in self.standard_ids
+        ]
+        for i in range(0, len(missing), READ_BATCH_SIZE):
+            batch = missing[i : i + READ_BATCH_SIZE]
+            variables = ", ".join(
+                "$id" + str(n) + ": String!" for n in range(len(batch))
+            )
+            fields = "\n".join(
+                "e"
+                + str(n)
+                + ": stixCoreObject(id: $id"
+                + str(n)
+                + ") { id standard_id parent_types }"
+                for n in range(len(batch))
+            )
+            result = self.helper.api.query(
+                "query SightedEntities(" + variables + ") {\n" + fields + "\n}",
+                {"id" + str(n): entity_id for n, entity_id in enumerate(batch)},
+            )
+            for n, entity_id in enumerate(batch):
+                entity = result["data"]["e" + str(n)]
+                if entity is None:
+                    self.helper.log_info(
+                        "[SIGHTINGS] Entity " + entity_id + " not found in OpenCTI"
                     )
-                    if external_reference is not None:
-                        entity = self.helper.api.stix_domain_object.read(
-                            filters=[
-                                {
-                                    "key": "hasExternalReference",
-                                    "values": [external_reference["id"]],
-                                }
-                            ]
-                        )
-                        if entity is None:
-                            entity = self.helper.api.stix_cyber_observable.read(
-                                filters=[
-                                    {
-                                        "key": "hasExternalReference",
-                                        "values": [external_reference["id"]],
-                                    }
-                                ]
-                            )
-                        if entity is not None:
-                            self.helper.api.stix_sighting_relationship.create(
-                                fromId=entity["id"],
-                                toId=self.identity["id"],
-                                first_seen=parse(alert["createdAt"]).strftime(
-                                    "%Y-%m-%dT%H:%M:%SZ"
-                                ),
-                                last_seen=parse(alert["createdAt"]).strftime(
-                                    "%Y-%m-%dT%H:%M:%SZ"
-                                ),
-                                count=1,
-                                confidence=85,
-                            )
+                    continue
+                self.standard_ids[entity_id] = (
+                    entity["standard_id"],
+                    "Stix-Cyber-Observable" in entity["parent_types"],
+                )
+
+    def _send_sightings(self, sightings):
+        self._resolve_standard_ids(list(sightings))
+        objects = []
+        for entity_id, sighting in sightings.items():
+            if entity_id not in self.standard_ids:
+                continue
+            standard_id, is_observable = self.standard_ids[entity_id]
+            objects.append(
+                Sighting(
+                    id=OpenCTIStix2Utils.generate_random_stix_id("sighting"),
+                    sighting_of_ref=FAKE_INDICATOR_ID if is_observable else standard_id,
+                    where_sighted_refs=[self.identity["standard_id"]],
+                    first_seen=sighting["first_seen"].strftime("%Y-%m-%dT%H:%M:%SZ"),
+                    last_seen=sighting["last_seen"].strftime("%Y-%m-%dT%H:%M:%SZ"),
+                    count=sighting["count"],
+                    confidence=85,
+                    custom_properties={"x_opencti_sighting_of_ref": standard_id}
+                    if is_observable
+                    else {},
+                )
+            )
+        if len(objects) == 0:
+            return 0
+        now = datetime.now(timezone.utc).strftime("%Y-%m-%d %H:%M:%S")
+        work_id = self.helper.api.work.initiate_work(
+            self.helper.connect_id, "Tanium sightings @ " + now
+        )
+        self.helper.send_stix2_bundle(
+            Bundle(objects=objects, allow_custom=True).serialize(),
+            work_id=work_id,
+            update=False,
+        )
+        self.helper.api.work.to_processed(
+            work_id, str(len(objects)) + " sightings sent from Tanium"
+        )
+        return len(objects)
+
+    def poll(self):
+        """Send the sightings of the alerts created since the last poll"""
+        state = self.helper.get_state()
+        if state and "lastAlertTimestamp" in state:
+            last_timestamp = state["lastAlertTimestamp"]
+        else:
+            last_timestamp = 0
+
+        # OpenCTI entity id -> first seen, last seen and count of its alerts
+        sightings = {}
+        new_timestamp = last_timestamp
+        for alert in self._get_alerts(last_timestamp):
+            created_at = parse(alert["createdAt"])
+            alert_timestamp = int(created_at.timestamp())
+            if alert_timestamp <= int(last_timestamp):
+                continue
+            new_timestamp = max(new_timestamp, alert_timestamp)
+            entity_id = self._get_entity_id(alert["intelDocId"])
+            if entity_id is None:
+                continue
+            if entity_id not in sightings:
+                sightings[entity_id] = {
+                    "first_seen": created_at,
+                    "last_seen": created_at,
+                    "count": 0,
+                }
+            sighting = sightings[entity_id]
+            sighting["first_seen"] = min(sighting["first_seen"], created_at)
+            sighting["last_seen"] = max(sighting["last_seen"], created_at)
+            sighting["count"] += 1
+
+        if len(sightings) > 0:
+            count = self._send_sightings(sightings)
+            self.helper.log_info("[SIGHTINGS] Sent " + str(count) + " sightings")
+        if new_timestamp != last_timestamp:
+            # Mark as processed, keeping the live stream checkpoint
+            self.event_pool.update_state("lastAlertTimestamp", new_timestamp)
+
+    def run(self):
+        self.helper.log_info("[SIGHTINGS] Starting alerts gatherer")
+        while True:
+            try:
+                self.poll()
+            except Exception as e:
+                self.helper.log_error("[SIGHTINGS] " + str(e))
             time.sleep(60)
@@ -5,8 +5,12 @@
 import os
 import yaml
 import json
+import atexit
+import signal
 
 from pycti import OpenCTIConnectorHelper, get_config_variable
+from pycti.connector.opencti_connector_helper import ListenStream
+from event_pool import CheckpointHelper, EventPool
 from intel_cache import IntelCache
 from import_manager import IntelManager
 from tanium_api_handler import TaniumApiHandler
@@ -57,6 +61,43 @@ class TaniumConnector:
         self.tanium_computer_groups = get_config_variable(
             "TANIUM_COMPUTER_GROUPS", ["tanium", "computer_groups"], config, False, ""
         ).split(",")
+        # Interval of the automatic quickscans, in seconds
+        self.tanium_quickscan_interval = get_config_variable(
+            "TANIUM_QUICKSCAN_INTERVAL",
+            ["tanium", "quickscan_interval"],
+            config,
+            True,
+            30,
+        )
+        # Events processed concurrently (the events of an entity stay in order)
+        self.tanium_workers = get_config_variable(
+            "TANIUM_WORKERS", ["tanium", "workers"], config, True, 4
+        )
+        self.tanium_queue_size = get_config_variable(
+            "TANIUM_QUEUE_SIZE", ["tanium", "queue_size"], config, True, 100
+        )
+        # Snapshot of the Tanium ids of the OpenCTI entities
+        self.tanium_cache_path = get_config_variable(
+            "TANIUM_CACHE_PATH",
+            ["tanium", "cache_path"],
+            config,
+            False,
+            os.path.dirname(os.path.abspath(__file__)) + "/data/intel_cache.tsv",
+        )
+        self.tanium_cache_snapshot_changes = get_config_variable(
+            "TANIUM_CACHE_SNAPSHOT_CHANGES",
+            ["tanium", "cache_snapshot_changes"],
+            config,
+            True,
+            1000,
+        )
+        self.tanium_cache_snapshot_interval = get_config_variable(
+            "TANIUM_CACHE_SNAPSHOT_INTERVAL",
+            ["tanium", "cache_snapshot_interval"],
+            config,
+            True,
+            10,
+        )
 
         # Check Live Stream ID
         if (
@@ -74,10 +115,21 @@ class TaniumConnector:
             self.tanium_ssl_verify,
             self.tanium_auto_quickscan,
             self.tanium_computer_groups,
+            self.tanium_workers,
+            self.tanium_quickscan_interval,
         )
 
         # Initialize managers
-        self.intel_cache = IntelCache(self.helper)
+        self.event_pool = EventPool(
+            self.helper, self.tanium_workers, self.tanium_queue_size
+        )
+        self.intel_cache = IntelCache(
+            self.helper,
+            self.tanium_cache_path,
+            self.tanium_cache_snapshot_changes,
+            self.tanium_cache_snapshot_interval,
+            self.event_pool,
+        )
         self.import_manager = IntelManager(
             self.helper, self.tanium_api_handler, self.intel_cache
         )
@@ -87,8 +139,13 @@ class TaniumConnector:
             data = json.loads(msg.data)["data"]
         except:
             raise ValueError("Cannot process the message: " + msg)
+        self.event_pool.submit(
+            data["x_opencti_id"], self._process_event, msg.event, data
+        )
+
+    def _process_event(self, event, data):
         # Handle creation
-        if msg.event == "create":
+        if event == "create":
             if data["type"] == "indicator":
                 self.helper.log_info(
                     "[CREATE] Processing indicator {" + data["x_opencti_id"] + "}"
@@ -112,7 +169,7 @@ class TaniumConnector:
                     self.import_manager.import_intel_from_observable(data)
             return
         # Handle update
-        if msg.event == "update":
+        if event == "update":
             if data["type"] == "indicator":
                 self.helper.log_info(
                     "[UPDATE] Processing indicator {" + data["x_opencti_id"] + "}"
@@ -133,7 +190,7 @@ class TaniumConnector:
                 self.import_manager.import_intel_from_observable(data, True)
             return
         # Handle delete
-        elif msg.event == "delete":
+        elif event == "delete":
             if data["type"] == "indicator":
                 self.import_manager.delete_intel(data)
             elif data["type"] in [
@@ -149,10 +206,35 @@ class TaniumConnector:
             return
         return
 
+    def _stop(self, signum, frame):
+        # Sent by docker stop, the atexit hooks do not run on signals
+        self.helper.log_info("Stopping, writing the intel cache snapshot")
+        self.intel_cache.close()
+        if self.tanium_api_handler.quickscans is not None:
+            try:
+                self.tanium_api_handler.quickscans.flush()
+            except Exception as e:
+                self.helper.log_error("Unable to trigger the quick scans: " + str(e))
+        os._exit(0)
+
     def start(self):
-        self.sightings = Sightings(self.helper, self.tanium_api_handler)
+        self.intel_cache.start()
+        atexit.register(self.intel_cache.close)
+        signal.signal(signal.SIGTERM, self._stop)
+        self.sightings = Sightings(
+            self.helper, self.tanium_api_handler, self.intel_cache, self.event_pool
+        )
         self.sightings.start()
-        self.helper.listen_stream(self._process_message)
+        self.event_pool.start()
+        ListenStream(
+            CheckpointHelper(self.helper, self.event_pool),
+            self._process_message,
+            None,
+            None,
+            None,
+            None,
+            None,
+        ).start()
 
 
 if __name__ == "__main__":
@@ -2,8 +2,12 @@
 # TANIUM API HANDLER #
 ######################
 
+import threading
+import time
 import requests
 
+from collections import OrderedDict
+from requests.adapters import HTTPAdapter
 from stix2slider import slide_string
 from stix2slider.options import initialize_options
 
@@ -18,6 +22,8 @@ class TaniumApiHandler:
         ssl_verify=True,
         auto_quickscan=False,
         auto_quickscan_computer_groups=[],
+        pool_size=4,
+        quickscan_interval=30,
     ):
         # Variables
         self.helper = helper
@@ -28,8 +34,19 @@ class TaniumApiHandler:
         self.auto_quickscan = auto_quickscan
         self.auto_quickscan_computer_groups = auto_quickscan_computer_groups
 
+        # Keep the connections to Tanium open, shared by the event workers
+        self.http_session = requests.Session()
+        self.http_session.verify = self.ssl_verify
+        self.http_session.mount(
+            "https://", HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        )
+        self.http_session.mount(
+            "http://", HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        )
+
         # Session
         self.session = None
+        self.session_lock = threading.Lock()
         self._acquire_session()
 
         # Intelligence documents source
@@ -51,24 +68,35 @@ class TaniumApiHandler:
             )
             self.source_id = str(source["id"])
 
+        # Quick scans of the imported intel documents
+        self.quickscans = None
+        if self.auto_quickscan:
+            self.quickscans = QuickscanBatcher(
+                self, self.auto_quickscan_computer_groups, quickscan_interval
+            )
+            self.quickscans.start()
+
     def get_url(self):
         return self.url
 
-    def _acquire_session(self):
-        payload = {
-            "username": self.login,
-            "password": self.password,
-        }
-        r = requests.post(
-            self.url + "/api/v2/session/login",
-            json=payload,
-            verify=self.ssl_verify,
-        )
-        if r.status_code == 200:
-            result = r.json()
-            self.session = result["data"]["session"]
-        else:
-            raise ValueError("Cannot access or login to the Tanium API")
+    def _acquire_session(self, expired_session=None):
+        with self.session_lock:
+            if expired_session is not None and self.session != expired_session:
+                # Already renewed by another worker
+                return
+            payload = {
+                "username": self.login,
+                "password": self.password,
+            }
+            r = self.http_session.post(
+                self.url + "/api/v2/session/login",
+                json=payload,
+            )
+            if r.status_code == 200:
+                result = r.json()
+                self.session = result["data"]["session"]
+            else:
+                raise ValueError("Cannot access or login to the Tanium API")
 
     def _query(
         self,
@@ -80,7 +108,8 @@ class TaniumApiHandler:
         retry=False,
     ):
         self.helper.log_info("Query " + method + " on " + uri)
-        headers = {"session": self.session}
+        session = self.session
+        headers = {"session": session}
         if method != "upload":
             headers["content-type"] = content_type
         if type is not None:
@@ -96,76 +125,67 @@ class TaniumApiHandler:
                     payload["description"].replace("\n", " ").strip()
                 )
         if method == "get":
-            r = requests.get(
+            r = self.http_session.get(
                 self.url + uri,
                 headers=headers,
                 params=payload,
-                verify=self.ssl_verify,
             )
         elif method == "post":
             if content_type == "application/octet-stream":
-                r = requests.post(
+                r = self.http_session.post(
                     self.url + uri,
                     headers=headers,
                     data=payload["document"],
-                    verify=self.ssl_verify,
                 )
             elif type is not None:
-                r = requests.post(
+                r = self.http_session.post(
                     self.url + uri,
                     headers=headers,
                     data=payload["intelDoc"],
-                    verify=self.ssl_verify,
                 )
             else:
-                r = requests.post(
+                r = self.http_session.post(
                     self.url + uri,
                     headers=headers,
                     json=payload,
-                    verify=self.ssl_verify,
                 )
         elif method == "upload":
             f = open(payload["filename"], "w")
             f.write(payload["content"])
             f.close()
             files = {"hash": open(payload["filename"], "rb")}
-            r = requests.post(
+            r = self.http_session.post(
                 self.url + uri,
                 headers=headers,
                 files=files,
-                verify=self.ssl_verify,
             )
         elif method == "put":
             if type is not None:
-                r = requests.put(
+                r = self.http_session.put(
                     self.url + uri,
                     headers=headers,
                     data=payload["intelDoc"],
-                    verify=self.ssl_verify,
                 )
             elif content_type == "application/xml":
-                r = requests.put(
+                r = self.http_session.put(
                     self.url + uri,
                     headers=headers,
                     data=payload,
-                    verify=self.ssl_verify,
                 )
             else:
-                r = requests.put(
+                r = self.http_session.put(
                     self.url + uri,
                     headers=headers,
                     json=payload,
-                    verify=self.ssl_verify,
                 )
         elif method == "patch":
-            r = requests.patch(
+            r = self.http_session.patch(
                 self.url + uri,
                 headers=headers,
                 json=payload,
-                verify=self.ssl_verify,
             )
         elif method == "delete":
-            r = requests.delete(self.url + uri, headers=headers, verify=self.ssl_verify)
+            r = self.http_session.delete(self.url + uri, headers=headers)
         else:
             raise ValueError("Unsupported method")
         if r.status_code == 200:
@@ -174,7 +194,7 @@ class TaniumApiHandler:
             except:
                 return r.text
         elif r.status_code == 401 and not retry:
-            self._acquire_session()
+            self._acquire_session(session)
             return self._query(method, uri, payload, content_type, type, True)
         elif r.status_code == 401:
             raise ValueError("Query failed, permission denied")
@@ -470,13 +490,74 @@ class TaniumApiHandler:
         )
 
     def trigger_quickscan(self, intel_document_id):
-        if self.auto_quickscan:
-            for computer_group in self.auto_quickscan_computer_groups:
-                self._query(
-                    "post",
-                    "/plugin/products/detect3/api/v1/quick-scans",
-                    {
-                        "computerGroupId": int(computer_group),
-                        "intelDocId": intel_document_id,
-                    },
-                )
+        if self.quickscans is not None:
+            self.quickscans.add(intel_document_id)
+
+
+class QuickscanBatcher(threading.Thread):
+    """
+    Quick scans of the imported intel documents, triggered every `interval`
+    seconds for the documents imported in the meantime instead of once per
+    document, and only once per document imported or updated several times.
+    """
+
+    def __init__(self, api_handler, computer_groups, interval):
+        super(QuickscanBatcher, self).__init__()
+        self.daemon = True
+        self.api_handler = api_handler
+        self.computer_groups = [
+            int(computer_group)
+            for computer_group in computer_groups
+            if len(str(computer_group).strip()) > 0
+        ]
+        self.interval = float(interval)
+        self.lock = threading.Lock()
+        self._pending = OrderedDict()
+
+    def add(self, intel_document_id):
+        with self.lock:
+            self._pending[intel_document_id] = True
+
+    def flush(self):
+        """
+        Trigger the quick scans of the pending documents. If a request fails, the
+        documents not scanned on every computer group yet are queued again, to
+        be scanned with the next flush.
+        """
+        with self.lock:
+            intel_document_ids = list(self._pending)
+            self._pending = OrderedDict()
+        if len(intel_document_ids) == 0:
+            return
+        self.api_handler.helper.log_info(
+            "Triggering quick scans of "
+            + str(len(intel_document_ids))
+            + " intel documents"
+        )
+        for index, intel_document_id in enumerate(intel_document_ids):
+            try:
+                for computer_group in self.computer_groups:
+                    self.api_handler._query(
+                        "post",
+                        "/plugin/products/detect3/api/v1/quick-scans",
+                        {
+                            "computerGroupId": computer_group,
+                            "intelDocId": intel_document_id,
+                        },
+                    )
+            except Exception:
+                with self.lock:
+                    pending = self._pending
+                    self._pending = OrderedDict.fromkeys(
+                        intel_document_ids[index:], True
+                    )
+                    self._pending.update(pending)
+                raise
+
+    def run(self):
+        while True:
+            time.sleep(self.interval)
+            try:
+                self.flush()
+            except Exception as e:
+                self.api_handler.helper.log_error(str(e))
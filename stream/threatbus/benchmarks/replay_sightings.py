@@ -0,0 +1,153 @@
+"""
+Benchmark harness replaying sighting traffic over a local ZeroMQ Threat Bus
+
+Starts a fake Threat Bus ZMQ-App (management, publisher and subscriber sockets
+on localhost), registers a ThreatBusConnectorHelper to it, publishes STIX-2
+Sightings of a set of indicators as fast as possible, and reports the receive
+throughput and the bundles the SightingBatcher would send to OpenCTI.
+
+Usage: PYTHONPATH=src python benchmarks/replay_sightings.py [sightings] [indicators] [batch size]
+"""
+
+import json
+import sys
+import threading
+import time
+import uuid
+
+import zmq
+from stix2 import Sighting, parse
+
+from sighting_batcher import SightingBatcher
+from threatbus_connector_helper import ThreatBusConnectorHelper
+
+MANAGE_PORT = 13370
+PUB_PORT = 13371
+SUB_PORT = 13372
+TOPIC = "benchmark-p2p-topic"
+IDENTITY_ID = "identity--7b82b010-b1c0-4dae-981f-7756374a17df"
+
+
+class FakeOpenCTIHelper:
+    connect_id = "benchmark"
+
+    def __init__(self):
+        self.api = self
+        self.work = self
+        self.bundles = 0
+        self.sightings = 0
+        self.count = 0
+
+    def initiate_work(self, connector_id, friendly_name):
+        return "work"
+
+    def to_processed(self, work_id, message):
+        pass
+
+    def send_stix2_bundle(self, bundle, **kwargs):
+        objects = json.loads(bundle)["objects"]
+        self.bundles += 1
+        self.sightings += len(objects)
+        self.count += sum(sighting["count"] for sighting in objects)
+
+    def log_info(self, msg):
+        pass
+
+
+def run_management(context, stop):
+    """Answers the subscription, heartbeat and unsubscription requests"""
+    socket = context.socket(zmq.REP)
+    socket.bind(f"tcp://127.0.0.1:{MANAGE_PORT}")
+    poller = zmq.Poller()
+    poller.register(socket, zmq.POLLIN)
+    while not stop.is_set():
+        if not poller.poll(100):
+            continue
+        action = socket.recv_json()
+        reply = {"status": "success"}
+        if action["action"] == "subscribe":
+            reply.update({"topic": TOPIC, "pub_port": PUB_PORT, "sub_port": SUB_PORT})
+        socket.send_json(reply)
+    socket.close(linger=0)
+
+
+def build_messages(sightings, indicators):
+    indicator_ids = [f"indicator--{uuid.uuid4()}" for _ in range(indicators)]
+    messages = []
+    for i in range(sightings):
+        sighting = Sighting(
+            sighting_of_ref=indicator_ids[i % indicators],
+            where_sighted_refs=[IDENTITY_ID],
+            first_seen="2022-01-01T00:00:00Z",
+            last_seen="2022-01-01T00:00:01Z",
+        )
+        messages.append(f"{TOPIC} {sighting.serialize()}".encode())
+    return messages
+
+
+def main(sightings, indicators, batch_size):
+    messages = build_messages(sightings, indicators)
+    context = zmq.Context.instance()
+    stop = threading.Event()
+    threading.Thread(target=run_management, args=(context, stop), daemon=True).start()
+    publisher = context.socket(zmq.PUB)
+    publisher.setsockopt(zmq.SNDHWM, 0)
+    publisher.bind(f"tcp://127.0.0.1:{SUB_PORT}")
+    collector = context.socket(zmq.SUB)
+    collector.bind(f"tcp://127.0.0.1:{PUB_PORT}")
+
+    opencti_helper = FakeOpenCTIHelper()
+    batcher = SightingBatcher(
+        opencti_helper, lambda: {"standard_id": IDENTITY_ID}, batch_size
+    )
+    received = threading.Event()
+    counter = {"messages": 0}
+
+    def handle(msg):
+        batcher.add(parse(msg, allow_custom=True))
+        counter["messages"] += 1
+        if counter["messages"] == sightings:
+            received.set()
+
+    helper = ThreatBusConnectorHelper(
+        f"127.0.0.1:{MANAGE_PORT}",
+        handle,
+        lambda msg: None,
+        print,
+        subscribe_topics=["stix2/sighting"],
+        publish_topic="stix2/indicator",
+        idle_callback=batcher.flush,
+    )
+    helper.daemon = True
+    helper.start()
+    while helper.receive_socket is None:
+        time.sleep(0.1)
+    # Let the subscription reach the publisher
+    time.sleep(1)
+
+    start = time.perf_counter()
+    for message in messages:
+        publisher.send(message)
+    sent = time.perf_counter() - start
+    if not received.wait(timeout=600):
+        print(f"Timeout after {counter['messages']} messages")
+    elapsed = time.perf_counter() - start
+    # The last batch is flushed once the queue is drained
+    time.sleep(0.5)
+
+    print(f"Published {sightings} sightings of {indicators} indicators in {sent:.2f}s")
+    print(f"Received and processed in {elapsed:.2f}s ({sightings / elapsed:.0f} msg/s)")
+    print(
+        f"Sent {opencti_helper.sightings} sightings (count {opencti_helper.count})"
+        f" in {opencti_helper.bundles} bundles"
+    )
+    stop.set()
+
+
+if __name__ == "__main__":
+    args = [int(arg) for arg in sys.argv[1:]]
+    main(
+        args[0] if len(args) > 0 else 20000,
+        args[1] if len(args) > 1 else 100,
+        args[2] if len(args) > 2 else 1000,
+    )
@@ -8,6 +8,7 @@ from threatbus.data import Operation, ThreatBusSTIX2Constants
 from typing import Union
 import yaml
 
+from sighting_batcher import SightingBatcher
 from threatbus_connector_helper import ThreatBusConnectorHelper
 
 
@@ -46,9 +47,28 @@ class ThreatBusConnector(object):
             isNumber=True,
             default=0,
         )
+        threatbus_queue_size = get_config_variable(
+            "THREATBUS_QUEUE_SIZE",
+            ["threatbus", "queue_size"],
+            config,
+            isNumber=True,
+            default=10000,
+        )
+        threatbus_sightings_batch_size = get_config_variable(
+            "THREATBUS_SIGHTINGS_BATCH_SIZE",
+            ["threatbus", "sightings_batch_size"],
+            config,
+            isNumber=True,
+            default=1000,
+        )
 
         # Helper initialization
         self.opencti_helper = OpenCTIConnectorHelper(config)
+        self.sighting_batcher = SightingBatcher(
+            self.opencti_helper,
+            self._get_threatbus_entity,
+            batch_size=threatbus_sightings_batch_size,
+        )
         zmq_endpoint = f"{self.threatbus_zmq_host}:{self.threatbus_zmq_port}"
         self.threatbus_helper = ThreatBusConnectorHelper(
             zmq_endpoint,
@@ -58,6 +78,8 @@ class ThreatBusConnector(object):
             subscribe_topics=["stix2/sighting", "stix2/indicator"],
             publish_topic="stix2/indicator",
             snapshot=threatbus_snapshot,
+            idle_callback=self.sighting_batcher.flush,
+            queue_size=threatbus_queue_size,
         )
 
     def _get_threatbus_entity(self) -> int:
@@ -168,8 +190,9 @@ class ThreatBusConnector(object):
 
     def _report_sighting(self, sighting: Sighting):
         """
-        Reports a STIX-2 Sighting to OpenCTI, modeled as a
-        `OpenCTI.stix_sighting_relation`.
+        Reports a STIX-2 Sighting to OpenCTI. Sightings are batched per
+        indicator and sent as a STIX-2 bundle once the received messages are
+        processed or the batch is full.
         @param sighting The STIX-2 Sighting object to report
         """
         if type(sighting) is not Sighting:
@@ -177,22 +200,7 @@ class ThreatBusConnector(object):
                 f"Error reporting sighting from Threat Bus. Expected a STIX-2 Sighting: {sighting}"
             )
             return
-        entity_id = self._get_threatbus_entity().get("id", None)
-        resp = self.opencti_helper.api.stix_sighting_relationship.create(
-            fromId=sighting.sighting_of_ref,
-            toId=entity_id,
-            createdBy=entity_id,
-            first_seen=sighting.first_seen.astimezone().strftime("%Y-%m-%dT%H:%M:%SZ")
-            if sighting.get("first_seen")
-            else None,
-            last_seen=sighting.last_seen.astimezone().strftime("%Y-%m-%dT%H:%M:%SZ")
-            if sighting.get("last_seen")
-            else None,
-            confidence=50,
-            externalReferences=[sighting.sighting_of_ref],
-            count=1,
-        )
-        self.opencti_helper.log_info(f"Created sighting {resp}")
+        self.sighting_batcher.add(sighting)
 
     def _map_to_threatbus(
         self, data: dict, opencti_action: str
@@ -274,6 +282,7 @@ class ThreatBusConnector(object):
         # Fork a new Thread to communicate with Threat Bus
         self.threatbus_helper.start()
         atexit.register(self.threatbus_helper.stop)
+        atexit.register(self.sighting_batcher.flush)
 
         # Send the main loop into a busy loop for processing OpenCTI events
         self.opencti_helper.listen_stream(self._process_message)
@@ -0,0 +1,127 @@
+"""
+Groups the STIX-2 Sightings received from Threat Bus per sighted indicator and
+sends them to OpenCTI as a single STIX-2 bundle, instead of creating one
+OpenCTI sighting per message.
+"""
+
+from datetime import datetime, timezone
+from threading import Lock
+from typing import Callable, Dict
+
+from pycti import OpenCTIStix2Utils
+from stix2 import Bundle, Sighting
+
+
+class SightingBatcher(object):
+    def __init__(
+        self,
+        opencti_helper,
+        get_entity: Callable[[], dict],
+        batch_size: int = 1000,
+        confidence: int = 50,
+    ):
+        """
+        @param opencti_helper The OpenCTIConnectorHelper used to send bundles
+        @param get_entity Returns the OpenCTI entity where sightings happened
+        @param batch_size Number of sightings after which the batch is sent
+        @param confidence The confidence of the reported sightings
+        """
+        self.opencti_helper = opencti_helper
+        self.get_entity = get_entity
+        self.batch_size = max(int(batch_size), 1)
+        self.confidence = confidence
+        self._lock = Lock()
+        # Sighted indicator ID -> first seen, last seen and count
+        self._batch: Dict[str, dict] = {}
+        self._pending = 0
+
+    def add(self, sighting: Sighting):
+        """
+        Adds a STIX-2 Sighting to the batch, sends the batch once it holds
+        `batch_size` sightings.
+        @param sighting The STIX-2 Sighting received from Threat Bus
+        """
+        seen = [
+            timestamp
+            for timestamp in [sighting.get("first_seen"), sighting.get("last_seen")]
+            if timestamp is not None
+        ] or [sighting.created]
+        with self._lock:
+            self._merge(
+                sighting.sighting_of_ref,
+                min(seen),
+                max(seen),
+                sighting.get("count", 1) or 1,
+            )
+            self._pending += 1
+            full = self._pending >= self.batch_size
+        if full:
+            self.flush()
+
+    def _merge(self, indicator_id: str, first_seen, last_seen, count: int):
+        aggregate = self._batch.get(indicator_id, None)
+        if aggregate is None:
+            self._batch[indicator_id] = {
+                "first_seen": first_seen,
+                "last_seen": last_seen,
+                "count": count,
+            }
+            return
+        aggregate["first_seen"] = min(aggregate["first_seen"], first_seen)
+        aggregate["last_seen"] = max(aggregate["last_seen"], last_seen)
+        aggregate["count"] += count
+
+    def flush(self) -> int:
+        """
+        Sends the batched sightings as one STIX-2 bundle. If sending fails, the
+        sightings are merged back into the batch, to be sent with the next one.
+        @return The number of sightings sent
+        """
+        with self._lock:
+            batch, self._batch = self._batch, {}
+            pending, self._pending = self._pending, 0
+        if len(batch) == 0:
+            return 0
+        try:
+            return self._send(batch)
+        except Exception:
+            with self._lock:
+                for indicator_id, aggregate in batch.items():
+                    self._merge(
+                        indicator_id,
+                        aggregate["first_seen"],
+                        aggregate["last_seen"],
+                        aggregate["count"],
+                    )
+                self._pending += pending
+            raise
+
+    def _send(self, batch: Dict[str, dict]) -> int:
+        entity_id = self.get_entity().get("standard_id", None)
+        sightings = [
+            Sighting(
+                id=OpenCTIStix2Utils.generate_random_stix_id("sighting"),
+                sighting_of_ref=indicator_id,
+                where_sighted_refs=[entity_id],
+                created_by_ref=entity_id,
+                first_seen=aggregate["first_seen"],
+                last_seen=aggregate["last_seen"],
+                count=aggregate["count"],
+                confidence=self.confidence,
+            )
+            for indicator_id, aggregate in batch.items()
+        ]
+        now = datetime.now(timezone.utc).strftime("%Y-%m-%d %H:%M:%S")
+        work_id = self.opencti_helper.api.work.initiate_work(
+            self.opencti_helper.connect_id, f"Threat Bus sightings @ {now}"
+        )
+        self.opencti_helper.send_stix2_bundle(
+            Bundle(objects=sightings, allow_custom=True).serialize(),
+            work_id=work_id,
+            update=False,
+        )
+        self.opencti_helper.api.work.to_processed(
+            work_id, f"{len(sightings)} sightings sent from Threat Bus"
+        )
+        self.opencti_helper.log_info(f"Sent {len(sightings)} sightings to OpenCTI")
+        return len(sightings)
@@ -5,9 +5,11 @@ MQ.
 """
 
 import asyncio
+from concurrent.futures import ThreadPoolExecutor
 from threading import Event, Thread
 from typing import Callable, List
 import zmq
+import zmq.asyncio
 import time
 
 
@@ -71,6 +73,14 @@ def unsubscribe(endpoint: str, topic: str):
 
 
 class ThreatBusConnectorHelper(Thread):
+    """
+    Receives the messages of Threat Bus on an asyncio event loop. Each time the
+    subscriber socket is readable, it is drained until empty into a bounded
+    queue. The message callback runs on a separate worker thread, so blocking
+    OpenCTI calls do not stall the socket. The idle callback is invoked once
+    the queue has been emptied, e.g. to flush batched work.
+    """
+
     def __init__(
         self,
         zmq_endpoint: str,
@@ -80,23 +90,30 @@ class ThreatBusConnectorHelper(Thread):
         subscribe_topics: List[str] = None,
         publish_topic: str = None,
         snapshot: int = 0,
+        idle_callback: Callable[[], None] = None,
+        queue_size: int = 10000,
     ):
         super(ThreatBusConnectorHelper, self).__init__()
         self._stop_event = Event()
         self.zmq_manage_ep = zmq_endpoint
         self.message_callback = message_callback
+        self.idle_callback = idle_callback
         self.log_error = log_error_callback
         self.log_info = log_info_callback
         self.subscribe_topics = subscribe_topics
         self.publish_topic = publish_topic
         self.snapshot = snapshot
+        self.queue_size = queue_size
 
         self.event_loop = None
+        self.context = None
+        self.queue = None
+        # A single worker, so messages are processed in the order received
+        self.executor = ThreadPoolExecutor(max_workers=1)
 
         # These fields will be populated upon successful registration
         self.publish_socket = None
         self.receive_socket = None
-        self.poller = None
         self.p2p_topic = None
 
     def _running(self):
@@ -126,44 +143,87 @@ class ThreatBusConnectorHelper(Thread):
     def run(self):
         """
         Starts a zmq subscriber and listens for new messages from Threat Bus.
-        Invokes the given callback for every received message.
-        @param callback A callable function to invoke for received messages.
+        Invokes the message callback for every received message.
         """
-        while not self.receive_socket:
-            try:
-                self._register_to_threatbus()
-            except Exception as e:
-                self.log_error(e)
-                time.sleep(5)
-
         # create new event loop for the current thread
         loop = asyncio.new_event_loop()
         asyncio.set_event_loop(loop)
+        self.event_loop = loop
+        self.context = zmq.asyncio.Context()
+        self.queue = asyncio.Queue(maxsize=self.queue_size)
 
         def exception_handler(loop, context):
             self.log_error(f"Error: {context}")
 
         loop.set_exception_handler(exception_handler)
-        loop.run_until_complete(asyncio.wait([self._heartbeat(), self._receive()]))
+
+        while not self.receive_socket:
+            try:
+                loop.run_until_complete(self._register_to_threatbus())
+            except Exception as e:
+                self.log_error(e)
+                time.sleep(5)
+
+        loop.run_until_complete(
+            asyncio.gather(self._heartbeat(), self._receive(), self._consume())
+        )
+        self.executor.shutdown()
         loop.close()
 
     async def _receive(self):
+        """
+        Waits for the subscriber socket to become readable, then reads all
+        pending messages without waiting. Blocks when the queue is full, which
+        leaves the messages to the ZeroMQ buffers until there is room.
+        """
         while self._running():
-            socks = dict(
-                self.poller.poll(timeout=1000)
-            )  # smaller timeouts may increase CPU load
-            if (
-                self.receive_socket in socks
-                and socks[self.receive_socket] == zmq.POLLIN
-            ):
-                try:
-                    topic, msg = self.receive_socket.recv().decode().split(" ", 1)
-                    asyncio.get_event_loop().call_soon_threadsafe(
-                        self.message_callback, msg
-                    )
-                except Exception:
+            socket = self.receive_socket
+            try:
+                # the timeout only bounds the reaction to a stop or a reconnection
+                if not await socket.poll(timeout=1000):
                     continue
-            await asyncio.sleep(0.01)
+                while True:
+                    raw = await socket.recv(zmq.NOBLOCK)
+                    try:
+                        topic, msg = raw.decode().split(" ", 1)
+                    except Exception:
+                        continue
+                    await self.queue.put(msg)
+            except zmq.Again:
+                continue
+            except zmq.ZMQError:
+                # the socket was replaced after a reconnection
+                continue
+
+    async def _consume(self):
+        """
+        Hands the queued messages to the worker thread, as many as are queued
+        at once.
+        """
+        loop = asyncio.get_event_loop()
+        while self._running() or not self.queue.empty():
+            try:
+                msg = await asyncio.wait_for(self.queue.get(), timeout=1)
+            except asyncio.TimeoutError:
+                continue
+            batch = [msg]
+            while not self.queue.empty():
+                batch.append(self.queue.get_nowait())
+            await loop.run_in_executor(
+                self.executor, self._dispatch, batch, self.queue.empty()
+            )
+
+    def _dispatch(self, batch: List[str], idle: bool):
+        for msg in batch:
+            try:
+                self.message_callback(msg)
+            except Exception as e:
+                self.log_error(f"Error processing Threat Bus message: {e}")
+        if idle and self.idle_callback is not None:
+            try:
+                self.idle_callback()
+            except Exception as e:
+                self.log_error(f"Error processing Threat Bus messages: {e}")
 
     async def _heartbeat(self):
         """
@@ -171,24 +231,30 @@ class ThreatBusConnectorHelper(Thread):
         Bus. Initiates reconnection in case the connection is lost (heartbeat is
         not answered.)
         """
+        loop = asyncio.get_event_loop()
         while self._running():
             action = {"action": "heartbeat", "topic": self.p2p_topic}
-            reply = send_manage_message(self.zmq_manage_ep, action)
+            reply = await loop.run_in_executor(
+                None, send_manage_message, self.zmq_manage_ep, action
+            )
             if not reply_is_success(reply):
                 self.log_error("Lost connection to Threat Bus.")
                 try:
-                    self._register_to_threatbus()
+                    await self._register_to_threatbus()
                 except Exception as e:
                     self.log_error(e)
             await asyncio.sleep(5)  # heartbeat every 5 secs
 
-    def _register_to_threatbus(self):
+    async def _register_to_threatbus(self):
         """
         Registers this connector at the configured Threat Bus endpoint.
         Populates the registration details to this connector instance.
-        @return True for successful subscription, False otherwise
+        Raises a RuntimeError if the subscription fails.
         """
-        reply = subscribe(self.zmq_manage_ep, self.subscribe_topics, self.snapshot)
+        loop = asyncio.get_event_loop()
+        reply = await loop.run_in_executor(
+            None, subscribe, self.zmq_manage_ep, self.subscribe_topics, self.snapshot
+        )
         if not reply_is_success(reply):
             raise RuntimeError(
                 f"Threat Bus subscription with topics {self.subscribe_topics} failed. Is the endpoint reachable?"
@@ -207,17 +273,21 @@ class ThreatBusConnectorHelper(Thread):
         if self.p2p_topic:
             # p2p_topic is already set, so we might be recovering from a
             # connection loss. Unsubscribe the old topic before re-subscribing.
-            self._unsubscribe()
+            await loop.run_in_executor(None, self._unsubscribe)
         self.p2p_topic = p2p_topic
-        zmq_host = self.zmq_manage_ep.split(":")[1]
-        self.publish_socket = zmq.Context().socket(zmq.PUB)
-        self.publish_socket.connect(f"tcp://{zmq_host}:{pub_port}")
-        self.receive_socket = zmq.Context().socket(zmq.SUB)
-        self.receive_socket.connect(f"tcp://{zmq_host}:{sub_port}")
-        self.receive_socket.setsockopt(zmq.SUBSCRIBE, self.p2p_topic.encode())
+        zmq_host = self.zmq_manage_ep.rsplit(":", 1)[0]
+        # The publisher is used from the OpenCTI stream thread, so it is a
+        # regular socket, the subscriber belongs to the event loop
+        publish_socket = zmq.Context.instance().socket(zmq.PUB)
+        publish_socket.connect(f"tcp://{zmq_host}:{pub_port}")
+        receive_socket = self.context.socket(zmq.SUB)
+        receive_socket.connect(f"tcp://{zmq_host}:{sub_port}")
+        receive_socket.setsockopt(zmq.SUBSCRIBE, self.p2p_topic.encode())
+        if self.receive_socket is not None:
+            self.receive_socket.close(linger=0)
+        self.publish_socket = publish_socket
+        self.receive_socket = receive_socket
         self.log_info(f"Subscribed to Threat Bus using p2p_topic '{self.p2p_topic}'.")
-        self.poller = zmq.Poller()
-        self.poller.register(self.receive_socket, zmq.POLLIN)
 
         # unset the snapshot interval, so it is not re-requested in case the
         # connector and Threat Bus lose connection and reconnect.